@@ -0,0 +1,116 @@
+#---------------------------------------------------------------
+# FoLiA Document Server - Compression module
+#   by Maarten van Gompel
+#   Centre for Language & Speech Technology, Radboud University Nijmegen
+#   & KNAW Humanities Cluster
+#   http://proycon.github.io/folia
+#   http://github.com/proycon/foliadocserve
+#   proycon AT anaproy DOT nl
+#
+# The FoLiA Document Server is a backend HTTP service to interact with
+# documents in the FoLiA format, a rich XML-based format for linguistic
+# annotation (http://proycon.github.io/folia). It provides an interface to
+# efficiently edit FoLiA documents through the FoLiA Query Language (FQL).
+#
+#   Licensed under GPLv3
+#
+#----------------------------------------------------------------
+
+import gzip
+import lzma
+from lxml import etree
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+FOLIAEXTENSION = ".folia.xml"
+
+COMPRESSIONS = ('gz','xz','zst') #supported compression methods, also used as file extensions (appended to FOLIAEXTENSION)
+
+def getcompression(filename):
+    """Returns the compression method of the given filename (based on its extension), or None if the file is not compressed"""
+    for compression in COMPRESSIONS:
+        if filename.endswith(FOLIAEXTENSION + '.' + compression):
+            return compression
+    return None
+
+def getextension(compression):
+    """Returns the full file extension for documents with the specified compression (None for uncompressed)"""
+    if compression:
+        return FOLIAEXTENSION + '.' + compression
+    else:
+        return FOLIAEXTENSION
+
+def getextensions():
+    """Returns all file extensions we recognise as FoLiA documents, uncompressed first"""
+    return (FOLIAEXTENSION,) + tuple(FOLIAEXTENSION + '.' + compression for compression in COMPRESSIONS)
+
+def isfoliafile(filename):
+    return filename.endswith(FOLIAEXTENSION) or getcompression(filename) is not None
+
+def stripextension(filename):
+    """Strips the FoLiA extension (including any compression extension) from a filename"""
+    compression = getcompression(filename)
+    if compression:
+        return filename[:-len(getextension(compression))]
+    elif filename.endswith(FOLIAEXTENSION):
+        return filename[:-len(FOLIAEXTENSION)]
+    return filename
+
+def checkcompression(compression):
+    """Checks whether the compression method is valid and available, raises ValueError otherwise"""
+    if compression and compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression method: " + compression + ", expected one of: " + ", ".join(COMPRESSIONS))
+    if compression == 'zst' and zstandard is None:
+        raise ValueError("Compression method zst requires the zstandard module, which is not installed")
+
+def openfile(filename, mode='rb', compression=None):
+    """Opens a (possibly compressed) file in binary mode. The compression method is derived from the filename unless explicitly specified"""
+    if compression is None:
+        compression = getcompression(filename)
+    if compression == 'gz':
+        return gzip.open(filename, mode)
+    elif compression == 'xz':
+        return lzma.open(filename, mode)
+    elif compression == 'zst':
+        checkcompression(compression)
+        return zstandard.open(filename, mode)
+    else:
+        return open(filename, mode)
+
+def readfile(filename, compression=None):
+    """Reads and decompresses the entire file, returns bytes"""
+    with openfile(filename, 'rb', compression) as f:
+        return f.read()
+
+def decompress(data, compression):
+    """Decompresses bytes compressed with the specified method (None for uncompressed)"""
+    if compression == 'gz':
+        return gzip.decompress(data)
+    elif compression == 'xz':
+        return lzma.decompress(data)
+    elif compression == 'zst':
+        checkcompression(compression)
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data) #also works if the frame does not record the content size
+    else:
+        return data
+
+def writefile(filename, data, compression=None):
+    """Writes (and compresses) the given bytes to file"""
+    with openfile(filename, 'wb', compression) as f:
+        f.write(data)
+
+def serialise(doc):
+    """Serialises a FoLiA document to bytes, identical to what folia.Document.save() writes"""
+    return etree.tostring(doc.xml(), xml_declaration=True, pretty_print=True, encoding='utf-8')
+
+def savedocument(doc, filename, compression=None):
+    """Saves a FoLiA document to the specified file, compressing it if needed. The compression method is derived from the filename unless explicitly specified"""
+    if compression is None:
+        compression = getcompression(filename)
+    if compression:
+        writefile(filename, serialise(doc), compression)
+    else:
+        doc.save(filename)
@@ -16,17 +16,21 @@
 #
 #----------------------------------------------------------------
 
-import json
 import random
 import sys
+import threading
 from folia import fql
 import folia.main as folia
 from foliatools.foliatextcontent import linkstrings
+from foliadocserve.jsonencoding import dumps
+from foliadocserve.setdefinitions import SetDefinitionCache
 
 
 ELEMENTLIMIT = 5000 #structure elements only
 
 
+CUSTOMSLICESIZE = 50 #default number of results per page (custom slice) in search results
+
 ELEMENTMEMORYLIMIT = 10000000 #very hard abort (exception) after this many elements, to protect memory overflow
 
 def getflatargs(params):
@@ -52,6 +56,8 @@ def getflatargs(params):
         args['slices'] = [ ( x.split(':')[0], int(x.split(':')[1])) for x in  params['slices'].split(',') ]  #comma separated list of xmltag:slicesize
     else:
         args['slices'] = ""
+    if 'customslicesize' in params:
+        args['customslicesize'] = int(params['customslicesize']) #number of results per page in search results
     if 'textclasses' in params:
         args['textclasses']= bool(int(params['declarations']))
     else:
@@ -95,14 +101,19 @@ def getslices(doc, Class, size=100):
 
 def parseresults(results, doc, **kwargs):
     response = {'version': kwargs['version']} #foliadocserve version
+    if 'fragments' in kwargs and kwargs['fragments'] is not None:
+        fragments = kwargs['fragments'] #cache of pre-encoded blocks for this document, maintained by the document store
+    else:
+        fragments = {}
+    prefragments = {} #pre-encoded JSON blocks, spliced into the response at the end
     if 'declarations' in kwargs and kwargs['declarations']:
-        response['declarations'] = tuple(getdeclarations(doc))
-        response['provenance'] = getprovenance(doc)
+        prefragments['declarations'] = getfragment(fragments, 'declarations', lambda: tuple(getdeclarations(doc)))
+        prefragments['provenance'] = getfragment(fragments, 'provenance', lambda: getprovenance(doc))
     if 'setdefinitions' in kwargs and kwargs['setdefinitions']:
-        response['setdefinitions'] =  getsetdefinitions(doc)
-        response['failedsetdefinitions'] = doc.failedsetdefinitions
+        prefragments['setdefinitions'] = getfragment(fragments, 'setdefinitions', lambda: getsetdefinitions(doc))
+        prefragments['failedsetdefinitions'] = getfragment(fragments, 'failedsetdefinitions', lambda: doc.failedsetdefinitions)
     if 'metadata' in kwargs and kwargs['metadata']:
-        response['metadata'] =  getmetadata(doc)
+        prefragments['metadata'] = getfragment(fragments, 'metadata', lambda: getmetadata(doc))
     if 'toc' in kwargs and kwargs['toc']:
         response['toc'] =  gettoc(doc)
     if 'textclasses' in kwargs:
@@ -112,7 +123,10 @@ def parseresults(results, doc, **kwargs):
         response['slicesize'] = {}
         for tag, size in kwargs['slices']:
             Class = folia.XML2CLASS[tag]
-            response['slices'][tag] = list(getslices(doc, Class, size))
+            if Class is folia.Word and kwargs.get('tokentable') is not None:
+                response['slices'][tag] = kwargs['tokentable'].ids(step=size) #same as getslices(), without walking the tree
+            else:
+                response['slices'][tag] = list(getslices(doc, Class, size))
             response['slicesize'][tag] = size
     if 'debug' in kwargs and kwargs['debug']:
         debug = True
@@ -123,13 +137,17 @@ def parseresults(results, doc, **kwargs):
     else:
         log = lambda s: print(s,file=sys.stderr)
     if debug: log("[Debugging for FLAT result parse enabled]")
+    if 'wordorder' in kwargs:
+        wordorder = kwargs['wordorder'] #WordOrder instance for the document, for fast neighbour lookups
+    else:
+        wordorder = None
 
     response['rtl'] = isrtl(doc)
 
     if 'customslicesize' in kwargs and kwargs['customslicesize']:
         customslicesize = int(kwargs['customslicesize'])
     else:
-        customslicesize = 50
+        customslicesize = CUSTOMSLICESIZE
 
 
     if results:
@@ -139,7 +157,8 @@ def parseresults(results, doc, **kwargs):
             postponecustomslice = False
 
     bookkeeper = Bookkeeper() #will abort with partial result if too much data is returned
-    for queryresults in results: #results are grouped per query, we don't care about the origin now
+    remainder = None #elements left to render if we abort
+    for g, queryresults in enumerate(results): #results are grouped per query, we don't care about the origin now
         for i, element in enumerate(queryresults):
             if debug: log("[Processing result from query]")
 
@@ -156,40 +175,197 @@ def parseresults(results, doc, **kwargs):
 
             if not bookkeeper.stop:
                 if isinstance(element,fql.SpanSet):
-                    for e in element:
+                    for k, e in enumerate(element):
                         structure = {}
                         if isinstance(e, (folia.AbstractStructureElement, folia.Correction)):
-                            html, _ = getstructure(e, structure, bookkeeper, debug=debug,log=log)
+                            html, _ = getstructure(e, structure, bookkeeper, debug=debug,log=log, wordorder=wordorder)
                         else:
                             html = None
+                        annotations = getannotations(e.doc,structure,debug=debug,log=log, wordorder=wordorder)
                         response['elements'].append({
                             'elementid': e.id if e.id else None,
                             'html': html,
                             'structure': structure,
-                            'annotations': getannotations(e.doc,structure,debug=debug,log=log),
+                            'annotations': annotations,
                         })
+                        if bookkeeper.stop:
+                            remainder = getremainder(bookkeeper.stopat, e) + list(element[k+1:])
+                            break
                 else:
                     structure = {}
                     if isinstance(element, (folia.AbstractStructureElement, folia.Correction)):
-                        html, _ = getstructure(element, structure, bookkeeper, debug=debug,log=log)
+                        html, _ = getstructure(element, structure, bookkeeper, debug=debug,log=log, wordorder=wordorder)
                     else:
                         html = None
+                    annotations = getannotations(element.doc,structure,debug=debug,log=log, wordorder=wordorder)
                     response['elements'].append({
                         'elementid': element.id if element.id else None,
                         'html': html,
                         'structure': structure,
-                        'annotations': getannotations(element.doc,structure,debug=debug,log=log),
+                        'annotations': annotations,
                     })
+                    if bookkeeper.stop:
+                        remainder = getremainder(bookkeeper.stopat, element)
             if bookkeeper.stop:
+                if remainder is not None:
+                    remainder += list(queryresults[i+1:])
+                    for laterresults in results[g+1:]:
+                        remainder += list(laterresults)
                 break
         if bookkeeper.elementcount > ELEMENTMEMORYLIMIT:
             raise Exception("Memory limit reached, aborting")
 
     response['aborted'] = bookkeeper.stop
+    if 'cursor' in kwargs and kwargs['cursor']:
+        response['cursor'] = kwargs['cursor'] #server-side result cursor, pages can be obtained without re-running the query
+    if 'customslices' in kwargs and kwargs['customslices'] is not None:
+        response['customslices'] = kwargs['customslices'] #slices of the full result set rather than of this page
+    if remainder and 'continuation' in kwargs and kwargs['continuation']:
+        #the continuation function stores the remainder and returns a token the client can use to resume rendering
+        response['continuation'] = kwargs['continuation'](remainder)
     if 'lastaccess' in kwargs:
         response['sessions'] =  len([s for s in kwargs['lastaccess'] if s != 'NOSID' ])
+    if 'docversion' in kwargs and kwargs['docversion'] is not None:
+        response['docversion'] = kwargs['docversion'] #version of the document this response reflects, for syncing later changes (poll with since)
+
+    out = dumps(response)
+    if prefragments:
+        #splice the pre-encoded blocks into the encoded response (which always has at least the version key)
+        out = out[:-1] + b"".join( b",\"" + name.encode('utf-8') + b"\":" + fragment for name, fragment in prefragments.items() ) + b"}"
+    return out
+
+def parsedelta(changes, doc, **kwargs):
+    """Renders what changed in an edit (as recorded by getchanges()) compactly, for delta polls. Structure elements that
+    changed are rendered like parseresults() does; for token annotations that changed on their own only those annotations
+    are rendered (and the links of their structure element), not the structure element itself.
+
+    Returns JSON with the following keys (besides version, sessions and aborted):
+        * elements: list of {elementid, html, structure} for structure elements that changed (their annotations are
+          included in annotations)
+        * annotations: extended ID => annotation, for annotations that were added or changed
+        * links: structure element ID => extended IDs of the annotations linked to it, for structure elements whose
+          annotations changed (but that were not rendered themselves)
+        * removed: extended IDs of annotations that no longer exist
+        * removedelements: IDs of structure elements that no longer exist
+    """
+    if 'debug' in kwargs and kwargs['debug']:
+        debug = True
+    else:
+        debug = False
+    if 'logfunction' in kwargs and kwargs['logfunction']:
+        log = kwargs['logfunction']
+    else:
+        log = lambda s: print(s,file=sys.stderr)
+    if 'wordorder' in kwargs:
+        wordorder = kwargs['wordorder']
+    else:
+        wordorder = None
+
+    elementids = sorted( change for change in changes if not isinstance(change, tuple) )
+    owners = {} #structure element ID => extended IDs of changed annotations
+    for change in changes:
+        if isinstance(change, tuple) and change[0] not in elementids:
+            owners.setdefault(change[0], set()).add(change[1])
+
+    response = {'version': kwargs['version'], 'delta': True, 'elements': [], 'annotations': {}, 'links': {}, 'removed': [], 'removedelements': []}
+    bookkeeper = Bookkeeper()
+    for id in elementids:
+        if id not in doc:
+            response['removedelements'].append(id)
+            continue
+        if bookkeeper.stop:
+            break
+        element = doc[id]
+        structure = {}
+        if isinstance(element, (folia.AbstractStructureElement, folia.Correction)):
+            html, _ = getstructure(element, structure, bookkeeper, debug=debug,log=log, wordorder=wordorder)
+        else:
+            html = None
+        response['annotations'].update(getannotations(element.doc,structure,debug=debug,log=log, wordorder=wordorder))
+        response['elements'].append({'elementid': id, 'html': html, 'structure': structure})
+        if bookkeeper.elementcount > ELEMENTMEMORYLIMIT:
+            raise Exception("Memory limit reached, aborting")
+    for ownerid, extids in sorted(owners.items()):
+        if ownerid not in doc:
+            response['removed'] += sorted(extids)
+            continue
+        structure = {ownerid: {'annotations': []}} #only collects the links
+        annotations = {}
+        getannotations_in(doc[ownerid], structure, annotations, debug=debug,log=log, wordorder=wordorder)
+        response['links'][ownerid] = structure[ownerid]['annotations']
+        for extid in sorted(extids):
+            if extid in annotations:
+                response['annotations'][extid] = annotations[extid]
+            else:
+                response['removed'].append(extid)
 
-    return json.dumps(response).encode('utf-8')
+    response['aborted'] = bookkeeper.stop
+    if 'lastaccess' in kwargs:
+        response['sessions'] =  len([s for s in kwargs['lastaccess'] if s != 'NOSID' ])
+    if 'docversion' in kwargs and kwargs['docversion'] is not None:
+        response['docversion'] = kwargs['docversion'] #version of the document this response reflects, for syncing later changes (poll with since)
+    return dumps(response)
+
+def getchanges(results, query=None):
+    """Returns what changed in an edit, given the results of the query: a set of IDs of structure elements that have to be
+    rendered anew, and of (structure element ID, extended ID) tuples for token annotations that changed on their own. For
+    results that are structure elements (e.g. with RETURN target), the elements touched by the query (see fql.Query._touch)
+    are looked up inside them"""
+    changes = set()
+    for result in results:
+        for element in (result if isinstance(result, fql.SpanSet) else (result,)):
+            if not isinstance(element, folia.AbstractElement):
+                continue
+            change = getannotationchange(element)
+            if change is not None:
+                changes.add(change)
+                continue
+            if query is not None and isinstance(element, folia.AbstractStructureElement) and element.id and getattr(element, 'changedbyquery', None) is not query:
+                touched = list(gettouched(element, query))
+                touchedchanges = [ getannotationchange(e) for e in touched ]
+                if touched and all(touchedchanges):
+                    changes.update(touchedchanges)
+                    continue
+            #anything else: render the nearest structure element with an ID
+            while isinstance(element, folia.AbstractElement) and not (isinstance(element, folia.AbstractStructureElement) and element.id):
+                element = element.parent
+            if isinstance(element, folia.AbstractElement):
+                changes.add(element.id)
+    return changes
+
+def getannotationchange(element):
+    """Returns (structure element ID, extended ID) if the element is (part of) a token annotation directly on a structure
+    element, None otherwise"""
+    while isinstance(element, folia.Feature):
+        element = element.parent
+    if isinstance(element, folia.AbstractInlineAnnotation) and isinstance(element.parent, folia.AbstractStructureElement) and element.parent.id:
+        return (element.parent.id, element.id if element.id else getextid(element, element.parent.id))
+    return None
+
+def gettouched(element, query):
+    """Yields the outermost elements under the element that were added or edited by the query"""
+    for child in element.data:
+        if isinstance(child, folia.AbstractElement):
+            if getattr(child, 'changedbyquery', None) is query:
+                yield child
+            else:
+                yield from gettouched(child, query)
+
+def getextid(element, prefix):
+    """Returns the extended ID of an annotation without an ID of its own"""
+    extid = prefix + '/' + element.XMLTAG
+    if isinstance(element, (folia.TextContent, folia.PhonContent)):
+        return extid + '/' + element.cls
+    elif element.set:
+        return extid + '/' + element.set
+    return extid + '/null'
+
+def getfragment(fragments, name, function):
+    """Returns a JSON-encoded block from the fragment cache, computing it with the function if it is missing. The cache belongs
+    to a single version of the document, the document store starts a new one after every edit (see DocStore.getfragments)"""
+    if name not in fragments:
+        fragments[name] = dumps(function())
+    return fragments[name]
 
 def gethtmltext(element, textclass="current"):
     """Get the text of an element, but maintain markup elements and convert them to HTML"""
@@ -294,6 +470,40 @@ class Bookkeeper:
         self.stop = False
         return self
 
+def countelements(results, limit):
+    """Counts the structure elements in (and beneath) query results, as an estimate of the rendering effort. Stops counting at the limit"""
+    count = 0
+    for queryresults in results:
+        for result in queryresults:
+            for element in (result if isinstance(result, fql.SpanSet) else (result,)):
+                count += 1
+                if isinstance(element, folia.AbstractElement):
+                    for _ in element.select(folia.AbstractStructureElement):
+                        count += 1
+                        if count >= limit:
+                            return count
+                if count >= limit:
+                    return count
+    return count
+
+def getremainder(element, top):
+    """Returns the element at which rendering stopped along with all structure elements that follow it in document order,
+    up to the end of the top element (the result being rendered). Rendering these continues exactly where it stopped."""
+    remainder = [element]
+    while element is not top and element.parent is not None:
+        parent = element.parent
+        following = False
+        for sibling in parent:
+            if sibling is element:
+                following = True
+            elif following:
+                if isinstance(sibling, (folia.AbstractStructureElement, folia.Correction)):
+                    remainder.append(sibling)
+                elif isinstance(sibling, (folia.MorphologyLayer, folia.PhonologyLayer)):
+                    remainder += [ child for child in sibling if isinstance(child, folia.AbstractStructureElement) ]
+        element = parent
+    return remainder
+
 def generate_id(element):
     candidateid = ":" #dummy
     while candidateid[0] == ':' or candidateid in element.doc:
@@ -302,7 +512,142 @@ def generate_id(element):
     element.doc.index[element.id] = element
     return element.id
 
-def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,log=lambda s: print(s,file=sys.stderr)):
+class WordOrder:
+    """Token order of a document: all authoritative words and hidden words in document order, grouped per structural
+    container (usually a sentence), with ID => position maps so neighbouring words are found in constant time rather than
+    by walking the tree. Built once per document and updated incrementally after structural edits (see update())"""
+
+    TOKENS = (folia.Word, folia.Hiddenword)
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.lock = threading.RLock() #the token order is shared by all requests reading the document, lookups may update it
+        self.rebuild()
+
+    def rebuild(self):
+        """Builds the token order from scratch"""
+        with self.lock:
+            self.containers = [] #container keys in document order
+            self.containerposition = {} #container key => index in self.containers
+            self.tokens = {} #container key => [token]
+            self.position = {} #token ID => (container key, index in self.tokens[container key])
+            self.segmented = set() #IDs of containers whose tokens are not contiguous (interrupted by another container), these always trigger a full rebuild
+            for root in self.doc.data:
+                for token in root.select(self.TOKENS, ignore=[True, folia.AbstractAnnotationLayer]):
+                    container = self.getcontainer(token)
+                    if not self.containers or self.containers[-1] != container.id:
+                        if container.id in self.containerposition:
+                            #container is interrupted by another one (mixed content), give this segment a key of its own
+                            self.segmented.add(container.id)
+                            key = container.id + "#" + str(len(self.containers))
+                        else:
+                            key = container.id
+                        self.containerposition[key] = len(self.containers)
+                        self.containers.append(key)
+                        self.tokens[key] = []
+                    key = self.containers[-1]
+                    if token.id:
+                        self.position[token.id] = (key, len(self.tokens[key]))
+                    self.tokens[key].append(token)
+
+    def getcontainer(self, element):
+        """Returns the nearest structural ancestor of the element that is not a token itself"""
+        container = element.parent
+        while container is not None and (not isinstance(container, folia.AbstractStructureElement) or isinstance(container, self.TOKENS)):
+            container = container.parent
+        if container is None:
+            return self.doc.data[0]
+        if not container.id:
+            generate_id(container)
+        return container
+
+    def refresh(self, key):
+        """Recomputes the tokens of a single container"""
+        with self.lock:
+            if key not in self.containerposition or key in self.segmented:
+                self.rebuild()
+                return
+            for token in self.tokens[key]:
+                if token.id and token.id in self.position and self.position[token.id][0] == key:
+                    del self.position[token.id]
+            container = self.doc.index.get(key)
+            if container is None or (container.parent is None and container is not self.doc.data[0]):
+                self.tokens[key] = [] #container was deleted, lookups skip empty containers
+                return
+            self.tokens[key] = [ token for token in container.select(self.TOKENS, ignore=[True, folia.AbstractAnnotationLayer]) if self.getcontainer(token) is container ]
+            for i, token in enumerate(self.tokens[key]):
+                if token.id:
+                    self.position[token.id] = (key, i)
+
+    def update(self, elements):
+        """Updates the token order after a structural edit (insertion, deletion, split, merge), given the elements returned by the query"""
+        with self.lock:
+            keys = set()
+            for element in elements:
+                if isinstance(element, fql.SpanSet):
+                    self.update(element)
+                    continue
+                if not isinstance(element, (folia.AbstractStructureElement, folia.Correction)):
+                    continue
+                if element.id and element.id in self.position:
+                    keys.add(self.position[element.id][0]) #where it was
+                if element.id and element.id in self.containerposition:
+                    keys.add(element.id) #edit of a container as a whole
+                elif isinstance(element, (folia.Correction,) + self.TOKENS) and (element.parent is not None):
+                    keys.add(self.getcontainer(element).id) #where it is now
+                elif element.parent is not None and any(True for _ in element.select(self.TOKENS, ignore=[True, folia.AbstractAnnotationLayer])):
+                    #a new container holding tokens, the order of containers changed
+                    self.rebuild()
+                    return
+            for key in keys:
+                self.refresh(key)
+
+    def locate(self, token):
+        """Returns the (container key, index) of the token, updating the token order if it is not (correctly) present"""
+        if token.id in self.position:
+            key, i = self.position[token.id]
+            if self.tokens[key][i] is token:
+                return key, i
+        self.update([token])
+        if token.id in self.position:
+            key, i = self.position[token.id]
+            if self.tokens[key][i] is token:
+                return key, i
+        self.rebuild()
+        return self.position.get(token.id, (None, None))
+
+    def neighbour(self, token, offset, retry=True):
+        with self.lock:
+            key, i = self.locate(token)
+            if key is None:
+                return None
+            neighbour = None
+            if 0 <= i + offset < len(self.tokens[key]):
+                neighbour = self.tokens[key][i + offset]
+            else:
+                c = self.containerposition[key] + offset
+                while 0 <= c < len(self.containers):
+                    tokens = self.tokens[self.containers[c]]
+                    if tokens:
+                        neighbour = tokens[-1] if offset < 0 else tokens[0]
+                        break
+                    c += offset
+            if neighbour is not None and retry and (neighbour.parent is None or (neighbour.id and neighbour.id not in self.doc.index)):
+                #neighbour was removed by an edit we were not told about
+                self.rebuild()
+                return self.neighbour(token, offset, False)
+            return neighbour
+
+    def previous(self, token):
+        """Returns the previous word (or hidden word) in the document, or None"""
+        return self.neighbour(token, -1)
+
+    def next(self, token):
+        """Returns the next word (or hidden word) in the document, or None"""
+        return self.neighbour(token, 1)
+
+
+def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,log=lambda s: print(s,file=sys.stderr), wordorder=None):
     """Converts the element to html skeleton and structure datamodel
 
     HTML is returned, structure is appended to dictionary
@@ -329,7 +674,7 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
                 try:
                     for child in element.new():
                         if isinstance(child, folia.AbstractStructureElement) or isinstance(child, folia.Correction):
-                            subhtml, _ = getstructure(child, structure, bookkeeper, incorrection=element.id, debug=debug,log=log)
+                            subhtml, _ = getstructure(child, structure, bookkeeper, incorrection=element.id, debug=debug,log=log, wordorder=wordorder)
                             html += subhtml
                 except folia.NoSuchAnnotation:
                     pass
@@ -337,7 +682,7 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
                 try:
                     for child in element.current():
                         if isinstance(child, folia.AbstractStructureElement) or isinstance(child, folia.Correction):
-                            subhtml, _ = getstructure(child, structure, bookkeeper, incorrection=element.id, debug=debug,log=log)
+                            subhtml, _ = getstructure(child, structure, bookkeeper, incorrection=element.id, debug=debug,log=log, wordorder=wordorder)
                             html += subhtml
                 except folia.NoSuchAnnotation:
                     pass
@@ -346,7 +691,7 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
                 try:
                     for child in element.original():
                         if isinstance(child, folia.AbstractStructureElement) or isinstance(child, folia.Correction):
-                            getstructure(child, structure, None, incorrection=element.id, debug=debug,log=log)
+                            getstructure(child, structure, None, incorrection=element.id, debug=debug,log=log, wordorder=wordorder)
                 except folia.NoSuchAnnotation:
                     pass
 
@@ -355,7 +700,7 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
                     try:
                         for child in suggestion:
                             if isinstance(child, folia.AbstractStructureElement) or isinstance(child, folia.Correction):
-                                getstructure(child, structure, None, incorrection=element.id, debug=debug,log=log)
+                                getstructure(child, structure, None, incorrection=element.id, debug=debug,log=log, wordorder=wordorder)
                     except folia.NoSuchAnnotation:
                         pass
 
@@ -367,13 +712,13 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
             for child in element:
                 if isinstance(child, (folia.AbstractStructureElement, folia.Correction)):
                     if bookkeeper and not bookkeeper.stop:
-                        subhtml, newsubids  = getstructure(child, structure, bookkeeper, debug=debug,log=log)
+                        subhtml, newsubids  = getstructure(child, structure, bookkeeper, debug=debug,log=log, wordorder=wordorder)
                         if subhtml: html += subhtml
                         subids += newsubids
                 elif isinstance(child, folia.MorphologyLayer) or isinstance(child, folia.PhonologyLayer):
                     for subchild in child:
                         if bookkeeper and not bookkeeper.stop:
-                            _, newsubids  = getstructure(subchild, structure, bookkeeper, debug=debug,log=log)
+                            _, newsubids  = getstructure(subchild, structure, bookkeeper, debug=debug,log=log, wordorder=wordorder)
                             #ignoring html
                             subids += newsubids
 
@@ -439,12 +784,18 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
             if incorrection:
                 structure[element.id]['incorrection'] = incorrection
             if isinstance(element, (folia.Word, folia.Hiddenword)):
-                prevword = element.previous((folia.Word, folia.Hiddenword),None)
+                if wordorder is not None:
+                    prevword = wordorder.previous(element)
+                else:
+                    prevword = element.previous((folia.Word, folia.Hiddenword),None)
                 if prevword:
                     structure[element.id]['previousword'] =  prevword.id
                 else:
                     structure[element.id]['previousword'] = None
-                nextword = element.next((folia.Word, folia.Hiddenword),None )
+                if wordorder is not None:
+                    nextword = wordorder.next(element)
+                else:
+                    nextword = element.next((folia.Word, folia.Hiddenword),None )
                 if nextword:
                     structure[element.id]['nextword'] =  nextword.id
                 else:
@@ -459,13 +810,13 @@ def getstructure(element, structure, bookkeeper, incorrection=None, debug=False,
     raise Exception("Structure element expected, got " + str(type(element)))
 
 
-def getannotations(doc, structure, annotations = None,debug=False,log=lambda s: print(s,file=sys.stderr)):
+def getannotations(doc, structure, annotations = None,debug=False,log=lambda s: print(s,file=sys.stderr), wordorder=None):
     if not annotations: annotations = {}
     processed = set() #processed elements
     for id in structure:
         e = doc[id]
         processed.add(id)
-        getannotations_in(e, structure, annotations, debug=debug,log=log)
+        getannotations_in(e, structure, annotations, debug=debug,log=log, wordorder=wordorder)
         if isinstance(e, (folia.Word, folia.Hiddenword)) and e.parent:
             p = e.parent
             while p is not None:
@@ -474,12 +825,12 @@ def getannotations(doc, structure, annotations = None,debug=False,log=lambda s:
                     #do we have span annotations?
                     if p.hasannotationlayer():
                         #yes, process them
-                        getannotations_in(p, structure, annotations, debug=debug,log=log, spanonly=True)
+                        getannotations_in(p, structure, annotations, debug=debug,log=log, spanonly=True, wordorder=wordorder)
                 p = p.parent
 
     return annotations
 
-def getannotations_in(parentelement, structure, annotations, incorrection=None, inalternative=None,auth=True, debug=False,log=lambda s: print(s,file=sys.stderr),idprefix=None, spanonly=False):
+def getannotations_in(parentelement, structure, annotations, incorrection=None, inalternative=None,auth=True, debug=False,log=lambda s: print(s,file=sys.stderr),idprefix=None, spanonly=False, wordorder=None):
     """Get annotations in the specified parentelement and add them to the annotations dictionary (passed as argument).
     Structure dictionary is also passed and references for all found annotations are made."""
 
@@ -524,19 +875,13 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
             extid = element.id
         else:
             if idprefix:
-                extid = idprefix + '/' + element.XMLTAG
+                extid = getextid(element, idprefix)
             elif incorrection:
-                extid = incorrection + '/' + element.XMLTAG
+                extid = getextid(element, incorrection)
             elif inalternative:
-                extid = inalternative + '/' + element.XMLTAG
+                extid = getextid(element, inalternative)
             else:
-                extid = structureelement.id + '/' + element.XMLTAG
-            if isinstance(element, (folia.TextContent, folia.PhonContent)):
-                extid += '/' + element.cls
-            elif element.set:
-                extid += '/' + element.set
-            else:
-                extid += '/null'
+                extid = getextid(element, structureelement.id)
 
         if debug:
             log("Processing annotation " + element.XMLTAG + " in " + parentelement.XMLTAG + "; extended ID " + extid)
@@ -544,7 +889,7 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
         processed = False
         if isinstance(element, folia.Correction):
             processed = True
-            getannotations_correction(element,structure,annotations, auth=auth, log=log,debug=debug)
+            getannotations_correction(element,structure,annotations, auth=auth, log=log,debug=debug, wordorder=wordorder)
             if auth and structureelement.id in structure:
                 structure[structureelement.id]['annotations'].append(extid) #link structure to annotations
         elif isinstance(element, folia.Alternative):
@@ -553,7 +898,7 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
             annotations[extid]['targets'] = [ structureelement.id ]
             annotations[extid]['scope'] = [ structureelement.id ]
             annotations[extid]['children'] = {} #reset, prevent duplication, annotations are gather under 'annotations' instead by the next line:
-            subids = getannotations_in(element,structure,annotations, inalternative=element.id, auth=False,debug=debug,log=log,idprefix=element.id)
+            subids = getannotations_in(element,structure,annotations, inalternative=element.id, auth=False,debug=debug,log=log,idprefix=element.id, wordorder=wordorder)
             annotations[extid]['annotations'] = subids
             if auth and structureelement.id in structure:
                 structure[structureelement.id]['annotations'].append(extid) #link structure to annotations
@@ -646,7 +991,7 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
 
         if isinstance(element, ( folia.AbstractAnnotationLayer, folia.AbstractSpanAnnotation, folia.Suggestion, folia.String)):
             #descend into nested annotations
-            subidlist = getannotations_in(element,structure, annotations,debug=debug,log=log)
+            subidlist = getannotations_in(element,structure, annotations,debug=debug,log=log, wordorder=wordorder)
 
             if processed:
                 annotations[extid]['annotations'] = subidlist
@@ -658,7 +1003,7 @@ def getannotations_in(parentelement, structure, annotations, incorrection=None,
 
     return idlist
 
-def getannotations_correction(element, structure, annotations, debug=False,log=lambda s: print(s,file=sys.stderr), auth=True):
+def getannotations_correction(element, structure, annotations, debug=False,log=lambda s: print(s,file=sys.stderr), auth=True, wordorder=None):
     correction_new = []
     correction_current = []
     correction_original = []
@@ -689,7 +1034,7 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
             pass
 
     if element.hasnew():
-        subids = getannotations_in(element.new(),structure,annotations, incorrection=element.id,auth=auth,debug=debug,log=log,idprefix=element.id + '/new')
+        subids = getannotations_in(element.new(),structure,annotations, incorrection=element.id,auth=auth,debug=debug,log=log,idprefix=element.id + '/new', wordorder=wordorder)
         if correction_structure:
             for child in element.new():
                 if isinstance(child,folia.AbstractStructureElement):
@@ -701,7 +1046,7 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
         #empty new, this is deletion
         correction_special_type = 'deletion'
     if element.hascurrent():
-        subids = getannotations_in(element.current(),structure,annotations, incorrection=element.id,auth=auth,debug=debug,log=log,idprefix=element.id + '/current')
+        subids = getannotations_in(element.current(),structure,annotations, incorrection=element.id,auth=auth,debug=debug,log=log,idprefix=element.id + '/current', wordorder=wordorder)
         try:
             if correction_structure:
                 for child in element.current():
@@ -713,7 +1058,7 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
         except folia.NoSuchAnnotation:
             pass
     if element.hasoriginal():
-        subids = getannotations_in(element.original(),structure,annotations, incorrection=element.id, auth=False,debug=debug,log=log,idprefix=element.id + '/original')
+        subids = getannotations_in(element.original(),structure,annotations, incorrection=element.id, auth=False,debug=debug,log=log,idprefix=element.id + '/original', wordorder=wordorder)
         if correction_structure:
             for child in element.original():
                 if isinstance(child,folia.AbstractStructureElement):
@@ -737,7 +1082,7 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
             if suggestion.split:
                 correction_split = suggestion.split.split(' ')
 
-            subids = getannotations_in(suggestion,structure,annotations, incorrection=element.id, auth=False,debug=debug,log=log,idprefix=element.id+'/suggestion.' + str(i+1))
+            subids = getannotations_in(suggestion,structure,annotations, incorrection=element.id, auth=False,debug=debug,log=log,idprefix=element.id+'/suggestion.' + str(i+1), wordorder=wordorder)
             if correction_structure:
                 subids = []
                 for child in suggestion:
@@ -768,23 +1113,43 @@ def getannotations_correction(element, structure, annotations, debug=False,log=l
             annotations[element.id]['suggestmerge'] = correction_merge
 
     annotations[element.id]['previous'] = None
-    try:
-        previous = element.previous(None,None)
-        if isinstance(previous, folia.Correction): previous = next(previous.select(folia.AbstractStructureElement))
-        if previous: annotations[element.id]['previous'] =  previous.id
-    except StopIteration:
-        pass
     annotations[element.id]['next'] = None
-    try:
-        successor = element.next(None,None )
-        if isinstance(successor, folia.Correction): successor = next(successor.select(folia.AbstractStructureElement))
-        if successor: annotations[element.id]['next'] =  successor.id
-    except StopIteration:
-        pass
+    tokens = list(element.select(WordOrder.TOKENS, ignore=[True, folia.AbstractAnnotationLayer])) if wordorder is not None and correction_structure else None
+    if tokens:
+        #structural correction, neighbours are looked up in the token order
+        previous = wordorder.previous(tokens[0])
+        if previous: annotations[element.id]['previous'] = getcorrectedtoken(previous, element).id
+        successor = wordorder.next(tokens[-1])
+        if successor: annotations[element.id]['next'] = getcorrectedtoken(successor, element).id
+    else:
+        try:
+            previous = element.previous(None,None)
+            if isinstance(previous, folia.Correction): previous = next(previous.select(folia.AbstractStructureElement))
+            if previous: annotations[element.id]['previous'] =  previous.id
+        except StopIteration:
+            pass
+        try:
+            successor = element.next(None,None )
+            if isinstance(successor, folia.Correction): successor = next(successor.select(folia.AbstractStructureElement))
+            if successor: annotations[element.id]['next'] =  successor.id
+        except StopIteration:
+            pass
     p = element.ancestor(folia.AbstractStructureElement)
     annotations[element.id]['targets'] = [ p.id ]
     annotations[element.id]['scope'] = [ p.id ]
 
+def getcorrectedtoken(token, correction):
+    """If the token is part of another (structural) correction, returns the first structure element of that correction instead"""
+    e = token.parent
+    while e is not None and not isinstance(e, folia.AbstractStructureElement):
+        if isinstance(e, folia.Correction) and e is not correction:
+            try:
+                return next(e.select(folia.AbstractStructureElement))
+            except StopIteration:
+                break
+        e = e.parent
+    return token
+
 def getdeclarations(doc):
     """resolve annotation type and return the XML tag that is primary for it"""
     for annotationtype, annotationset in doc.annotations:
@@ -811,7 +1176,10 @@ def getsetdefinitions(doc):
     setdefs = {}
     for annotationtype, set in doc.annotations:
         if set in doc.setdefinitions:
-            setdefs[set] = doc.setdefinitions[set].json()
+            if isinstance(doc.setdefinitions, SetDefinitionCache):
+                setdefs[set] = doc.setdefinitions.json(set) #precomputed
+            else:
+                setdefs[set] = doc.setdefinitions[set].json()
     return setdefs
 
 def getmetadata(doc):
@@ -28,19 +28,36 @@ import subprocess
 import sys
 import traceback
 import threading
-import datetime
 import shutil
 import queue
 import re
-from collections import defaultdict
+import hashlib
+import zlib
+import base64
+import random
+import copy
+import heapq
+import itertools
+import tempfile
+import tarfile
+import zipfile
+import concurrent.futures
+from collections import defaultdict, deque, OrderedDict
 from socket import getfqdn
 import cherrypy
 from jinja2 import Environment, FileSystemLoader
 from folia import fql
 import folia.main as folia
 from pynlpl.formats import cql
-from foliadocserve.flat import parseresults, getflatargs
+from foliadocserve.flat import parseresults, parsedelta, getchanges, getflatargs, countelements, WordOrder, CUSTOMSLICESIZE
+from foliadocserve.jsonencoding import dumps, setencoder, getencoder, ENCODERS
+from foliadocserve.setdefinitions import SetDefinitionCache
+from foliadocserve.planner import Planner, IdQuery
+from foliadocserve.tokentable import TokenTable, getlayers, exporttables, LAYERS
+from foliadocserve.logger import Logger, LEVELS, DEBUG, INFO, WARNING, ERROR
+from foliadocserve.prerender import PRERENDEREXTENSION, getprerenderdir, getstamp, getrenderrequests, getprobeargs, writeprerendered, findprerendered, removeprerendered
 from foliadocserve.test import test
+from foliadocserve.compression import getcompression, getextension, getextensions, isfoliafile, stripextension, checkcompression, readfile, writefile, decompress, savedocument, serialise, COMPRESSIONS, zstandard
 from foliatools.foliatextcontent import cleanredundancy
 from foliatools.foliaupgrade import upgrade
 from foliatools import VERSION as FOLIATOOLSVERSION
@@ -53,38 +70,36 @@ def fake_wait_for_occupied_port(host, port): return
 class NoSuchDocument(Exception):
     pass
 
+class Overloaded(Exception):
+    pass
+
 
 VERSION = "0.7.4"
+MAXCONTINUATIONS = 256 #maximum number of continuation tokens (for FLAT results truncated at ELEMENTLIMIT) that are held at once
+MAXCOPYATTEMPTS = 3 #number of times a writer tries to copy a document that is being read (see DocStore.detach) before giving up
 PROCESSOR_FOLIADOCSERVE = "PROCESSOR name \"foliadocserve\" version \"" + VERSION + "\" host \"" +getfqdn() + "\" folia_version \"" + folia.FOLIAVERSION + "\" src \"https://github.com/proycon/foliadocserve\""
 
-logfile = None
-def log(msg):
-    if logfile:
-        logfile.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " - " +  msg+"\n")
-        logfile.flush()
+logger = None #Logger, see logger.py
+def log(msg, level=INFO, **fields):
+    """Logs a message (asynchronously), fields such as sid, docsel and duration are appended as key=value pairs"""
+    if logger:
+        logger.log(msg, level, **fields)
+
+def logtraceback(exc_traceback):
+    log("Traceback (most recent call last):\n" + "".join(traceback.format_tb(exc_traceback, limit=50)).rstrip(), ERROR)
+
 
+GITLOGFORMAT = "--format=%H%x1f%ad%x1f%B%x1e" #machine-readable git log output: fields separated by 0x1f, commits by 0x1e
 
 def parsegitlog(data):
-    commit = None
-    date = None
-    msg = None
-    for line in data.split("\n"):
-        line = line.strip()
-        if line[0:6] == 'commit':
-            #yield previous
-            if commit and date and msg:
-                yield commit, date, msg
-            commit = line[7:]
-            msg = None
-            date = None
-        elif line[0:7] == 'Author:':
-            pass
-        elif line[0:5] == 'Date:':
-            date = line[6:].strip()
-        elif line:
-            msg = line
-    if commit and date and msg:
-        yield commit, date, msg
+    """Parses git log output in GITLOGFORMAT, yields (commit, date, msg), where msg is the last line of the commit message"""
+    for record in data.split("\x1e"):
+        fields = record.strip("\n").split("\x1f")
+        if len(fields) == 3:
+            commit, date, body = fields
+            lines = [ line.strip() for line in body.split("\n") if line.strip() ]
+            if lines:
+                yield commit, date, lines[-1]
 
 
 
@@ -98,6 +113,78 @@ def cleantextredundancy(element):
                 for cls in element.doc.textclasses:
                     cleanredundancy(element, cls)
 
+CONTENTENCODINGS = ('zstd','gzip') if zstandard else ('gzip',) #supported HTTP content encodings, in order of preference
+CONTENTENCODING2COMPRESSION = {'gzip': 'gz', 'zstd': 'zst'} #maps HTTP content encodings to the compression methods for documents on disk
+
+def negotiateencoding():
+    """Returns the preferred content encoding that is accepted by the client (as per Accept-Encoding), or None"""
+    accepted = {}
+    for element in cherrypy.serving.request.headers.elements('Accept-Encoding'):
+        accepted[element.value.lower()] = element.qvalue
+    for encoding in CONTENTENCODINGS:
+        qvalue = accepted.get(encoding, accepted.get('x-' + encoding, accepted.get('*', 0)))
+        if qvalue > 0:
+            return encoding
+    return None
+
+def etagvariant(etag, encoding):
+    """Returns the (strong) etag for the encoded variant of a response"""
+    return etag[:-1] + "-" + encoding + "\""
+
+def checketag(etag):
+    """Sets the etag on the response and responds with 304 if the client already has it (regardless of content encoding)"""
+    cherrypy.response.headers['ETag'] = etag
+    if cherrypy.request.method in ('GET','HEAD'):
+        for element in cherrypy.request.headers.elements('If-None-Match'):
+            value = element.value
+            if value.startswith('W/'): value = value[2:] #weak comparison suffices for If-None-Match
+            if value == '*' or value == etag or any( value == etagvariant(etag, encoding) for encoding in CONTENTENCODINGS ):
+                raise cherrypy.HTTPRedirect([], 304)
+
+def compressbody(body, encoding, level):
+    """Generator compressing the (possibly streamed) response body"""
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16) #| 16 produces a gzip header and trailer
+    for chunk in body:
+        if isinstance(chunk, str): chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compressresponse(threshold=4096, level=6, mimetypes=('text/xml','application/json')):
+    """CherryPy tool (before_finalize) that compresses large XML and JSON responses using the content encoding negotiated with the client.
+    Smaller responses (below threshold bytes) are not worth the overhead and are sent as is. A level of 0 disables compression."""
+    response = cherrypy.serving.response
+    if level <= 0 or 'Content-Encoding' in response.headers or (response.status and not str(response.status).startswith('200')): #status is not set yet for regular responses
+        return
+    if response.headers.get('Content-Type','').split(';')[0] not in mimetypes:
+        return
+    response.headers['Vary'] = 'Accept-Encoding'
+    encoding = negotiateencoding()
+    if not encoding:
+        return
+    if 'Content-Length' in response.headers:
+        length = int(response.headers['Content-Length'])
+    elif not response.stream:
+        body = response.collapse_body()
+        response.body = body
+        length = len(body)
+    else:
+        length = None #streamed with unknown length, always compress
+    if length is not None and length < threshold:
+        return
+    response.headers['Content-Encoding'] = encoding
+    if 'ETag' in response.headers:
+        response.headers['ETag'] = etagvariant(response.headers['ETag'], encoding)
+    if 'Content-Length' in response.headers:
+        del response.headers['Content-Length']
+    response.body = compressbody(response.body, encoding, level)
+
+cherrypy.tools.compressresponse = cherrypy.Tool('before_finalize', compressresponse, priority=80)
+
 class BackgroundTaskQueue(cherrypy.process.plugins.SimplePlugin):
     """For background tasks that need not tie-up the request process"""
 
@@ -148,68 +235,217 @@ class BackgroundTaskQueue(cherrypy.process.plugins.SimplePlugin):
         self.q.put((func, args, kwargs))
 
 class AutoUnloader(cherrypy.process.plugins.SimplePlugin):
-    """Calls docstore.autounload() every tick"""
+    """Calls docstore.autounload() whenever a document is due to expire, and at least every interval"""
 
     thread = None
-    def __init__(self, bus, docstore, interval=60):
+    def __init__(self, bus, docstore, interval=60, deadline=None):
         self.docstore = docstore
         self.interval = interval
+        self.deadline = deadline #maximum time (in seconds) to spend saving documents when stopping
         self.safe_stop = True
+        self.running = False
         cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
 
     def start(self):
         self.running = True
         if not self.thread:
-            self.thread = threading.Thread(target=self.run)
+            self.thread = threading.Thread(target=self.run, name="autounloader")
             self.thread.start()
 
     def stop(self):
-        self.bus.log("Stopping AutoUnloader")
-        self.docstore.forceunload()
-        self.running = False
-
         if self.thread:
+            self.bus.log("Stopping AutoUnloader")
+            self.running = False
+            with self.docstore.expirycondition:
+                self.docstore.expirycondition.notify_all()
             self.thread.join()
             self.thread = None
+            self.docstore.forceunload(self.deadline)
 
     def run(self):
         while self.running:
+            log("Documents loaded: " + str(len(self.docstore)), DEBUG)
             self.docstore.autounload()
-            i = 0
-            while self.running and i < self.interval:
-                time.sleep(1)
-                i+=1
-
+            if self.running:
+                self.docstore.waitforexpiry(self.interval)
+
+
+
+def getmaxwaiting(args):
+    """Returns the maximum number of requests waiting for admission in total: the threads left over by the requests being processed"""
+    if args.maxconcurrent:
+        return args.threads - args.maxconcurrent
+    return args.maxqueue #unlimited concurrency, requests only wait for busy documents
+
+class AdmissionControl:
+    """Bounds the number of requests being processed concurrently. Requests that can not be processed immediately wait
+    in a bounded queue per document, and are admitted in round-robin fashion over the (user) namespaces so one heavy
+    user can not monopolize the server. Requests that are not admitted within the timeout are rejected. Waiting requests
+    occupy a worker thread, so the total number of waiting requests is bounded as well: together with the requests being
+    processed they must leave threads for other documents (and other requests)."""
+
+    def __init__(self, maxconcurrent=8, maxperdocument=4, maxqueue=4, timeout=10.0, maxwaiting=8):
+        self.maxconcurrent = maxconcurrent #maximum number of requests processed at the same time (0 = unlimited)
+        self.maxperdocument = maxperdocument #maximum number of requests processed at the same time for a single document (0 = unlimited)
+        self.maxqueue = maxqueue #maximum number of requests waiting for a single document
+        self.maxwaiting = maxwaiting #maximum number of requests waiting in total
+        self.timeout = timeout #maximum time (in seconds) a request waits for admission
+        self.condition = threading.Condition()
+        self.active = defaultdict(int) # (namespace,docid) => number of requests being processed
+        self.activecount = 0
+        self.queued = defaultdict(int) # (namespace,docid) => number of requests waiting
+        self.queuedcount = 0
+        self.waiting = defaultdict(deque) # user namespace => deque of (ticket, (namespace,docid)), in order of arrival
+        self.rotation = deque() #user namespaces with waiting requests, in round-robin order
+        self.admitted = 0
+        self.rejected = 0
+
+    def eligible(self, key):
+        return (not self.maxconcurrent or self.activecount < self.maxconcurrent) and (not self.maxperdocument or self.active[key] < self.maxperdocument)
+
+    def nextticket(self):
+        """Returns the (namespace, ticket) that is next in line to be admitted, or (None,None)"""
+        for namespace in self.rotation:
+            for ticket, key in self.waiting[namespace]:
+                if self.eligible(key):
+                    return namespace, ticket
+        return None, None
+
+    def dequeue(self, namespace, ticket, key, admitted):
+        self.waiting[namespace] = deque( x for x in self.waiting[namespace] if x[0] is not ticket )
+        self.rotation.remove(namespace)
+        if self.waiting[namespace]:
+            #admitted namespaces go to the back of the line, others retain their position
+            if admitted:
+                self.rotation.append(namespace)
+            else:
+                self.rotation.appendleft(namespace)
+        else:
+            del self.waiting[namespace]
+        self.queued[key] -= 1
+        self.queuedcount -= 1
+        if not self.queued[key]:
+            del self.queued[key]
+
+    def admit(self, key):
+        """Wait for admission of a request on the specified document, raises Overloaded if the request can not be admitted"""
+        namespace = key[0].split('/')[0]
+        with self.condition:
+            if self.eligible(key) and self.nextticket()[1] is None:
+                #nobody that could be admitted is waiting (requests waiting for a busy document do not hold up other documents)
+                self.start(key)
+                return
+            if self.queued[key] >= self.maxqueue:
+                self.rejected += 1
+                raise Overloaded("Too many requests waiting for " + "/".join(key))
+            if self.queuedcount >= self.maxwaiting:
+                self.rejected += 1
+                raise Overloaded("Too many requests waiting")
+            ticket = object()
+            self.waiting[namespace].append( (ticket, key) )
+            if namespace not in self.rotation:
+                self.rotation.append(namespace)
+            self.queued[key] += 1
+            self.queuedcount += 1
+            deadline = time.time() + self.timeout
+            while True:
+                if self.nextticket()[1] is ticket:
+                    self.dequeue(namespace, ticket, key, True)
+                    self.start(key)
+                    self.condition.notify_all() #the next in line may be eligible too
+                    return
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.dequeue(namespace, ticket, key, False)
+                    self.rejected += 1
+                    self.condition.notify_all()
+                    raise Overloaded("Timed out waiting for admission on " + "/".join(key))
+                self.condition.wait(remaining)
+
+    def start(self, key):
+        self.active[key] += 1
+        self.activecount += 1
+        self.admitted += 1
+
+    def release(self, key):
+        with self.condition:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+            self.activecount -= 1
+            self.condition.notify_all()
 
 
 class DocStore:
-    def __init__(self, workdir, expiretime, git=False, gitmode="user", gitshare=True, ignorefail=False, debug=False):
+    def __init__(self, workdir, expiretime, git=False, gitmode="user", gitshare=True, ignorefail=False, debug=False, compression=None, setdefinitions=None, cursorttl=900, maxcursorids=1000000, savethreads=4, historycachesize=1000, maxchanges=256, renderpool=None, renderthreshold=1000):
         log("Initialising document store in " + workdir)
         self.workdir = workdir
         self.expiretime = expiretime
         self.data = {}
-        self.updateq = defaultdict(lambda: defaultdict(set)) #update queue, (namespace,docid) => session_id => set(folia element id), for concurrency
+        self.updateq = defaultdict(lambda: defaultdict(set)) #update queue, (namespace,docid) => session_id => set(folia element id or (element id, annotation id), see flat.getchanges()), for concurrency
         self.lastaccess = defaultdict(dict) # (namespace,docid) => session_id => time
         self.changelog = defaultdict(list) # (namespace,docid) => [changemessage]
+        self.editcount = defaultdict(int) # (namespace,docid) => number of edits since the document was loaded
+        self.xmlcache = {} # (namespace,docid) => (stamp, etag, serialised xml as bytes)
+        self.fragments = {} # (namespace,docid) => (edit count, name => JSON-encoded block), used by flat.parseresults
+        self.wordorder = {} # (namespace,docid) => flat.WordOrder, built on first use
+        self.tokentables = {} # (namespace,docid) => tokentable.TokenTable, built on first use
+        self.continuations = {} # token => ((namespace,docid), editcount, [element], time), remainders of FLAT results truncated at ELEMENTLIMIT
+        self.cursors = OrderedDict() # cursor id => ((namespace,docid), session_id, query, editcount, [element id or tuple of ids for span sets], page size, last access time), least recently used first
+        self.cursorids = 0 #total number of ids held in all cursors
+        self.resultlock = threading.RLock() #guards the cursors and continuations, which are shared by the requests for all documents
+        self.cursorttl = cursorttl
+        self.maxcursorids = maxcursorids
         self.lastunloadcheck = time.time()
+        self.expiryschedule = [] #heap of (time, (namespace,docid)), the earliest time at which loaded documents may expire
+        self.expirycondition = threading.Condition() #guards expiryschedule, notified when it changes
+        self.savepool = concurrent.futures.ThreadPoolExecutor(max_workers=savethreads, thread_name_prefix="save") #saves and unloads documents in parallel
+        self.gitlocks = {} #git repository directory => threading.Lock, git operations on the same repository are serialised
+        self.versions = {} # (namespace,docid) => version, increases with every change (kept when the document is unloaded)
+        self.versioncounter = itertools.count(int(time.time() * 1000)) #versions are drawn from a single counter starting at the start time (in ms), so they keep increasing across restarts and replacements of documents
+        self.changes = {} # (namespace,docid) => deque of (version, frozenset of changes as returned by flat.getchanges() or None if unknown, metadata changed?), the most recent changes of a loaded document
+        self.changebase = {} # (namespace,docid) => the version before the oldest change in self.changes, the oldest version clients can sync from
+        self.maxchanges = maxchanges
+        self.history = OrderedDict() # (namespace,docid) => (git repository directory, [{commit, date, msg}]), parsed git history, least recently used first
+        self.historycachesize = historycachesize
+        self.renderpool = renderpool #concurrent.futures.ProcessPoolExecutor running renderdocument(), or None to render in-thread only
+        self.renderthreshold = renderthreshold #minimum number of structure elements in results for rendering to be done by the render pool
+        self.snapshotdir = tempfile.mkdtemp(prefix="foliadocserve-snapshots-") if renderpool is not None else None
+        self.snapshots = {} # (namespace,docid) => filename of the latest serialisation written for the render pool
 
         self.ignorefail = ignorefail
         self.fail = False
 
-        self.lock = set() #will contain (namespace,docid) of temporarily locked documents, loading/unloading/saving are blocking operations
-        self.setdefinitions = {}
+        self.lock = {} # (namespace,docid) => (thread id, depth) of temporarily locked documents, loading/unloading/saving/editing are blocking operations
+        self.lockcondition = threading.Condition() #guards self.lock, notified when a document is released
+        self.readers = {} # id(document) => number of requests reading the document object, see pin()
+        self.detached = {} # id(document) => (document, copy, deepcopy memo, size of the document's index when copied) for documents that were replaced by a copy while being read, see detach()
+        self.setdefinitions = setdefinitions if setdefinitions is not None else SetDefinitionCache(log=log) #shared by all documents
         self.git = git
         self.gitmode = gitmode
         self.gitshare = gitshare
         self.debug = debug
+        checkcompression(compression)
+        self.compression = compression #compression method for newly saved documents (None, gz, xz, zst)
         super().__init__()
 
     def getfilename(self, key):
+        """Returns the filename of the document, if the document does not exist yet, the filename is based on the default compression"""
         assert isinstance(key, tuple) and len(key) == 2
         if key[0] == "testflat":
             return syspath + '/testflat.folia.xml'
+        elif key in self.data and self.data[key].filename:
+            return self.data[key].filename
         else:
-            return self.workdir + '/' + key[0] + '/' + key[1] + '.folia.xml'
+            basename = self.getbasename(key)
+            for extension in getextensions():
+                if os.path.exists(basename + extension):
+                    return basename + extension
+            return basename + getextension(self.compression)
+
+    def getbasename(self, key):
+        """Returns the filename of the document without any extension"""
+        return self.workdir + '/' + key[0] + '/' + key[1]
 
     def getpath(self, key, useronly=False):
         assert isinstance(key, tuple) and len(key) == 2
@@ -220,20 +456,127 @@ class DocStore:
 
     def getkey(self, filename):
         """reverse of getfilename()"""
-        return tuple(filename.replace(self.workdir,'').strip('/').rsplit('/'),1)
+        return tuple(stripextension(filename.replace(self.workdir,'').strip('/')).rsplit('/',1))
 
 
 
     def use(self, key):
-        while key in self.lock:
-            if self.debug >= 2: log("[waiting for lock " + "/".join(key)+"]")
-            time.sleep(0.1)
-        self.lock.add(key)
+        """Locks the document, blocks while another thread holds it. The lock is reentrant, every use() needs a done()"""
+        me = threading.get_ident()
+        with self.lockcondition:
+            while key in self.lock and self.lock[key][0] != me:
+                if self.debug >= 2: log("[waiting for lock " + "/".join(key)+"]")
+                self.lockcondition.wait()
+            self.lock[key] = (me, self.lock[key][1] + 1 if key in self.lock else 1)
         if self.debug >= 2: log("[acquired lock " + "/".join(key)+"]")
 
     def done(self, key):
         if self.debug >= 2: log("[releasing lock " + "/".join(key)+"]")
-        self.lock.remove(key)
+        with self.lockcondition:
+            owner, depth = self.lock[key]
+            if depth > 1:
+                self.lock[key] = (owner, depth - 1)
+            else:
+                del self.lock[key]
+                self.lockcondition.notify_all()
+
+    def pin(self, key):
+        """Returns (document, version) of a loaded document for reading (searching, rendering, serialising). A pinned document
+        is never edited, writers edit a copy instead (see detach()). Waits for an edit in progress to finish. Every pin() needs an unpin()"""
+        if key[0] == "testflat":
+            return self[key], self.getversion(key)
+        me = threading.get_ident()
+        while True:
+            doc = self[key]
+            with self.lockcondition:
+                while key in self.lock and self.lock[key][0] != me:
+                    self.lockcondition.wait()
+                if self.data.get(key) is doc: #not unloaded or replaced in the meantime
+                    self.readers[id(doc)] = self.readers.get(id(doc), 0) + 1
+                    return doc, self.getversion(key)
+
+    def unpin(self, key, doc):
+        """Releases a document obtained with pin(). Rendering may have assigned identifiers to the document (FLAT needs them), if
+        it was replaced by a copy in the meantime these are carried over to the copy, as clients may refer to them"""
+        if key[0] == "testflat":
+            return
+        with self.lockcondition:
+            if self.readers[id(doc)] > 1 or id(doc) not in self.detached:
+                self.readers[id(doc)] -= 1
+                if not self.readers[id(doc)]:
+                    del self.readers[id(doc)]
+                return
+            indexsize = self.detached[id(doc)][3]
+        #last reader of a replaced document, no new readers can arrive
+        self.use(key)
+        try:
+            live = self.data.get(key)
+            if live is not None:
+                #readers only ever add to the index of a replaced document, so the identifiers they assigned after it was copied come last
+                newids = [ elementid for elementid in itertools.islice(doc.index, indexsize, None) if elementid not in live.index or live.index[elementid].id != elementid ]
+                if newids:
+                    live = self.detach(key) #assigning identifiers is an edit like any other
+                    carried = 0
+                    for elementid in newids:
+                        counterpart = self.getcounterpart(doc, doc.index[elementid])
+                        if counterpart is not None and counterpart.id in (None, elementid) and isattached(counterpart, live):
+                            counterpart.id = elementid
+                            live.index[elementid] = counterpart
+                            carried += 1
+                    if carried:
+                        log("Carried " + str(carried) + " identifier(s) assigned while reading over to the current copy of " + "/".join(key), DEBUG)
+        finally:
+            self.done(key)
+            with self.lockcondition:
+                del self.readers[id(doc)]
+                self.forgetdetached()
+
+    def detach(self, key):
+        """Called by writers holding the lock before they edit a document: if the document is pinned by readers, it is replaced by
+        a copy for the writer to edit (copy-on-write), so the readers keep the version they started on. Returns the document to edit"""
+        doc = self.data.get(key)
+        if doc is None or id(doc) not in self.readers:
+            return doc
+        for attempt in range(MAXCOPYATTEMPTS):
+            memo = {id(doc.setdefinitions): doc.setdefinitions} #shared by all documents and never edited
+            indexsize = len(doc.index)
+            try:
+                newdoc = copy.deepcopy(doc, memo)
+                break
+            except RecursionError:
+                raise
+            except RuntimeError:
+                if attempt == MAXCOPYATTEMPTS - 1:
+                    raise
+                #a reader assigned an identifier while we were copying, try again
+        with self.lockcondition:
+            self.data[key] = newdoc
+            self.detached[id(doc)] = (doc, newdoc, memo, indexsize)
+        if key in self.wordorder:
+            del self.wordorder[key]
+        if key in self.tokentables:
+            self.tokentables[key] = self.tokentables[key].copy(newdoc) #readers keep the old table
+        log("Document " + "/".join(key) + " is being read by " + str(self.readers.get(id(doc), 0)) + " request(s), editing a copy", DEBUG)
+        return newdoc
+
+    def getcounterpart(self, doc, element):
+        """Returns the counterpart of an element of a replaced document in the current copy, or None if it has none"""
+        while id(doc) in self.detached:
+            _, doc, memo, _ = self.detached[id(doc)]
+            element = memo.get(id(element))
+            if element is None:
+                return None
+        return element
+
+    def forgetdetached(self):
+        """Drops replaced documents that are no longer read, neither directly nor through an older copy. Call with lockcondition held"""
+        while True:
+            successors = set( id(newdoc) for _, newdoc, _, _ in self.detached.values() )
+            stale = [ docid for docid in self.detached if docid not in self.readers and docid not in successors ]
+            if not stale:
+                break
+            for docid in stale:
+                del self.detached[docid]
 
 
     def load(self,key, forcereload=False):
@@ -243,6 +586,7 @@ class DocStore:
         if time.time() - self.lastunloadcheck > 900: #no unload check for 15 mins? background thread seems to have crashed?
             self.fail = True #trigger lockdown
             self.forceunload() #force unload of everything
+            self.done(key)
             raise NoSuchDocument("Document Server is in lockdown due to loss of contact with autoupdater thread, refusing to process new documents...")
         if key not in self or forcereload:
             if not os.path.exists(filename):
@@ -250,57 +594,95 @@ class DocStore:
                 self.done(key)
                 raise NoSuchDocument
             if self.fail and not self.ignorefail:
+                self.done(key)
                 raise NoSuchDocument("Document Server is in lockdown due to earlier failure during XML serialisation, refusing to process new documents...")
             log("Loading " + filename)
-            mainprocessor = folia.Processor.create(name="foliadocserve", version=VERSION, host=getfqdn(), folia_version=folia.FOLIAVERSION, src="https://github.com/proycon/foliadocserve")
             try:
-                self.data[key] = folia.Document(file=filename, setdefinitions=self.setdefinitions, loadsetdefinitions=True,autodeclare=True,allowadhocsets=True,processor=mainprocessor)
-                if folia.checkversion(self.data[key].version, "2.0.0") < 0:
-                    log("Upgrading " + self.data[key].filename)
-                    upgrader = folia.Processor("foliaupgrade", version=FOLIATOOLSVERSION, src="https://github.com/proycon/foliatools")
-                    mainprocessor.append(upgrader)
-                    upgrade(self.data[key],upgrader)
-                self.data[key].changed = False #we do not count the above upgrade as a change yet (meaning it won't be saved unless an annotation is also added/edited)
+                if getcompression(filename):
+                    self.data[key] = self.parsedocument(filename, readfile(filename))
+                else:
+                    self.data[key] = self.parsedocument(filename)
+                if key in self.xmlcache:
+                    del self.xmlcache[key]
+                if key in self.fragments:
+                    del self.fragments[key]
+                if key in self.wordorder:
+                    del self.wordorder[key]
+                if key in self.tokentables:
+                    del self.tokentables[key]
+                self.scheduleexpiry(key, time.time() + self.expiretime)
             except Exception as e:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
-                log("ERROR reading file " + filename + ": " + str(e))
-                if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
+                log("Unable to read file " + filename + ": " + str(e), ERROR)
+                logtraceback(exc_traceback)
                 self.done(key)
                 raise
             self.lastaccess[key]['NOSID'] = time.time()
         self.done(key)
         return self.data[key]
 
-    def gitcommit(self, key, message="", remove=False):
+    def parsedocument(self, filename, data=None):
+        """Parses a document from file, or from the given (uncompressed) data, upgrading it to FoLiA v2 if needed"""
+        mainprocessor = folia.Processor.create(name="foliadocserve", version=VERSION, host=getfqdn(), folia_version=folia.FOLIAVERSION, src="https://github.com/proycon/foliadocserve")
+        if data is not None:
+            doc = folia.Document(string=data, setdefinitions=self.setdefinitions, loadsetdefinitions=True,autodeclare=True,allowadhocsets=True,processor=mainprocessor)
+            doc.filename = filename
+        else:
+            doc = folia.Document(file=filename, setdefinitions=self.setdefinitions, loadsetdefinitions=True,autodeclare=True,allowadhocsets=True,processor=mainprocessor)
+        if folia.checkversion(doc.version, "2.0.0") < 0:
+            log("Upgrading " + doc.filename)
+            upgrader = folia.Processor("foliaupgrade", version=FOLIATOOLSVERSION, src="https://github.com/proycon/foliatools")
+            mainprocessor.append(upgrader)
+            upgrade(doc,upgrader)
+        doc.changed = False #we do not count the above upgrade as a change yet (meaning it won't be saved unless an annotation is also added/edited)
+        return doc
+
+    def getgitpath(self, key):
+        """Returns the directory of the git repository the document belongs to (which need not exist yet)"""
+        if os.path.exists(self.workdir + '/.git') or self.gitmode == "monolithic":
+            # entire workdir is one git repo
+            return self.workdir
+        else:
+            return self.getpath(key, useronly=(self.gitmode == 'user'))
+
+    def getgitlock(self, targetdir):
+        """Returns the lock serialising git operations on the repository"""
+        return self.gitlocks.setdefault(targetdir, threading.Lock())
+
+    def getgitdir(self, key):
+        """Returns the directory of the git repository the document belongs to, initialising the repository if needed. Returns None on failure.
+        Call with the lock for the repository (getgitlock) held"""
+        targetdir = self.getgitpath(key)
+        if not os.path.exists(targetdir + '/.git'):
+            log("Initialising git repository in  " + targetdir)
+            r = subprocess.call(["git","init","--shared=" + self.gitshare], cwd=targetdir)
+            if r != 0:
+                log("Git init failed for " + targetdir, ERROR)
+                return None
+        return targetdir
+
+    def gitcommit(self, key, message="", remove=False, filename=None, replaces=None):
+        """Commit the document to git. If replaces is set, that (old) file is removed from the repository in the same commit"""
         if self.git:
-            doinit = False
-            if os.path.exists(self.workdir + '/.git'):
-                # entire workdir is one git repo (old style)
-                targetdir = self.workdir
-            elif self.gitmode == "monolithic":
-                doinit = True
-                targetdir = self.workdir
-            else:
-                targetdir = self.getpath(key, useronly=(self.gitmode == 'user'))
-                if not os.path.exists(targetdir + '/.git'):
-                    doinit = True
-            os.chdir(targetdir)
-            if doinit:
-                log("Initialising git repository in  " + targetdir)
-                r = os.system("git init --shared \"" + self.gitshare + "\"")
-                if r != 0:
-                    log("ERROR during git init of " + targetdir)
-                    self.done(key)
+            if filename is None:
+                filename = self.getfilename(key)
+            with self.getgitlock(self.getgitpath(key)):
+                targetdir = self.getgitdir(key)
+                if targetdir is None:
                     return
-            message = "\n".join(self.changelog[key]) + "\n" + message
-            self.changelog[key] = [] #reset changelog
-            message = message.strip("\n")
-            log("Doing git commit for " + self.getfilename(key) + " -- " + message.replace("\n", " -- "))
-            action = "rm" if remove else "add"
-            r = os.system("cd \"" + targetdir + "\" && git " + action + " \"" + self.getfilename(key) + "\" && git commit -m \"" + message.replace('"','') + "\"")
-            if r != 0:
-                log("ERROR during git " + action + "/commit of " + self.getfilename(key) + " in " + targetdir)
+                message = "\n".join(self.changelog[key]) + "\n" + message
+                self.changelog[key] = [] #reset changelog
+                message = message.strip("\n")
+                log("Doing git commit for " + filename + " -- " + message.replace("\n", " -- "))
+                action = "rm" if remove else "add"
+                cmd = "cd \"" + targetdir + "\" && "
+                if replaces:
+                    cmd += "git rm -q --cached --ignore-unmatch \"" + replaces + "\" && "
+                r = os.system(cmd + "git " + action + " \"" + filename + "\" && git commit -m \"" + message.replace('"','') + "\"")
+                self.invalidatehistory(targetdir)
+                if r != 0:
+                    log("Git " + action + "/commit failed for " + filename + " in " + targetdir, ERROR)
 
     def save(self, key, message = ""):
         doc = self[key]
@@ -310,31 +692,204 @@ class DocStore:
             return test(doc, key[1])
         elif hasattr(doc,'changed') and doc.changed:
             self.use(key)
-            log("Saving " + self.getfilename(key) + " - " + message)
-            dirname = os.path.dirname(self.getfilename(key))
+            filename = self.getfilename(key)
+            log("Saving " + filename + " - " + message)
+            dirname = os.path.dirname(filename)
             if not os.path.exists(dirname):
                 log("Directory does not exist yet, creating on the fly: " + dirname)
                 os.makedirs(dirname)
             try:
-                doc.save(self.getfilename(key) + '.tmp')
+                savedocument(doc, filename + '.tmp', getcompression(filename))
             except Exception as e:
                 self.fail = True
-                log("ERROR: Unable to save document " + self.getfilename(key) + ": [" + e.__class__.__name__ + "] " + str(e) )
+                log("Unable to save document " + filename + ": [" + e.__class__.__name__ + "] " + str(e), ERROR)
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
-                if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
+                logtraceback(exc_traceback)
+                self.done(key)
                 return False
             try:
-                os.rename(self.getfilename(key) + '.tmp', self.getfilename(key))
+                os.rename(filename + '.tmp', filename)
             except Exception as e:
                 self.fail = True
-                log("ERROR: Unable to complete saving of document " + self.getfilename(key) + ": ["  + e.__class__.__name__ + "] " + str(e) )
+                log("Unable to complete saving of document " + filename + ": ["  + e.__class__.__name__ + "] " + str(e), ERROR)
+                self.done(key)
                 return False
-            self.gitcommit(key, message)
+            doc.changed = False #until the next edit, saves (e.g. before copying, moving or unloading) can be skipped
+            self.gitcommit(key, message, filename=filename)
             self.done(key)
             return True
 
 
+    def gitcommitbatch(self, key, filenames, message, removed=()):
+        """Commits multiple files (in the same repository as the specified document) to git in a single commit, removed files
+        (or directories) are removed from the repository"""
+        if self.git and (filenames or removed):
+            with self.getgitlock(self.getgitpath(key)):
+                targetdir = self.getgitdir(key)
+                if targetdir is None:
+                    return False
+                log("Doing git commit for " + str(len(filenames)) + " file(s) in " + targetdir + " -- " + message)
+                try:
+                    if removed:
+                        subprocess.run(["git","rm","-r","-q","--cached","--ignore-unmatch","--pathspec-from-file=-"], input="\n".join(removed).encode('utf-8'), cwd=targetdir, check=True)
+                    if filenames:
+                        subprocess.run(["git","add","--pathspec-from-file=-"], input="\n".join(filenames).encode('utf-8'), cwd=targetdir, check=True)
+                    subprocess.run(["git","commit","-q","-m",message], cwd=targetdir, check=True)
+                except subprocess.CalledProcessError as e:
+                    log("Git add/commit failed in " + targetdir + ": " + str(e), ERROR)
+                    return False
+                finally:
+                    self.invalidatehistory(targetdir)
+        return True
+
+    def gethistory(self, key, limit=None, before=None):
+        """Returns the git history of the document, most recent first, as a list of {commit, date, msg} dictionaries and a boolean
+        indicating whether there are more (older) commits. Starts after the commit 'before' if specified and returns at most
+        'limit' commits. The full history is parsed once and cached until the next commit in the repository"""
+        try:
+            history = self.history[key][1]
+            self.history.move_to_end(key)
+        except KeyError: #not cached (or just invalidated)
+            history = None
+        if history is None:
+            filename = self.getfilename(key)
+            targetdir = self.getgitpath(key)
+            with self.getgitlock(targetdir): #no commit (and invalidation) can come in between reading and caching the history
+                cached = self.history.get(key) #another thread may have been first
+                if cached is not None:
+                    history = cached[1]
+                else:
+                    log("Invoking git log " + filename)
+                    proc = subprocess.run(["git","log","--follow",GITLOGFORMAT,"--",filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=targetdir)
+                    if proc.returncode != 0:
+                        log("git log failed for " + filename + ": " + proc.stderr.decode('utf-8'), WARNING)
+                        return [], False
+                    history = [ {'commit': commit, 'date': date, 'msg': msg} for commit, date, msg in parsegitlog(proc.stdout.decode('utf-8')) ]
+                    log(str(len(history)) + " revisions found")
+                    self.history[key] = (targetdir, history)
+                    while len(self.history) > self.historycachesize:
+                        self.history.popitem(last=False)
+        begin = 0
+        if before:
+            for i, entry in enumerate(history):
+                if entry['commit'].startswith(before):
+                    begin = i + 1
+                    break
+            else:
+                raise KeyError(before)
+        end = begin + limit if limit else len(history)
+        return history[begin:end], end < len(history)
+
+    def invalidatehistory(self, targetdir):
+        """Drops the cached history of all documents in the git repository, called after committing to it"""
+        for key in [ key for key, (gitdir, _) in list(self.history.items()) if gitdir == targetdir ]:
+            self.history.pop(key, None)
+
+    def getrevision(self, key, commit):
+        """Returns the (uncompressed) contents of the document as it was at the specified commit, read directly from the git
+        object store. Raises KeyError if the document did not exist at that commit"""
+        targetdir = self.getgitpath(key)
+        path = os.path.relpath(self.getfilename(key), targetdir)
+        proc = subprocess.run(["git","show",commit + ":" + path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=targetdir)
+        if proc.returncode != 0:
+            #the document may have had a different name (or compression) at the time, try the names it had in its history
+            proc = subprocess.run(["git","log","--follow","--format=","--name-only","--",path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=targetdir)
+            for oldpath in OrderedDict.fromkeys( line for line in proc.stdout.decode('utf-8').split("\n") if line and line != path ):
+                proc = subprocess.run(["git","show",commit + ":" + oldpath], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=targetdir)
+                if proc.returncode == 0:
+                    path = oldpath
+                    break
+            else:
+                raise KeyError(commit)
+        return decompress(proc.stdout, getcompression(path))
+
+    def revert(self, key, commit):
+        """Reverts the document to its state at the specified commit, in memory: the document is parsed from the git object
+        store and replaces the loaded one at once, sessions keep working and are notified of the changed elements.
+        The reverted document is not saved (and committed) yet, returns the commit message to save it with."""
+        log("Reverting " + "/".join(key) + " to commit " + commit)
+        filename = self.getfilename(key)
+        doc = self.parsedocument(filename, self.getrevision(key, commit))
+        doc.changed = True
+        message = "Reverting to commit " + commit
+        self.use(key)
+        try:
+            if key in self.data:
+                changed = getchangedelements(self.data[key], doc)
+                for sid, ids in self.updateq[key].items():
+                    ids.update(changed)
+            self.data[key] = doc
+            self.editcount[key] += 1 #invalidates continuations and cursors
+            self.resetchanges(key)
+            self.changelog[key].append(message)
+            for state in (self.xmlcache, self.fragments, self.wordorder, self.tokentables):
+                if key in state:
+                    del state[key]
+            self.invalidatecursors(key)
+            self.lastaccess[key]['NOSID'] = time.time()
+        finally:
+            self.done(key)
+        self.scheduleexpiry(key, time.time() + self.expiretime)
+        return message
+
+    def importdocuments(self, namespace, filenames, workers=None, batchsize=1000, overwrite=False, allowtextredundancy=False):
+        """Imports FoLiA documents from the specified files into a namespace. Documents are parsed, upgraded and cleaned in
+        parallel by a pool of worker processes, written atomically to the work directory, and committed to git in batches.
+        Returns a report (dictionary) listing the failures."""
+        namespace = validatenamespace(namespace)
+        nsdir = os.path.join(self.workdir, namespace)
+        if not os.path.exists(nsdir):
+            os.makedirs(nsdir)
+        report = {'imported': 0, 'failed': [], 'commits': 0}
+        imported = set() #keys imported in this run
+        batch = []
+        removed = []
+        def commit():
+            if self.gitcommitbatch((namespace, ''), batch, "Bulk import of " + str(len(batch)) + " document(s)", removed):
+                if self.git: report['commits'] += 1
+            else:
+                report['failed'].append({'file': None, 'error': "Git commit of " + str(len(batch)) + " document(s) failed, they were imported but are not under version control"})
+            batch.clear()
+            removed.clear()
+        tasks = ( (filename, nsdir, self.compression, allowtextredundancy) for filename in filenames )
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            for sourcefile, docid, tmpfile, error in pool.map(prepareimport, tasks, chunksize=8):
+                if error is None:
+                    key = (namespace, docid)
+                    existing = self.getfilename(key)
+                    filename = self.getbasename(key) + getextension(self.compression)
+                    if key in imported:
+                        error = "Duplicate document ID " + docid
+                    elif key in self.data:
+                        error = "Document " + docid + " is currently loaded, unable to replace it"
+                    elif os.path.exists(existing) and not overwrite:
+                        error = "Document " + docid + " already exists"
+                    else:
+                        try:
+                            os.rename(tmpfile, filename) #atomic
+                        except OSError as e:
+                            error = "Unable to write " + filename + ": " + str(e)
+                    if error is None:
+                        if existing != filename and os.path.exists(existing):
+                            #replaces a document that was stored with another compression method
+                            os.unlink(existing)
+                            removed.append(existing)
+                        imported.add(key)
+                        batch.append(filename)
+                        report['imported'] += 1
+                        if len(batch) >= batchsize:
+                            commit()
+                    elif os.path.exists(tmpfile):
+                        os.unlink(tmpfile)
+                if error is not None:
+                    log("Import of " + sourcefile + " failed: " + error)
+                    report['failed'].append({'file': sourcefile, 'error': error})
+        if batch or removed:
+            commit()
+        log("Bulk import into " + namespace + ": " + str(report['imported']) + " document(s) imported, " + str(len(report['failed'])) + " failure(s)")
+        return report
+
     def unload(self, key, save=True):
         if key in self:
             if save:
@@ -342,57 +897,590 @@ class DocStore:
             self.use(key) #save set its own lock
             log("Unloading " + "/".join(key))
             del self.data[key]
-            del self.lastaccess[key]
+            if key in self.lastaccess:
+                del self.lastaccess[key]
             if key in self.updateq:
                 del self.updateq[key]
             if key in self.changelog:
                 del self.changelog[key]
+            if key in self.editcount:
+                del self.editcount[key]
+            self.changes.pop(key, None)
+            self.changebase.pop(key, None)
+            if key in self.xmlcache:
+                del self.xmlcache[key]
+            if key in self.fragments:
+                del self.fragments[key]
+            if key in self.wordorder:
+                del self.wordorder[key]
+            if key in self.tokentables:
+                del self.tokentables[key]
+            if key in self.snapshots:
+                removesnapshot(self.snapshots.pop(key))
+            with self.resultlock:
+                for token in [ token for token, continuation in list(self.continuations.items()) if continuation[0] == key ]:
+                    del self.continuations[token]
+            self.invalidatecursors(key)
             self.done(key)
 
     def delete(self, key):
         self.unload(key,False)
         filename = self.getfilename(key)
+        removeprerendered(getprerenderdir(self.getbasename(key)))
         if os.path.exists(filename):
             log("Removing " + filename)
-            os.unlink(self.getfilename(key))
-            self.gitcommit(key, message="Removed document", remove=True)
+            os.unlink(filename)
+            self.gitcommit(key, message="Removed document", remove=True, filename=filename)
 
 
     def copy(self, key, newkey):
+        """Copies the document (a hardlink if possible, documents are only ever replaced, never modified in place). Never overwrites,
+        returns False if the target already exists"""
         if key in self:
             self.save(key) #ensure latest changes are flushed to disk
         filename = self.getfilename(key)
-        if os.path.exists(filename):
-            newfilename = self.getfilename(newkey)
-            if os.path.exists(newfilename): #never overwrites
-                log("Target file already exists (" + newfilename + ")")
-            else:
-                log("Copying " + filename + " to " + newfilename)
-                targetdir = self.getpath(newkey)
-                shutil.copyfile(filename, newfilename)
-                self.gitcommit(newkey, message="Adding copied document")
+        if not os.path.exists(filename):
+            raise NoSuchDocument
+        locked = sorted({key, newkey}) #always locked in the same order, so opposite copies and moves can not deadlock
+        for lockedkey in locked:
+            self.use(lockedkey)
+        try:
+            if os.path.exists(self.getfilename(newkey)): #never overwrites
+                log("Target file already exists (" + self.getfilename(newkey) + ")")
+                return False
+            newfilename = self.getbasename(newkey) + getextension(getcompression(filename)) #the copy retains the compression of the original
+            log("Copying " + filename + " to " + newfilename)
+            os.makedirs(os.path.dirname(newfilename), exist_ok=True)
+            linkorcopy(filename, newfilename)
+            self.gitcommit(newkey, message="Adding copied document", filename=newfilename)
+            return True
+        finally:
+            for lockedkey in reversed(locked):
+                self.done(lockedkey)
+
+    def convert(self, key, compression):
+        """Convert the document on disk to the specified compression method (None for uncompressed)"""
+        checkcompression(compression)
+        if key in self:
+            self.unload(key) #saves pending changes first
+        self.use(key)
+        try:
+            filename = self.getfilename(key)
+            if not os.path.exists(filename):
+                raise NoSuchDocument
+            if getcompression(filename) == compression:
+                return False
+            newfilename = self.getbasename(key) + getextension(compression)
+            log("Converting " + filename + " to " + newfilename)
+            data = readfile(filename)
+            writefile(newfilename + '.tmp', data, compression)
+            os.rename(newfilename + '.tmp', newfilename)
+            os.unlink(filename)
+            self.gitcommit(key, message="Converted document to " + (compression if compression else "uncompressed") + " storage", filename=newfilename, replaces=filename)
+            return True
+        finally:
+            self.done(key)
 
 
     def move(self, key, newkey):
-        self.copy(key, newkey)
-        self.delete(key)
-
-        #self.unload(key)
-        #filename = self.getfilename(key)
-        #if os.path.exists(filename):
-        #    newfilename = self.getfilename(newkey)
-        #    if os.path.exists(newfilename): #never overwrites
-        #        log("Target file already exists (" + newfilename + ")")
-        #    else:
-        #        if self.git:
-        #            message = "Moving document"
-        #            log("Doing git commit for " + newfilename + " -- " + message.replace("\n", " -- "))
-        #            r = os.system("git mv " + filename + " " + newfilename + " && git commit -m \"" + message.replace('"','') + "\"")
-        #            if r != 0:
-        #                log("ERROR during git mv/commit of " +filename)
-        #        else:
-        #            log("Moving " + filename + " to " + newfilename)
-        #            shutil.movefile(filename, newfilename)
+        """Moves (renames) the document. A loaded document remains loaded under the new key, along with its sessions. Never overwrites"""
+        if key in self:
+            self.save(key) #ensure latest changes are flushed to disk (save sets its own lock)
+        locked = sorted({key, newkey}) #always locked in the same order, so opposite moves and copies can not deadlock
+        for lockedkey in locked:
+            self.use(lockedkey)
+        try:
+            filename = self.getfilename(key)
+            if not os.path.exists(filename):
+                raise NoSuchDocument
+            if os.path.exists(self.getfilename(newkey)): #never overwrites
+                log("Target file already exists (" + self.getfilename(newkey) + ")")
+                return False
+            newfilename = self.getbasename(newkey) + getextension(getcompression(filename))
+            log("Moving " + filename + " to " + newfilename)
+            os.makedirs(os.path.dirname(newfilename), exist_ok=True)
+            shutil.move(filename, newfilename) #a rename, unless across filesystems
+            prerenderdir = getprerenderdir(self.getbasename(key))
+            if os.path.exists(prerenderdir):
+                shutil.move(prerenderdir, getprerenderdir(self.getbasename(newkey))) #renderings remain valid
+            self.rekey(key, newkey, newfilename)
+            self.gitmove(key, newkey, filename, newfilename, "Moved document " + "/".join(key) + " to " + "/".join(newkey))
+            return True
+        finally:
+            for lockedkey in reversed(locked):
+                self.done(lockedkey)
+
+    def rekey(self, key, newkey, newfilename):
+        """Moves all in-memory state of a document (if loaded) to a new key. Call with both locks held"""
+        if key in self.data:
+            self.data[key].filename = newfilename
+            for state in (self.data, self.lastaccess, self.updateq, self.changelog, self.editcount, self.versions, self.changes, self.changebase, self.xmlcache, self.fragments, self.wordorder, self.tokentables, self.snapshots):
+                if key in state:
+                    state[newkey] = state.pop(key)
+            with self.resultlock:
+                for token, continuation in list(self.continuations.items()):
+                    if continuation[0] == key:
+                        self.continuations[token] = (newkey,) + continuation[1:]
+                for cursorid, cursor in list(self.cursors.items()):
+                    if cursor[0] == key:
+                        self.cursors[cursorid] = (newkey,) + cursor[1:]
+            self.scheduleexpiry(newkey, time.time() + self.expiretime)
+
+    def gitmove(self, key, newkey, path, newpath, message):
+        """Records a move of a file or directory in git. Within a repository this is a single commit (recorded by git as a rename),
+        across repositories the removal and addition are committed separately"""
+        if self.git:
+            gitpath = self.getgitpath(key)
+            if gitpath == path or gitpath.startswith(path + '/'):
+                return #the repository itself was moved along
+            added = getdocumentfiles(newpath) if os.path.isdir(newpath) else [newpath] #not the prerendered output moved along
+            if gitpath == self.getgitpath(newkey):
+                self.gitcommitbatch(newkey, added, message, removed=[path])
+            else:
+                self.gitcommitbatch(key, [], message, removed=[path])
+                self.gitcommitbatch(newkey, added, message)
+
+    def namespacekeys(self, namespace):
+        """Returns the keys of all loaded documents in the namespace (including nested namespaces)"""
+        return [ key for key in list(self.data.keys()) if key[0] == namespace or key[0].startswith(namespace + '/') ]
+
+    def movenamespace(self, namespace, newnamespace):
+        """Moves (renames) an entire namespace, including nested namespaces. Loaded documents remain loaded under their new keys. Never overwrites"""
+        path = os.path.join(self.workdir, namespace)
+        newpath = os.path.join(self.workdir, newnamespace)
+        if not namespace or not newnamespace or newpath.startswith(path + '/'):
+            raise ValueError("Unable to move namespace " + namespace + " to " + newnamespace)
+        if not os.path.isdir(path):
+            raise NoSuchDocument("No such namespace: " + namespace)
+        if os.path.exists(newpath):
+            log("Target namespace already exists (" + newnamespace + ")")
+            return False
+        keys = sorted(self.namespacekeys(namespace)) #locked in a fixed order, as in move()
+        for key in keys:
+            self.save(key) #ensure latest changes are flushed to disk
+        for key in keys:
+            self.use(key)
+        try:
+            log("Moving namespace " + namespace + " to " + newnamespace)
+            os.makedirs(os.path.dirname(newpath), exist_ok=True)
+            shutil.move(path, newpath)
+            for key in keys:
+                newkey = (newnamespace + key[0][len(namespace):], key[1])
+                filename = self.getfilename(key)
+                self.rekey(key, newkey, newpath + filename[len(path):])
+            self.gitmove((namespace,""), (newnamespace,""), path, newpath, "Moved namespace " + namespace + " to " + newnamespace)
+            return True
+        finally:
+            for key in reversed(keys):
+                self.done(key)
+
+    def copynamespace(self, namespace, newnamespace):
+        """Copies an entire namespace, including nested namespaces, documents are hardlinked if possible. Never overwrites"""
+        path = os.path.join(self.workdir, namespace)
+        newpath = os.path.join(self.workdir, newnamespace)
+        if not namespace or not newnamespace or newpath.startswith(path + '/'):
+            raise ValueError("Unable to copy namespace " + namespace + " to " + newnamespace)
+        if not os.path.isdir(path):
+            raise NoSuchDocument("No such namespace: " + namespace)
+        if os.path.exists(newpath):
+            log("Target namespace already exists (" + newnamespace + ")")
+            return False
+        for key in self.namespacekeys(namespace):
+            self.save(key) #ensure latest changes are flushed to disk
+        log("Copying namespace " + namespace + " to " + newnamespace)
+        shutil.copytree(path, newpath, copy_function=linkorcopy, ignore=shutil.ignore_patterns('.git', '*.tmp', '.*' + PRERENDEREXTENSION))
+        if self.git:
+            self.gitcommitbatch((newnamespace,""), getdocumentfiles(newpath), "Copied namespace " + namespace + " to " + newnamespace)
+        return True
+
+    def markchanged(self, key, elements=(), metadata=False, query=None):
+        """Marks a loaded document as changed, must be called after every edit so caches are invalidated. What changed
+        (structure elements or single token annotations, see flat.getchanges(), or metadata) is recorded for clients syncing
+        since an earlier version, and returned. Elements may also be a (serialised) query result, clients then need to reload
+        the document to sync past this change"""
+        if key[0] == "testflat":
+            key = ("testflat","testflat")
+        self.data[key].changed = True
+        self.editcount[key] += 1
+        self.invalidatecursors(key)
+        if isinstance(elements, str):
+            changes = None #XML or JSON output, we don't know what changed
+        else:
+            changes = getchanges(elements, query)
+        self.recordchange(key, changes, metadata)
+        return changes
+
+    def getversion(self, key):
+        """Returns the current version of the document"""
+        if key not in self.versions:
+            self.versions[key] = next(self.versioncounter)
+        return self.versions[key]
+
+    def recordchange(self, key, ids, metadata=False):
+        """Assigns a new version to the document and records what changed (a set of element IDs and annotation changes as
+        returned by flat.getchanges(), or None if unknown) in the ring of recent changes"""
+        previous = self.getversion(key)
+        version = next(self.versioncounter)
+        if key not in self.changes:
+            self.changes[key] = deque()
+            self.changebase[key] = previous
+        elif len(self.changes[key]) >= self.maxchanges:
+            self.changebase[key] = self.changes[key].popleft()[0]
+        self.changes[key].append((version, frozenset(ids) if ids is not None else None, metadata))
+        self.versions[key] = version
+
+    def resetchanges(self, key):
+        """Assigns a new version to a document that was replaced entirely, clients need to reload it"""
+        self.versions[key] = next(self.versioncounter)
+        self.changes.pop(key, None)
+        self.changebase.pop(key, None)
+
+    def getchanges(self, key, since):
+        """Returns (version, set of changes (see flat.getchanges()), metadata changed?) for everything that changed after the specified
+        version, or (version, None, None) if that is not known (anymore), in which case the client should reload the document"""
+        version = self.getversion(key)
+        if since == version:
+            return version, set(), False
+        if key in self.changes and self.changebase[key] <= since < version:
+            ids = set()
+            metadata = False
+            for changeversion, changeids, changemetadata in list(self.changes[key]):
+                if changeversion > since:
+                    if changeids is None:
+                        return version, None, None
+                    ids.update(changeids)
+                    metadata = metadata or changemetadata
+            return version, ids, metadata
+        return version, None, None
+
+    def getxml(self, key, doc=None):
+        """Returns (etag, xml) for a loaded document (or the pinned version of it), the serialisation is cached until the document is edited"""
+        if doc is None:
+            doc = self[key]
+        cacheable = key[0] != "testflat" and self.data.get(key) is doc #no caching for versions replaced by a copy
+        stamp = (self.editcount[key], len(doc.index)) #the index size catches IDs generated on the fly (e.g. by FLAT)
+        if cacheable and key in self.xmlcache and self.xmlcache[key][0] == stamp:
+            return self.xmlcache[key][1:]
+        xml = serialise(doc)
+        etag = "\"" + hashlib.sha1(xml).hexdigest() + "\""
+        if cacheable:
+            self.xmlcache[key] = (stamp, etag, xml)
+        return etag, xml
+
+    def getcachedxml(self, key):
+        """Returns (etag, xml, version) if the serialisation of the loaded document is cached and current, None otherwise. Cheap
+        enough not to pin the document (which would make a concurrent edit copy it, see detach())"""
+        if key[0] == "testflat":
+            return None
+        with self.lockcondition:
+            doc = self.data.get(key)
+            if doc is None or key not in self.xmlcache or (key in self.lock and self.lock[key][0] != threading.get_ident()):
+                return None #not loaded or being edited
+            stamp, etag, xml = self.xmlcache[key]
+            if stamp != (self.editcount[key], len(doc.index)):
+                return None
+            return etag, xml, self.getversion(key)
+
+    def getfragments(self, key, doc=None):
+        """Returns the cache of pre-encoded JSON blocks (declarations, provenance, metadata, etc) for a loaded document"""
+        if key[0] == "testflat":
+            return None #fresh copy every time, nothing to cache
+        if doc is not None and self.data.get(key) is not doc:
+            return None #pinned version that was replaced by a copy, the cache belongs to the copy
+        editcount = self.editcount[key]
+        if key not in self.fragments or self.fragments[key][0] != editcount:
+            self.fragments[key] = (editcount, {}) #every edit may change declarations or provenance, start afresh
+        return self.fragments[key][1]
+
+    def getwordorder(self, key, doc=None):
+        """Returns the token order of a loaded document, used for fast neighbour lookups"""
+        if key[0] == "testflat":
+            return None #fresh copy every time, not worth indexing
+        if doc is not None and self.data.get(key) is not doc:
+            return WordOrder(doc) #pinned version that was replaced by a copy
+        if key not in self.wordorder:
+            self.wordorder[key] = WordOrder(self[key])
+        return self.wordorder[key]
+
+    def updatewordorder(self, key, results):
+        """Updates the token order after a structural edit, results are the elements returned by the query"""
+        if key in self.wordorder:
+            self.wordorder[key].update(results)
+
+    def gettokentable(self, key, doc=None):
+        """Returns the token table of a loaded document (see tokentable.TokenTable), used for column scans over its words"""
+        if key[0] == "testflat":
+            return None #fresh copy every time, not worth indexing
+        if doc is not None and self.data.get(key) is not doc:
+            return TokenTable(doc) #pinned version that was replaced by a copy
+        if key not in self.tokentables:
+            self.tokentables[key] = TokenTable(self[key])
+        return self.tokentables[key]
+
+    def updatetokentable(self, key, results):
+        """Updates the token table after an edit, results are what the query returned"""
+        if key in self.tokentables:
+            if isinstance(results, str):
+                del self.tokentables[key] #serialised results (FORMAT xml/json), we can not tell what changed
+            else:
+                self.tokentables[key].update(results)
+
+    def gettokentables(self, keys, layers=LAYERS):
+        """Yields (key, token table) for each document, for export. Loaded documents are read from memory (reusing their table if
+        it has the requested layers), others are parsed for the occasion and not kept, so at most one extra document is in
+        memory at a time. If a document can not be read, the exception is yielded instead of the table"""
+        for key in keys:
+            if key in self:
+                doc, _ = self.pin(key)
+                try:
+                    table = self.gettokentable(key, doc) if layers == LAYERS else None
+                    yield key, table if table is not None else TokenTable(doc, layers)
+                finally:
+                    self.unpin(key, doc)
+            else:
+                filename = self.getfilename(key)
+                try:
+                    if getcompression(filename):
+                        doc = self.parsedocument(filename, readfile(filename))
+                    else:
+                        doc = self.parsedocument(filename)
+                    table = TokenTable(doc, layers)
+                except Exception as e:
+                    log("Unable to export " + filename + ": " + str(e), WARNING)
+                    table = e
+                yield key, table
+                doc = table = None #before parsing the next one
+
+    def render(self, key, doc, results, **flatargs):
+        """Renders query results on a (pinned) document for FLAT, see flat.parseresults(). Results with many elements are
+        rendered by the render pool, if enabled"""
+        if self.renderpool is not None and key[0] != "testflat" and countelements(results, self.renderthreshold) >= self.renderthreshold:
+            out = self.renderinpool(key, doc, results, flatargs)
+            if out is not None:
+                return out
+        return parseresults(results, doc, fragments=self.getfragments(key, doc), wordorder=self.getwordorder(key, doc), tokentable=self.gettokentable(key, doc) if flatargs.get('slices') else None, **flatargs)
+
+    def renderinpool(self, key, doc, results, flatargs):
+        """Renders query results in a render process, from a snapshot of the document. Returns None if the results have to be
+        rendered in-thread instead: if they lack identifiers, or if rendering assigns identifiers (these have to exist here)"""
+        idgroups = []
+        for queryresults in results:
+            ids = []
+            for result in queryresults:
+                if isinstance(result, fql.SpanSet):
+                    ids.append(tuple(e.id for e in result))
+                    if not all(ids[-1]): return None
+                elif isinstance(result, folia.AbstractElement) and result.id:
+                    ids.append(result.id)
+                else:
+                    return None
+            idgroups.append(ids)
+        continuation = flatargs.get('continuation')
+        placeholder = "continuation.%032x" % random.getrandbits(128) if continuation else None #replaced by the actual token afterwards
+        args = { name: value for name, value in flatargs.items() if name not in ('continuation', 'logfunction') }
+        try:
+            filename = self.getsnapshot(key, doc)
+            rendered = self.renderpool.submit(renderdocument, (filename, idgroups, placeholder, args)).result()
+        except concurrent.futures.BrokenExecutor:
+            log("Render pool is broken, rendering in-thread from now on", ERROR)
+            self.renderpool = None
+            return None
+        except Exception as e: #pylint: disable=broad-except
+            log("Rendering in the render pool failed, rendering in-thread: [" + e.__class__.__name__ + "] " + str(e), WARNING)
+            return None
+        if rendered is None:
+            return None
+        out, remainderids = rendered
+        if remainderids:
+            out = out.replace(dumps(placeholder), dumps(continuation([ doc[id] for id in remainderids ])), 1)
+        return out
+
+    def getsnapshot(self, key, doc):
+        """Returns the filename of a serialisation of the (pinned) document for the render pool, written once per version"""
+        etag, xml = self.getxml(key, doc)
+        filename = os.path.join(self.snapshotdir, hashlib.sha1("/".join(key).encode('utf-8')).hexdigest() + "-" + etag.strip('"') + ".xml")
+        if not os.path.exists(filename):
+            tmpfile = filename + ".%016x.tmp" % random.getrandbits(64)
+            with open(tmpfile, 'wb') as f:
+                f.write(xml)
+            os.rename(tmpfile, filename)
+        previous = self.snapshots.get(key)
+        self.snapshots[key] = filename
+        if previous and previous != filename:
+            removesnapshot(previous) #render processes that still need it fall back to in-thread rendering
+        return filename
+
+    def stoprendering(self):
+        """Shuts down the render pool and removes the snapshots"""
+        if self.renderpool is not None:
+            self.renderpool.shutdown()
+            self.renderpool = None
+        if self.snapshotdir:
+            shutil.rmtree(self.snapshotdir, ignore_errors=True)
+
+    def addcontinuation(self, key, remainder, rawqueries):
+        """Stores the elements that were not rendered because ELEMENTLIMIT was reached, returns a continuation token
+        encoding the document, the stop position and (a digest of) the query"""
+        token = base64.urlsafe_b64encode(dumps({
+            'doc': "/".join(key),
+            'stopat': remainder[0].id,
+            'query': hashlib.sha1("\n".join(rawqueries).encode('utf-8')).hexdigest()[:16],
+            'nonce': "%016x" % random.getrandbits(64),
+        })).decode('ascii')
+        with self.resultlock:
+            #forget old continuations
+            now = time.time()
+            for oldtoken in [ oldtoken for oldtoken, continuation in list(self.continuations.items()) if now - continuation[3] > self.expiretime ]:
+                del self.continuations[oldtoken]
+            while len(self.continuations) >= MAXCONTINUATIONS:
+                del self.continuations[min(list(self.continuations.items()), key=lambda item: item[1][3])[0]]
+            self.continuations[token] = (key, self.editcount[key], remainder, now)
+        return token
+
+    def getcontinuation(self, token):
+        """Returns (key, remainder) for a continuation token (which can only be used once), raises KeyError if the token is unknown or expired
+        and ValueError if the document was edited in the meantime"""
+        with self.resultlock:
+            key, editcount, remainder, _ = self.continuations.pop(token)
+        if key not in self or self.editcount[key] != editcount or remainder[0].doc is not self.data[key]:
+            raise ValueError("Document was changed")
+        return key, remainder
+
+    def addcursor(self, key, sid, query, results, doc=None, slicesize=CUSTOMSLICESIZE):
+        """Stores the ordered IDs of a search result (on the specified document version, if pinned) so later pages (of slicesize
+        results, as in the customslices the client received) can be rendered without re-running the query. Returns the cursor ID,
+        or None if the results are not worth (or can't be) cached"""
+        if key[0] == "testflat" or sid == 'NOSID' or not self.maxcursorids or len(results) <= slicesize:
+            return None
+        editcount = self.editcount[key] #obtained before checking the document is current, edits are made after replacing it
+        if doc is not None and self.data.get(key) is not doc:
+            return None #pinned version that was replaced by a copy, the results may be outdated already
+        ids = []
+        for result in results:
+            if isinstance(result, fql.SpanSet):
+                ids.append(tuple(e.id for e in result))
+                if not all(ids[-1]): return None
+            elif result.id:
+                ids.append(result.id)
+            else:
+                return None
+        if len(ids) > self.maxcursorids:
+            return None
+        with self.resultlock:
+            for cursorid, cursor in list(self.cursors.items()):
+                if cursor[:3] == (key, sid, query):
+                    self.removecursor(cursorid) #replaced
+            cursorid = "%016x" % random.getrandbits(64)
+            self.cursors[cursorid] = (key, sid, query, editcount, ids, slicesize, time.time())
+            self.cursorids += len(ids)
+            self.expirecursors()
+        return cursorid
+
+    def findcursor(self, key, sid, query, slicesize=CUSTOMSLICESIZE):
+        """Returns the ID of a valid cursor for the same query (and page size) by the same session, or None"""
+        with self.resultlock:
+            self.expirecursors()
+            for cursorid, cursor in list(self.cursors.items()):
+                if cursor[:3] == (key, sid, query) and cursor[3] == self.editcount[key] and cursor[5] == slicesize:
+                    return cursorid
+        return None
+
+    def getcursor(self, cursorid):
+        """Returns ((namespace,docid), session_id, ids, page size) for a cursor, raises KeyError if it does not exist (anymore)"""
+        with self.resultlock:
+            self.expirecursors()
+            key, sid, query, editcount, ids, slicesize, _ = self.cursors[cursorid]
+            self.cursors[cursorid] = (key, sid, query, editcount, ids, slicesize, time.time())
+            self.cursors.move_to_end(cursorid)
+        return key, sid, ids, slicesize
+
+    def resolvecursor(self, ids, doc):
+        """Turns cursor IDs back into elements (or span sets), returns None if any element no longer exists"""
+        results = []
+        for id in ids:
+            if isinstance(id, tuple):
+                if not all(x in doc for x in id): return None
+                results.append(fql.SpanSet(doc[x] for x in id))
+            else:
+                if id not in doc: return None
+                results.append(doc[id])
+        return results
+
+    def removecursor(self, cursorid):
+        with self.resultlock:
+            self.cursorids -= len(self.cursors[cursorid][4])
+            del self.cursors[cursorid]
+
+    def expirecursors(self):
+        """Removes cursors that exceed the TTL, and the least recently used ones if the cursors hold too many IDs"""
+        now = time.time()
+        with self.resultlock:
+            for cursorid in [ cursorid for cursorid, cursor in list(self.cursors.items()) if now - cursor[6] > self.cursorttl ]:
+                self.removecursor(cursorid)
+            while self.cursorids > self.maxcursorids:
+                self.removecursor(next(iter(self.cursors)))
+
+    def invalidatecursors(self, key):
+        """Removes all cursors for a document, called whenever the document is edited"""
+        with self.resultlock:
+            for cursorid in [ cursorid for cursorid, cursor in list(self.cursors.items()) if cursor[0] == key ]:
+                self.removecursor(cursorid)
+
+    def invalidatefragments(self, key, *names):
+        """Invalidates the specified pre-encoded JSON blocks for a document (all if none are specified)"""
+        if key in self.fragments:
+            if names:
+                for name in names:
+                    self.fragments[key][1].pop(name, None)
+            else:
+                del self.fragments[key]
+
+    def prerender(self, key, slices=None, assignids=False):
+        """Renders the FLAT responses for viewing the document in advance and stores them next to the document, returns the number of renderings.
+        If rendering assigns new identifiers, the document is saved if assignids is set, otherwise nothing is stored"""
+        filename = self.getfilename(key)
+        stamp = getstamp(filename, VERSION)
+        doc = self[key]
+        indexsize = len(doc.index)
+        renderings = []
+        for rawquery, flatargs in getrenderrequests(doc, slices):
+            if rawquery == "PROBE":
+                results = []
+            else:
+                results = [ fql.Query(rawquery)(doc,False) ]
+            out = parseresults(results, doc, version=VERSION, fragments=self.getfragments(key), wordorder=self.getwordorder(key), tokentable=self.gettokentable(key) if flatargs.get('slices') else None, logfunction=log, **flatargs)
+            renderings.append( (rawquery, flatargs, out) )
+        if len(doc.index) != indexsize:
+            #rendering assigned new IDs, these have to be on disk as well or later edits can not refer to them
+            if not assignids:
+                raise ValueError("Rendering assigns new identifiers, the document has to be saved with them first (use --assignids)")
+            doc.changed = True
+            self.save(key, "Assigned identifiers")
+            stamp = getstamp(filename, VERSION)
+        elif getstamp(filename, VERSION) != stamp:
+            log("Document " + "/".join(key) + " changed during rendering, discarding")
+            return 0
+        writeprerendered(getprerenderdir(self.getbasename(key)), stamp, renderings)
+        return len(renderings)
+
+    def getprerendered(self, key, rawquery, flatargs):
+        """Returns the filename of the (gzip compressed) precomputed FLAT response for the query, or None if it is unavailable or outdated.
+        Only documents that are not loaded qualify, loaded documents may have unsaved edits."""
+        if key in self or key[0] == "testflat":
+            return None
+        try:
+            stamp = getstamp(self.getfilename(key), VERSION)
+        except FileNotFoundError:
+            return None
+        return findprerendered(getprerenderdir(self.getbasename(key)), stamp, rawquery, flatargs)
+
+    def getfileetag(self, key):
+        """Returns an etag for the document as stored on disk (based on modification time and size), or None if it does not exist"""
+        try:
+            stat = os.stat(self.getfilename(key))
+        except FileNotFoundError:
+            return None
+        return "\"f" + format(stat.st_mtime_ns, 'x') + "-" + format(stat.st_size, 'x') + "\""
 
     def __getitem__(self, key):
         assert isinstance(key, tuple) and len(key) == 2
@@ -406,6 +1494,17 @@ class DocStore:
         assert isinstance(doc, folia.Document)
         doc.filename = self.getfilename(key)
         self.data[key] = doc
+        self.editcount[key] = 0
+        self.resetchanges(key)
+        if key in self.xmlcache:
+            del self.xmlcache[key]
+        if key in self.fragments:
+            del self.fragments[key]
+        if key in self.wordorder:
+            del self.wordorder[key]
+        if key in self.tokentables:
+            del self.tokentables[key]
+        self.scheduleexpiry(key, time.time() + self.expiretime)
 
     def __contains__(self,key):
         assert isinstance(key, tuple) and len(key) == 2
@@ -427,38 +1526,140 @@ class DocStore:
     def __iter__(self):
         return iter(self.data)
 
+    def scheduleexpiry(self, key, expirytime):
+        """Schedules a check whether the document has expired (i.e. all its sessions are inactive) at the specified time"""
+        with self.expirycondition:
+            heapq.heappush(self.expiryschedule, (expirytime, key))
+            self.expirycondition.notify_all()
+
+    def waitforexpiry(self, timeout):
+        """Blocks until the next scheduled expiry check is due, the schedule changes, or the timeout passes"""
+        with self.expirycondition:
+            if self.expiryschedule:
+                timeout = min(timeout, max(0, self.expiryschedule[0][0] - time.time()))
+            if timeout > 0:
+                self.expirycondition.wait(timeout)
+
     def autounload(self, save=True):
-        log("Documents loaded: " + str(len(self)))
+        """Unloads all documents that are due according to the expiry schedule"""
         self.lastunloadcheck = time.time()
         if self.fail and not self.ignorefail:
             self.forceunload() #if we enter a failed state, we forcibly unload everything (probably again and again until the problem is fixed)
-        else:
-            unload = []
-            for d in self.lastaccess:
-                if d not in unload:
-                    dounload = True #falsify: all sessions must be expired before we can actually unload the document
-                    for sid, t in self.lastaccess[d].items():
-                        expirecheck = time.time() - t
-                        if expirecheck < self.expiretime:
-                            dounload = False
-
-                    if dounload:
-                        log("Triggering unload for " + "/".join(d) + " [" + str(expirecheck) + "s / " + sid + "]")
-                        unload.append(d)
-
-            if unload:
-                for key in unload:
-                    self.unload(key, save)
-
-    def forceunload(self):
-        """Called when the document server stops/reloads (SIGUSR1 will trigger this)"""
+            return
+        unload = []
+        now = time.time()
+        with self.expirycondition:
+            while self.expiryschedule and self.expiryschedule[0][0] <= now:
+                _, key = heapq.heappop(self.expiryschedule)
+                if key not in self.data or key in unload:
+                    continue #already unloaded
+                sessions = self.lastaccess.get(key, {})
+                #all sessions must be expired before we can actually unload the document
+                expirytime = max(sessions.values(), default=0) + self.expiretime
+                if expirytime <= now:
+                    log("Triggering unload for " + "/".join(key) + " [" + str(len(sessions)) + " session(s) expired]")
+                    unload.append(key)
+                else:
+                    heapq.heappush(self.expiryschedule, (expirytime, key))
+        if unload:
+            self.unloadall(unload, save)
+
+    def unloadall(self, keys, save=True, deadline=None):
+        """Unloads (and saves) the documents in parallel, on the save thread pool. Documents not yet being unloaded when the
+        deadline (a time) passes are skipped, their keys are returned."""
+        if not keys:
+            return []
+        begintime = lastreport = time.time()
+        futures = { self.savepool.submit(self.unload, key, save): key for key in keys }
+        pending = set(futures)
+        while pending:
+            timeout = 1.0 if deadline is None else min(1.0, max(0, deadline - time.time()))
+            finished, pending = concurrent.futures.wait(pending, timeout=timeout)
+            for future in finished:
+                if future.exception():
+                    log("Unloading " + "/".join(futures[future]) + " failed: " + str(future.exception()), ERROR)
+            if pending and time.time() - lastreport >= 1.0:
+                log("Unloading documents: " + str(len(keys) - len(pending)) + "/" + str(len(keys)) + " done")
+                lastreport = time.time()
+            if pending and deadline is not None and time.time() >= deadline:
+                #documents that are being saved right now will finish, the others are abandoned
+                skipped = [ futures[future] for future in pending if future.cancel() ]
+                log("Deadline passed, " + str(len(skipped)) + " document(s) were not unloaded (changes not saved): " + ", ".join( "/".join(key) for key in skipped ), ERROR)
+                concurrent.futures.wait(pending - set( future for future in pending if future.cancelled() ))
+                return skipped
+        log(str(len(keys)) + " document(s) unloaded in " + "%.2f" % (time.time() - begintime) + "s")
+        return []
+
+    def forceunload(self, deadline=None):
+        """Called when the document server stops/reloads (SIGUSR1 will trigger this). The deadline is the maximum time (in seconds) to spend saving documents"""
         log("Forcibly unloading all " + str(len(self)) + " documents...")
-        for key in list(self.data.keys()):
-            self.unload(key)
+        self.unloadall(list(self.data.keys()), True, time.time() + deadline if deadline else None)
+
+def getchangedelements(doc, newdoc):
+    """Returns the IDs of the top-level structure elements that differ between two versions of a document, including those that
+    were removed in the new version"""
+    def toplevel(doc):
+        elements = {}
+        for body in doc.data:
+            for element in body:
+                if isinstance(element, folia.AbstractStructureElement) and element.id:
+                    elements[element.id] = element
+        return elements
+    old = toplevel(doc)
+    changed = set()
+    for id, element in toplevel(newdoc).items():
+        if id not in old or old[id].xmlstring() != element.xmlstring():
+            changed.add(id)
+        old.pop(id, None)
+    changed.update(old) #no longer present
+    return changed
+
+def removesnapshot(filename):
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+
+def isattached(element, doc):
+    """Is the element (still) part of the document?"""
+    while element.parent is not None:
+        if not any( child is element for child in element.parent.data ):
+            return False
+        element = element.parent
+    return any( child is element for child in doc.data )
+
+def linkorcopy(filename, newfilename):
+    """Hardlinks the file if possible (same filesystem), copies it otherwise"""
+    try:
+        os.link(filename, newfilename)
+    except OSError:
+        shutil.copy2(filename, newfilename)
+    return newfilename
+
+def getdocumentfiles(path):
+    """Returns the FoLiA documents in a directory and its subdirectories, skipping hidden directories (such as git repositories and
+    prerendered FLAT output)"""
+    filenames = []
+    for directory, subdirectories, files in os.walk(path):
+        subdirectories[:] = [ subdirectory for subdirectory in subdirectories if subdirectory[0] != '.' ]
+        filenames += sorted( os.path.join(directory, filename) for filename in files if isfoliafile(filename) )
+    return filenames
 
 def validatenamespace(namespace):
     return namespace.replace('..','').replace('"','').replace(' ','_').replace(';','').replace('&','').strip('/')
 
+def getexpectedversion(params):
+    """Returns the document version a client expects to edit, from the If-Match header or the docversion parameter, or None if not specified"""
+    value = cherrypy.request.headers.get('If-Match', params.get('docversion'))
+    if value is None or value.strip() == '*':
+        return None
+    value = value.strip()
+    if value.startswith('W/'): value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise cherrypy.HTTPError(400, "Expected a document version (docversion) in If-Match")
+
 def getdocumentselector(query):
     if query.startswith("USE "):
         end = query[4:].index(' ') + 4
@@ -488,21 +1689,38 @@ class Root:
         self.workdir = args.workdir
         self.debug = args.debug
         self.allowtextredundancy = args.allowtextredundancy
+        self.prerendered = args.prerendered
+        self.admission = AdmissionControl(args.maxconcurrent, args.maxperdocument, args.maxqueue, args.admissiontimeout, getmaxwaiting(args))
+        self.planner = Planner(not args.noplanner)
 
-    def setsession(self,namespace,docid, sid=None, results=None):
-        """Create or update a session"""
+    def admit(self, key):
+        """Admit the current request for processing on the specified document, responds with 503 if the server is too busy. The admission is released automatically at the end of the request."""
+        if not key: key = ('','')
+        try:
+            self.admission.admit(key)
+        except Overloaded as e:
+            log("[REJECTED] " + str(e) + " (" + str(self.admission.rejected) + " rejected in total)", WARNING)
+            cherrypy.response.headers['Retry-After'] = str(max(1, int(self.admission.timeout)))
+            raise cherrypy.HTTPError(503, "Server too busy, try again later: " + str(e))
+        cherrypy.request.hooks.attach('on_end_request', lambda: self.admission.release(key))
+
+    def logduration(self, msg, sid, key, level=INFO):
+        """Logs the message with the status and duration of the current request once it has ended"""
+        begintime = time.time()
+        cherrypy.request.hooks.attach('on_end_request', lambda: log(msg, level, sid=sid, docsel=key, status=cherrypy.response.status, duration=time.time() - begintime))
+
+    def setsession(self,namespace,docid, sid=None, changes=()):
+        """Create or update a session, the changes made by this session (see flat.getchanges()) are queued for the others"""
         if sid != 'NOSID':
-            log("Creating session " + sid + " for " + "/".join((namespace,docid)))
+            log("Creating session " + sid + " for " + "/".join((namespace,docid)), DEBUG)
             self.docstore.lastaccess[(namespace,docid)][sid] = time.time()
             # v-- will create it if it does not exist yet, does nothing otherwise, other sessions will write here what we need to update
             self.docstore.updateq[(namespace,docid)][sid] #pylint: disable=pointless-statement
-            #update the queue for other sessions with the results we just obtained for this one
-            for othersid in self.docstore.updateq[(namespace,docid)]:
-                if othersid != sid:
-                    for queryresults in results: #results are grouped per query, we don't care about that here though
-                        for result in queryresults:
-                            if result.id:
-                                self.docstore.updateq[(namespace,docid)][othersid].add(result.id)
+            #update the queue for other sessions with the changes we just made in this one
+            if changes:
+                for othersid in self.docstore.updateq[(namespace,docid)]:
+                    if othersid != sid:
+                        self.docstore.updateq[(namespace,docid)][othersid].update(changes)
 
     def addtochangelog(self, doc, query, docselector):
         if self.docstore.git:
@@ -543,6 +1761,17 @@ class Root:
         else:
             sid = 'NOSID'
 
+        if 'continuation' in kwargs:
+            return self.resume(kwargs['continuation'], sid)
+        if 'cursor' in kwargs:
+            try:
+                page = int(kwargs['page']) if 'page' in kwargs else 0
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Expected a page number")
+            if page < 0:
+                raise cherrypy.HTTPError(400, "Expected a page number")
+            return self.page(kwargs['cursor'], sid, kwargs['start'] if 'start' in kwargs else None, page)
+
         if 'query' in kwargs:
             rawqueries = kwargs['query'].split("\n")
         else:
@@ -551,13 +1780,26 @@ class Root:
 
         if self.debug:
             for i,rawquery in enumerate(rawqueries):
-                log("[QUERY INCOMING #" + str(i+1) + ", SID=" +sid + "] " + rawquery)
+                log("[QUERY INCOMING #" + str(i+1) + ", SID=" +sid + "] " + rawquery, DEBUG)
+
+        try:
+            querydocsel = getdocumentselector(rawqueries[0])[0]
+        except fql.SyntaxError:
+            querydocsel = None #syntax error will be reported later
+        self.admit(querydocsel)
+        self.logduration("[QUERY DONE]", sid, querydocsel)
 
         #Get parameters for FLAT-specific return format
-        flatargs = getflatargs(cherrypy.request.params)
+        try:
+            flatargs = getflatargs(cherrypy.request.params)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Invalid parameters for FLAT output")
         flatargs['debug'] = self.debug
         flatargs['logfunction'] = log
         flatargs['version'] = VERSION
+        slicesize = flatargs.get('customslicesize') or CUSTOMSLICESIZE #results per page of a search result, as rendered by parseresults()
+        if slicesize < 0:
+            raise cherrypy.HTTPError(400, "Invalid parameters for FLAT output")
 
         prevdocsel = None
         sessiondocsel = None
@@ -568,8 +1810,6 @@ class Root:
                 docsel, rawquery = getdocumentselector(rawquery)
                 rawquery = rawquery.replace("$FOLIADOCSERVE_PROCESSOR", PROCESSOR_FOLIADOCSERVE)
                 if not docsel: docsel = prevdocsel
-                self.docstore.use(docsel)
-                if self.debug >= 2: log("[acquired lock " + "/".join(docsel)+"]")
                 if not sessiondocsel: sessiondocsel = docsel
                 if rawquery == "GET":
                     query = "GET"
@@ -598,132 +1838,230 @@ class Root:
                         metachanges[key] = value
                         query = None
                     else:
-                        query = fql.Query(rawquery)
+                        query = self.planner.plan(rawquery)
                     if query and query.format == "python":
                         query.format = "xml"
                     if query and query.action and not docsel:
                         raise fql.SyntaxError("Document Server requires USE statement prior to FQL query")
             except fql.SyntaxError as e:
-                log("[QUERY ON " + "/".join(docsel)  + "] " + str(rawquery))
-                log("[QUERY FAILED] FQL Syntax Error: " + str(e))
+                log("[QUERY ON " + "/".join(docsel)  + "] " + str(rawquery), sid=sid)
+                log("[QUERY FAILED] FQL Syntax Error: " + str(e), WARNING)
                 raise cherrypy.HTTPError(404, "FQL syntax error: " + str(e))
-            finally:
-                if self.debug >= 2: log("[releasing lock " + "/".join(docsel))
-                self.docstore.done(docsel)
 
             if query:
                 queries.append( (query, rawquery))
             prevdocsel = docsel
 
 
-        if metachanges:
-            try:
-                doc = self.docstore[docsel]
-            except NoSuchDocument:
-                log("[QUERY FAILED] No such document")
-                raise cherrypy.HTTPError(404, "Document not found: " + docsel[0] + "/" + docsel[1])
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
-                print("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e), file=sys.stderr)
-                log("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e))
-                if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
-                raise cherrypy.HTTPError(404, "FoLiA error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e) + "\n\nQuery was: " + rawquery)
-
-            if doc.metadatatype == "native":
-                doc.changed = True
-                self.docstore.lastaccess[docsel][sid] = time.time()
-                log("[METADATA EDIT ON " + "/".join(docsel)  + "]")
-                for key, value in metachanges.items():
-                    if value == 'NONE':
-                        del doc.metadata[key]
-                    else:
-                        doc.metadata[key] = value
+        if docsel and len(queries) == 1 and queries[0][0] == "GET" and not metachanges and docsel[0] != "testflat":
+            if docsel not in self.docstore:
+                #document is not loaded so has no pending edits, serve it straight from disk without parsing
+                etag = self.docstore.getfileetag(docsel)
+                if etag is None:
+                    log("[QUERY FAILED] No such document", WARNING)
+                    raise cherrypy.HTTPError(404, "Document not found: " + docsel[0] + "/" + docsel[1])
+                log("[QUERY ON " + "/".join(docsel)  + "] GET (from disk)", sid=sid)
+                filename = self.docstore.getfilename(docsel)
+                encoding = negotiateencoding()
+                if getcompression(filename) and encoding and CONTENTENCODING2COMPRESSION[encoding] == getcompression(filename):
+                    #the client accepts the compression the document is stored in, send it as is
+                    checketag(etagvariant(etag, encoding))
+                    cherrypy.response.headers['Content-Encoding'] = encoding
+                    cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+                    return cherrypy.lib.static.serve_file(filename, content_type='text/xml')
+                checketag(etag)
+                if getcompression(filename):
+                    cherrypy.response.headers['Content-Type']= 'text/xml'
+                    return readfile(filename)
+                else:
+                    return cherrypy.lib.static.serve_file(filename, content_type='text/xml')
             else:
-                raise cherrypy.HTTPError(404, "Unable to edit metadata on document with non-native metadata type (" + "/".join(docsel)+")")
-        else:
-            doc = None #initialize document only if not already initialized by metadta changes
-
-
-        results = [] #stores all results
-        xresults = [] #stores results that should be transferred to other sessions as well, i.e. results of adds/edits
-        prevdocid = None
-        multidoc = False #are the queries over multiple distinct documents?
-        format = None
-        for query, rawquery in queries:
+                cachedxml = self.docstore.getcachedxml(docsel)
+                if cachedxml is not None:
+                    etag = cachedxml[0]
+                else:
+                    doc, _ = self.docstore.pin(docsel)
+                    try:
+                        etag, _ = self.docstore.getxml(docsel, doc)
+                    finally:
+                        self.docstore.unpin(docsel, doc)
+                checketag(etag)
+
+        if self.prerendered and docsel and len(queries) == 1 and not metachanges and (queries[0][0] == "PROBE" or (isinstance(queries[0][0], (fql.Query, IdQuery)) and queries[0][0].format == "flat" and (not queries[0][0].action or queries[0][0].action.action == "SELECT"))):
+            filename = self.docstore.getprerendered(docsel, queries[0][1], flatargs)
+            if filename:
+                #viewing an unmodified document, serve the rendering made in advance without parsing the document
+                log("[QUERY ON " + "/".join(docsel)  + "] " + queries[0][1] + " (prerendered)", sid=sid)
+                self.setsession(docsel[0], docsel[1], sid, [])
+                cherrypy.response.headers['Content-Type']= 'application/json'
+                encoding = negotiateencoding()
+                if encoding and CONTENTENCODING2COMPRESSION[encoding] == 'gz':
+                    cherrypy.response.headers['Content-Encoding'] = encoding
+                    cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+                    return cherrypy.lib.static.serve_file(filename, content_type='application/json')
+                return readfile(filename, 'gz')
+
+        #edits are executed with the document locked, after checking that the document is still at the version the client
+        #expects (if specified); if other requests are still reading the document, the edits are made on a copy (see DocStore.detach).
+        #Results are searched and rendered from a pinned version of the document, without holding the lock
+        editing = bool(docsel) and (bool(metachanges) or any( isinstance(query, (fql.Query, IdQuery)) and query.action and query.action.action != "SELECT" for query, _ in queries ))
+        reading = None #the document version results are obtained and rendered from, pinned so edits by others do not change it
+        docversion = None
+        try:
+            if editing:
+                self.docstore.use(docsel)
             try:
-                doc = self.docstore[docsel]
-                self.docstore.lastaccess[docsel][sid] = time.time()
-                log("[QUERY ON " + "/".join(docsel)  + "] " + str(rawquery))
-                if isinstance(query, fql.Query):
-                    if prevdocid and doc.id != prevdocid:
-                        multidoc = True
-                    result =  query(doc,False,self.debug >= 2)
-                    results.append(result) #False = nowrap
-                    if query.action and query.action.action in ('EDIT','ADD','DELETE', 'SUBSTITUTE','PREPEND','APPEND'):
-                        #results of edits should be transferred to other open sessions
-                        xresults.append(result)
-                    if self.debug:
-                        log("[QUERY RESULT] " + repr(result))
-                    format = query.format
-                    if query.action and query.action.action != "SELECT":
-                        doc.changed = True
-                        self.addtochangelog(doc, query, docsel)
-                elif query == "GET":
-                    results.append(doc.xmlstring())
-                    format = "single-xml"
-                elif query == "PROBE":
-                    #no queries to perform
-                    format = "flat"
+                if editing:
+                    expectedversion = getexpectedversion(kwargs)
+                    if expectedversion is not None and expectedversion != self.docstore.getversion(docsel):
+                        log("[QUERY REJECTED] Document was changed since version " + str(expectedversion), WARNING, sid=sid, docsel=docsel)
+                        cherrypy.response.status = 409
+                        cherrypy.response.headers['Content-Type'] = 'application/json'
+                        return dumps({'version': VERSION, 'conflict': True, 'docversion': self.docstore.getversion(docsel)})
+                    self.docstore.detach(docsel)
+                if metachanges:
+                    try:
+                        doc = self.docstore[docsel]
+                    except NoSuchDocument:
+                        log("[QUERY FAILED] No such document", WARNING)
+                        raise cherrypy.HTTPError(404, "Document not found: " + docsel[0] + "/" + docsel[1])
+                    except Exception as e:
+                        exc_type, exc_value, exc_traceback = sys.exc_info()
+                        traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
+                        print("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e), file=sys.stderr)
+                        log("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e), WARNING)
+                        logtraceback(exc_traceback)
+                        raise cherrypy.HTTPError(404, "FoLiA error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e) + "\n\nQuery was: " + rawquery)
+
+                    if doc.metadatatype == "native":
+                        self.docstore.markchanged(docsel, metadata=True)
+                        self.docstore.lastaccess[docsel][sid] = time.time()
+                        log("[METADATA EDIT ON " + "/".join(docsel)  + "]")
+                        for key, value in metachanges.items():
+                            if value == 'NONE':
+                                del doc.metadata[key]
+                            else:
+                                doc.metadata[key] = value
+                        self.docstore.invalidatefragments(docsel, 'metadata')
+                    else:
+                        raise cherrypy.HTTPError(404, "Unable to edit metadata on document with non-native metadata type (" + "/".join(docsel)+")")
                 else:
-                    raise Exception("Invalid query")
-            except NoSuchDocument:
-                if self.docstore.fail and not self.docstore.ignorefail:
-                    log("[QUERY FAILED] Document server is in lockdown due to earlier failure. Restart required!")
-                    raise cherrypy.HTTPError(403, "Document server is in lockdown due to earlier failure. Contact your FLAT administrator")
+                    doc = None #initialize document only if not already initialized by metadta changes
+
+
+                results = [] #stores all results
+                changes = set() #stores what the edits changed, to be transferred to other sessions as well (see flat.getchanges())
+                prevdocid = None
+                multidoc = False #are the queries over multiple distinct documents?
+                format = None
+                cursorid = None #server-side cursor for (the last) search result
+                for query, rawquery in queries:
+                    try:
+                        cachedxml = self.docstore.getcachedxml(docsel) if query == "GET" and not editing and reading is None else None
+                        if not editing and reading is None and cachedxml is None:
+                            reading, docversion = self.docstore.pin(docsel)
+                        doc = reading if reading is not None else self.docstore[docsel]
+                        self.docstore.lastaccess[docsel][sid] = time.time()
+                        log("[QUERY ON " + "/".join(docsel)  + "] " + str(rawquery), sid=sid)
+                        if isinstance(query, (fql.Query, IdQuery)):
+                            if prevdocid and doc.id != prevdocid:
+                                multidoc = True
+                            result = None
+                            searchquery = query.format == "flat" and (not query.action or query.action.action == "SELECT") and not isinstance(query, IdQuery) #a single element needs no cursor
+                            if searchquery:
+                                #same search by the same session on an unchanged document? Then we can reuse the results
+                                cursorid = self.docstore.findcursor(docsel, sid, rawquery, slicesize)
+                                if cursorid:
+                                    result = self.docstore.resolvecursor(self.docstore.getcursor(cursorid)[2], doc)
+                                    if result is not None:
+                                        log("[QUERY RESULT FROM CURSOR " + cursorid + "]")
+                            if result is None:
+                                result =  query(doc,False,self.debug >= 2)
+                                if searchquery:
+                                    cursorid = self.docstore.addcursor(docsel, sid, rawquery, result, doc, slicesize)
+                            results.append(result) #False = nowrap
+                            if self.debug:
+                                log("[QUERY RESULT] " + repr(result), DEBUG)
+                            format = query.format
+                            if query.action and query.action.action != "SELECT":
+                                querychanges = self.docstore.markchanged(docsel, result, query=query)
+                                if querychanges:
+                                    changes.update(querychanges)
+                                self.docstore.updatewordorder(docsel, result)
+                                self.docstore.updatetokentable(docsel, result)
+                                self.addtochangelog(doc, query, docsel)
+                        elif query == "GET":
+                            if cachedxml is not None:
+                                etag, xml, docversion = cachedxml #no need to pin the document
+                            else:
+                                etag, xml = self.docstore.getxml(docsel, doc)
+                            results.append(xml)
+                            format = "single-xml"
+                        elif query == "PROBE":
+                            #no queries to perform
+                            format = "flat"
+                        else:
+                            raise Exception("Invalid query")
+                    except NoSuchDocument:
+                        if self.docstore.fail and not self.docstore.ignorefail:
+                            log("[QUERY FAILED] Document server is in lockdown due to earlier failure. Restart required!", WARNING)
+                            raise cherrypy.HTTPError(403, "Document server is in lockdown due to earlier failure. Contact your FLAT administrator")
+                        else:
+                            log("[QUERY FAILED] No such document", WARNING)
+                            raise cherrypy.HTTPError(404, "Document not found: " + docsel[0] + "/" + docsel[1])
+                    except fql.QueryError as e:
+                        log("[QUERY FAILED] FQL Query Error: " + str(e), WARNING)
+                        raise cherrypy.HTTPError(404, "FQL query error: " + str(e))
+                    except Exception as e:
+                        exc_type, exc_value, exc_traceback = sys.exc_info()
+                        traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
+                        log("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e), WARNING)
+                        print("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e), file=sys.stderr)
+                        logtraceback(exc_traceback)
+                        raise cherrypy.HTTPError(404, "FoLiA error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e) + "\n\nQuery was: " + rawquery)
+                    prevdocid = doc.id
+                if editing:
+                    reading, docversion = self.docstore.pin(docsel) #still locked, so this is exactly the version the edits produced
+            finally:
+                if editing:
+                    self.docstore.done(docsel)
+            if docversion is not None:
+                cherrypy.response.headers['X-Docversion'] = str(docversion)
+
+            if not format:
+                if metachanges:
+                    return dumps({'version': VERSION, 'docversion': docversion})
                 else:
-                    log("[QUERY FAILED] No such document")
-                    raise cherrypy.HTTPError(404, "Document not found: " + docsel[0] + "/" + docsel[1])
-            except fql.QueryError as e:
-                log("[QUERY FAILED] FQL Query Error: " + str(e))
-                raise cherrypy.HTTPError(404, "FQL query error: " + str(e))
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
-                log("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e))
-                print("[QUERY FAILED] FoLiA Error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e), file=sys.stderr)
-                if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
-                raise cherrypy.HTTPError(404, "FoLiA error in " + "/".join(docsel) + ": [" + e.__class__.__name__ + "] " + str(e) + "\n\nQuery was: " + rawquery)
-            prevdocid = doc.id
-
-        if not format:
-            if metachanges:
-                return "{\"version\":\"" + VERSION + "\"}"
+                    raise cherrypy.HTTPError(404, "No queries given")
+            if format.endswith('xml'):
+                cherrypy.response.headers['Content-Type']= 'text/xml'
+            elif format.endswith('json'):
+                cherrypy.response.headers['Content-Type']= 'application/json'
+
+
+            if format == "xml":
+                out = "<results>" + "\n".join(results) + "</results>"
+            elif format == "json":
+                out = "[" + ",".join(results) + "]"
+            elif format == "flat":
+                if sid != 'NOSID' and sessiondocsel:
+                    self.setsession(sessiondocsel[0],sessiondocsel[1],sid, changes)
+                cherrypy.response.headers['Content-Type']= 'application/json'
+                if multidoc:
+                    raise "{\"version\":\""+VERSION +"\"} //multidoc response, not producing results"
+                elif doc:
+                    log("[Parsing results for FLAT]", DEBUG)
+                    if docsel[0] != "testflat":
+                        flatargs['continuation'] = lambda remainder: self.docstore.addcontinuation(docsel, remainder, rawqueries)
+                    flatargs['cursor'] = cursorid
+                    out = self.docstore.render(docsel, doc, results, docversion=docversion, **flatargs)
             else:
-                raise cherrypy.HTTPError(404, "No queries given")
-        if format.endswith('xml'):
-            cherrypy.response.headers['Content-Type']= 'text/xml'
-        elif format.endswith('json'):
-            cherrypy.response.headers['Content-Type']= 'application/json'
-
-
-        if format == "xml":
-            out = "<results>" + "\n".join(results) + "</results>"
-        elif format == "json":
-            out = "[" + ",".join(results) + "]"
-        elif format == "flat":
-            if sid != 'NOSID' and sessiondocsel:
-                self.setsession(sessiondocsel[0],sessiondocsel[1],sid, xresults)
-            cherrypy.response.headers['Content-Type']= 'application/json'
-            if multidoc:
-                raise "{\"version\":\""+VERSION +"\"} //multidoc response, not producing results"
-            elif doc:
-                log("[Parsing results for FLAT]")
-                out =  parseresults(results, doc, **flatargs)
-        else:
-            if len(results) > 1:
-                raise cherrypy.HTTPError(404, "Multiple results were obtained but format dictates only one can be returned!")
-            out = results[0]
+                if len(results) > 1:
+                    raise cherrypy.HTTPError(404, "Multiple results were obtained but format dictates only one can be returned!")
+                out = results[0]
+        finally:
+            if reading is not None:
+                self.docstore.unpin(docsel, reading)
 
 
         if docsel[0] == "testflat":
@@ -732,11 +2070,11 @@ class Root:
 
 
             if format == "flat":
-                out = json.loads(str(out,'utf-8'))
+                out = json.loads(out)
                 out['testresult'] = testresult[0]
                 out['testmessage'] = testresult[1]
                 out['queries'] = rawqueries
-                out = json.dumps(out)
+                out = dumps(out)
 
             #unload the document, we want a fresh copy every time
             del self.docstore.data[('testflat','testflat')]
@@ -753,6 +2091,84 @@ class Root:
             return out
 
 
+    def resume(self, token, sid):
+        """Resumes rendering a FLAT result that was truncated at ELEMENTLIMIT, given the continuation token from the previous response"""
+        try:
+            key, remainder = self.docstore.getcontinuation(token)
+        except KeyError:
+            raise cherrypy.HTTPError(410, "Continuation token is unknown or expired, please reissue the query")
+        except ValueError:
+            raise cherrypy.HTTPError(409, "Document was changed since the continuation token was issued, please reissue the query")
+        self.admit(key)
+        log("[RESUMING FLAT RESULT ON " + "/".join(key)  + " AT " + str(remainder[0].id) + "]")
+        flatargs = getflatargs(cherrypy.request.params)
+        flatargs['debug'] = self.debug
+        flatargs['logfunction'] = log
+        flatargs['version'] = VERSION
+        flatargs['continuation'] = lambda remainder: self.docstore.addcontinuation(key, remainder, [token])
+        doc, _ = self.docstore.pin(key)
+        try:
+            if remainder[0].doc is not doc:
+                raise cherrypy.HTTPError(409, "Document was changed since the continuation token was issued, please reissue the query")
+            self.docstore.lastaccess[key][sid] = time.time()
+            out = self.docstore.render(key, doc, [remainder], **flatargs)
+        finally:
+            self.docstore.unpin(key, doc)
+        cherrypy.response.headers['Content-Type']= 'application/json'
+        return out
+
+    def page(self, cursorid, sid, start=None, page=0):
+        """Renders a single page (custom slice) of a search result from a server-side cursor, starting at the specified element ID (as listed in customslices) or page number"""
+        try:
+            key, cursorsid, ids, slicesize = self.docstore.getcursor(cursorid)
+        except KeyError:
+            raise cherrypy.HTTPError(410, "Cursor is unknown or expired (the document may have been changed), please reissue the query")
+        if cursorsid != sid:
+            raise cherrypy.HTTPError(410, "Cursor belongs to another session, please reissue the query")
+        self.admit(key)
+        firstids = [ id[0] if isinstance(id, tuple) else id for id in ids ]
+        if start:
+            try:
+                begin = firstids.index(start)
+            except ValueError:
+                raise cherrypy.HTTPError(404, "Element " + start + " is not in the result set of cursor " + cursorid)
+        else:
+            begin = page * slicesize
+        log("[RENDERING PAGE OF CURSOR " + cursorid + " ON " + "/".join(key)  + " FROM RESULT " + str(begin) + "]")
+        flatargs = getflatargs(cherrypy.request.params)
+        flatargs['debug'] = self.debug
+        flatargs['logfunction'] = log
+        flatargs['version'] = VERSION
+        flatargs['cursor'] = cursorid
+        flatargs['customslices'] = firstids[::slicesize]
+        flatargs['continuation'] = lambda remainder: self.docstore.addcontinuation(key, remainder, [cursorid])
+        doc, _ = self.docstore.pin(key)
+        try:
+            self.docstore.lastaccess[key][sid] = time.time()
+            results = self.docstore.resolvecursor(ids[begin:begin+slicesize], doc)
+            if results is None:
+                raise cherrypy.HTTPError(410, "Cursor is no longer valid, please reissue the query")
+            out = self.docstore.render(key, doc, [results], **flatargs)
+        finally:
+            self.docstore.unpin(key, doc)
+        cherrypy.response.headers['Content-Type']= 'application/json'
+        return out
+
+    @cherrypy.expose
+    def stats(self):
+        """Returns statistics on caches and load"""
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return dumps({
+            'version': VERSION,
+            'loaded': len(self.docstore),
+            'admission': {'active': self.admission.activecount, 'waiting': self.admission.queuedcount, 'admitted': self.admission.admitted, 'rejected': self.admission.rejected},
+            'setdefinitions': self.docstore.setdefinitions.stats(),
+            'cursors': {'count': len(self.docstore.cursors), 'ids': self.docstore.cursorids},
+            'readers': {'documents': len(self.docstore.readers), 'replaced': len(self.docstore.detached)},
+            'planner': self.planner.stats(),
+            'log': logger.stats() if logger else None,
+        })
+
     @cherrypy.expose
     def index(self):
         template = env.get_template('index.html')
@@ -760,32 +2176,27 @@ class Root:
 
 
     @cherrypy.expose
-    def getdochistory(self, *args):
+    def getdochistory(self, *args, limit=None, before=None):
         namespace, docid = self.docselector(*args)
         log("Returning history for document " + "/".join((namespace,docid)))
         cherrypy.response.headers['Content-Type'] = 'application/json'
-        if not os.path.exists(self.docstore.getfilename((namespace,docid))):
+        filename = self.docstore.getfilename((namespace,docid))
+        if not os.path.exists(filename):
             raise cherrypy.HTTPError(404, "Document not found")
         if self.docstore.git:
-            log("Invoking git log " + namespace+"/"+docid + ".folia.xml")
-            if os.path.exists(self.workdir + '/.git'):
-                dir = self.workdir
-            else:
-                dir = self.docstore.getpath((namespace,docid))
-            os.chdir(dir)
-            proc = subprocess.Popen("git log " + docid + ".folia.xml", stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=True,cwd=dir)
-            outs, errs = proc.communicate()
-            if errs: log("git log errors? " + errs.decode('utf-8'))
-            d = {'history':[], 'version': VERSION}
-            count = 0
-            for commit, date, msg in parsegitlog(outs.decode('utf-8')):
-                count += 1
-                d['history'].append( {'commit': commit, 'date': date, 'msg':msg})
-            if count == 0: log("git log output: " + outs.decode('utf-8'))
-            log(str(count) + " revisions found - " + errs.decode('utf-8'))
-            return json.dumps(d).encode('utf-8')
+            try:
+                limit = int(limit) if limit else None
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Expected a number for limit")
+            if before is not None and (not before or not before.isalnum()):
+                raise cherrypy.HTTPError(400, "Expected a commit hash for before")
+            try:
+                history, more = self.docstore.gethistory((namespace,docid), limit, before)
+            except KeyError:
+                raise cherrypy.HTTPError(404, "Commit not found in history: " + before)
+            return dumps({'history': history, 'more': more, 'version': VERSION})
         else:
-            return json.dumps({'history': [], 'version': VERSION}).encode('utf-8')
+            return dumps({'history': [], 'version': VERSION})
 
     @cherrypy.expose
     def save(self, *args, message=""):
@@ -794,9 +2205,9 @@ class Root:
         if (namespace,docid) in self.docstore:
             #self.bgtask.put( self.docstore.save, (namespace,docid), message)
             self.docstore.save( (namespace,docid), message)
-            return b"{\"saved\":1, \"version\": \"" + VERSION.encode('utf-8')+ "\"}"
+            return dumps({'saved': 1, 'version': VERSION})
         else:
-            return b"{\"saved\":0, \"version\": \"" + VERSION.encode('utf-8')+ "\"}"
+            return dumps({'saved': 0, 'version': VERSION})
 
 
     @cherrypy.expose
@@ -805,25 +2216,22 @@ class Root:
             raise cherrypy.HTTPError(400, "Expected commithash")
 
         if not all([ x.isalnum() for x in commithash ]):
-            return b"{\"version\": \"" + VERSION.encode('utf-8')+ "\"}"
+            return b"{\"version\": \"" + VERSION.encode('utf-8')+ b"\"}"
 
         cherrypy.response.headers['Content-Type'] = 'application/json'
         if self.docstore.git:
             namespace, docid = self.docselector(*args)
             key = (namespace,docid)
-            os.chdir(os.path.join(self.workdir,namespace))
-
-            if key in self.docstore:
-                #unload document (will even still save it if not done yet, cause we need a clean workdir)
-                self.docstore.unload(key)
-
-            log("Doing git revert for " + self.docstore.getfilename(key) )
-            r = os.system("git checkout " + commithash + " " + self.docstore.getfilename(key) + " && git commit -m \"Reverting to commit " + commithash + "\"")
-            if r != 0:
-                log("Error during git revert of " + self.docstore.getfilename(key))
-            return b"{\"version\": \"" + VERSION.encode('utf-8')+ "\"}"
+            if not os.path.exists(self.docstore.getfilename(key)):
+                raise cherrypy.HTTPError(404, "Document not found")
+            try:
+                message = self.docstore.revert(key, commithash)
+            except KeyError:
+                raise cherrypy.HTTPError(404, "Document not found at commit " + commithash)
+            self.bgtask.put(self.docstore.save, key) #commits with the message in the changelog
+            return dumps({'reverted': commithash, 'message': message, 'version': VERSION})
         else:
-            return b"{\"version\": \"" + VERSION.encode('utf-8')+ "\"}"
+            return b"{\"version\": \"" + VERSION.encode('utf-8')+ b"\"}"
 
 
 
@@ -862,7 +2270,8 @@ class Root:
 
 
     @cherrypy.expose
-    def poll(self, *args):
+    def poll(self, *args, **kwargs):
+        """Returns the changes made by other sessions, as full FLAT results or, if the delta parameter is set, as compact deltas (see flat.parsedelta)"""
         namespace, docid = self.docselector(*args)
 
         if 'X-Sessionid' in cherrypy.request.headers:
@@ -870,27 +2279,55 @@ class Root:
         else:
             raise cherrypy.HTTPError(404, "Expected X-Sessionid " + namespace + "/" + docid)
 
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+
+        self.admit((namespace,docid))
+        self.logduration("[POLL DONE]", sid, (namespace,docid), DEBUG)
+
         #set last access
-        log("Poll from session " + sid + " for " + "/".join((namespace,docid)))
+        log("Poll from session " + sid + " for " + "/".join((namespace,docid)), DEBUG)
         self.docstore.lastaccess[(namespace,docid)][sid] = time.time()
 
         if namespace == "testflat":
-            return "{\"version\":\""+VERSION+"\"}" #no polling for testflat
+            return dumps({'version': VERSION}) #no polling for testflat
 
         self.checkexpireconcurrency()
 
-        if sid in self.docstore.updateq[(namespace,docid)]:
-            ids = self.docstore.updateq[(namespace,docid)][sid]
-            self.docstore.updateq[(namespace,docid)][sid] = set() #reset
-            if ids:
-                cherrypy.log("Successful poll from session " + sid + " for " + "/".join((namespace,docid)) + ", returning IDs: " + " ".join(ids))
-                doc = self.docstore[(namespace,docid)]
+        key = (namespace,docid)
+        metadata = False
+        if 'since' in kwargs:
+            #sync everything that changed since the version the client has
+            try:
+                since = int(kwargs['since'])
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Expected a version for since")
+            docversion, ids, metadata = self.docstore.getchanges(key, since)
+            self.docstore.updateq[key][sid] = set() #covered by this sync
+            if ids is None:
+                log("Poll from session " + sid + " for " + "/".join(key) + " since version " + str(since) + " requires a reload", DEBUG)
+                return dumps({'version': VERSION, 'reload': True, 'docversion': docversion, 'sessions': len([s for s in self.docstore.lastaccess[key] if s != 'NOSID' ])})
+        elif sid in self.docstore.updateq[key]:
+            docversion = self.docstore.getversion(key) #obtained before the queue, so it never claims more than is returned
+            ids = self.docstore.updateq[key][sid]
+            self.docstore.updateq[key][sid] = set() #reset
+        else:
+            docversion = self.docstore.getversion(key)
+            ids = set()
+        if ids or metadata:
+            cherrypy.log("Successful poll from session " + sid + " for " + "/".join(key) + ", returning IDs: " + " ".join(sorted( "/".join(change) if isinstance(change, tuple) else change for change in ids)))
+            #polls only render what changed, they hold the lock rather than pinning the document (which would make a concurrent edit copy it)
+            self.docstore.use(key)
+            try:
+                doc = self.docstore[key]
+                if 'delta' in kwargs and kwargs['delta'] not in ('0','') and not metadata:
+                    return parsedelta(ids, doc, **{'version': VERSION, 'docversion': docversion, 'lastaccess': self.docstore.lastaccess[key], 'debug': self.debug, 'logfunction': log, 'wordorder': self.docstore.getwordorder(key, doc)})
+                ids = { change[0] if isinstance(change, tuple) else change for change in ids } #changed annotations are rendered as part of their structure element
                 results = [[ doc[id] for id in ids if id in doc ]] #results are grouped by query, but we lose that distinction here and group them all in one, hence the double list
-                return parseresults(results, doc, **{'version': VERSION, 'sid':sid, 'lastaccess': self.docstore.lastaccess[(namespace,docid)]})
-            else:
-                return json.dumps({'sessions': len([s for s in self.docstore.lastaccess[(namespace,docid)] if s != 'NOSID' ])}).encode('utf-8')
+                return parseresults(results, doc, **{'version': VERSION, 'docversion': docversion, 'metadata': metadata, 'sid':sid, 'lastaccess': self.docstore.lastaccess[key], 'wordorder': self.docstore.getwordorder(key, doc)})
+            finally:
+                self.docstore.done(key)
         else:
-            return json.dumps({'sessions': len([s for s in self.docstore.lastaccess[(namespace,docid)] if s != 'NOSID' ])}).encode('utf-8')
+            return dumps({'sessions': len([s for s in self.docstore.lastaccess[key] if s != 'NOSID' ]), 'docversion': docversion})
 
     def listdir(self, rootdir, output):
         for d in os.listdir(os.path.join(self.docstore.workdir,rootdir)):
@@ -907,7 +2344,8 @@ class Root:
             self.listdir(rootdir, namespaces)
         except FileNotFoundError:
             raise cherrypy.HTTPError(404, "Namespace not found: " + str(rootdir))
-        return json.dumps({
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return dumps({
             'namespaces': namespaces
         })
 
@@ -915,16 +2353,56 @@ class Root:
     def documents(self, *namespaceargs):
         namespace = validatenamespace('/'.join(namespaceargs))
         try:
-            docs = [ x for x in os.listdir(self.docstore.workdir + "/" + namespace) if x[-10:] == ".folia.xml" ]
+            stat = os.stat(self.docstore.workdir + "/" + namespace)
+        except FileNotFoundError:
+            raise cherrypy.HTTPError(404, "Namespace not found: " + str(namespace))
+        #documents are saved through a rename, so any change is reflected in the directory's modification time
+        checketag("\"d" + format(stat.st_ino, 'x') + "-" + format(stat.st_mtime_ns, 'x') + "\"")
+        try:
+            files = { stripextension(x) + ".folia.xml": x for x in os.listdir(self.docstore.workdir + "/" + namespace) if isfoliafile(x) } #documents are always reported with the .folia.xml extension, regardless of compression
         except FileNotFoundError:
             raise cherrypy.HTTPError(404, "Namespace not found: " + str(namespace))
-        return json.dumps({
+        docs = list(files.keys())
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return dumps({
             'documents': docs,
-            'timestamp': { x:os.path.getmtime(self.docstore.workdir + "/" + namespace + "/"+ x) for x in docs  },
-            'filesize': { x:os.path.getsize(self.docstore.workdir + "/" + namespace + "/"+ x) for x in docs  }
+            'timestamp': { x:os.path.getmtime(self.docstore.workdir + "/" + namespace + "/"+ files[x]) for x in docs  },
+            'filesize': { x:os.path.getsize(self.docstore.workdir + "/" + namespace + "/"+ files[x]) for x in docs  },
+            'compression': { x:getcompression(files[x]) for x in docs  }
         })
 
 
+    @cherrypy.expose
+    def export(self, *args, **params):
+        """Streams the token annotations of a namespace (all documents in it) or of a single document as a zip archive of
+        columnar arrays (readable as .npz), see tokentable.exporttables(). Annotation layers are selected with one or more
+        annotation=<type>[:<set>] parameters (default: pos and lemma)"""
+        path = validatenamespace('/'.join(args))
+        if not path or path.split('/')[0] == "testflat":
+            raise cherrypy.HTTPError(404, "Expected namespace or namespace/docid")
+        if os.path.isdir(self.docstore.workdir + "/" + path):
+            namespace = path
+            keys = sorted( (namespace, stripextension(x)) for x in os.listdir(self.docstore.workdir + "/" + namespace) if isfoliafile(x) )
+        else:
+            key = self.docselector(*args)
+            if not os.path.exists(self.docstore.getfilename(key)):
+                raise cherrypy.HTTPError(404, "Document not found: " + "/".join(key))
+            namespace = key[0]
+            keys = [key]
+        annotations = params.get('annotation')
+        if isinstance(annotations, str):
+            annotations = [annotations]
+        try:
+            layers = getlayers(annotations) if annotations else LAYERS
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        log("Exporting " + str(len(keys)) + " document(s) from " + namespace + ": " + ", ".join(name for name, _, _ in layers))
+        cherrypy.response.headers['Content-Type'] = 'application/zip'
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="' + path.replace('/','_') + '.npz"'
+        tables = ( (key[1], table) for key, table in self.docstore.gettokentables(keys, layers) )
+        return exporttables(tables, layers, {'version': VERSION, 'namespace': namespace})
+    export._cp_config = {'response.stream': True}
+
     @cherrypy.expose
     def upload(self, *namespaceargs):
         namespace = validatenamespace('/'.join(namespaceargs))
@@ -955,8 +2433,8 @@ class Root:
             traceback.print_tb(exc_traceback, limit=50, file=sys.stderr)
             response['error'] = "Uploaded file is no valid FoLiA Document: " + str(e) + " -- " "\n".join(formatted_lines)
             log(response['error'])
-            if logfile: traceback.print_tb(exc_traceback, limit=50, file=logfile)
-            return json.dumps(response).encode('utf-8')
+            logtraceback(exc_traceback)
+            return dumps(response)
 
         filename = self.docstore.getfilename( (namespace, doc.id))
         i = 1
@@ -964,22 +2442,50 @@ class Root:
             filename = self.docstore.getfilename( (namespace, doc.id + "." + str(i)))
             i += 1
         self.docstore.save((namespace,doc.id), "Initial upload")
-        return json.dumps(response).encode('utf-8')
+        return dumps(response)
+
+    @cherrypy.expose
+    def bulkimport(self, *namespaceargs, **params):
+        """Imports all FoLiA documents from a posted zip or tar archive into the namespace, returns a report"""
+        namespace = validatenamespace('/'.join(namespaceargs))
+        if not namespace:
+            raise cherrypy.HTTPError(404, "No namespace specified")
+        log("In bulkimport, namespace=" + namespace)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        overwrite = 'overwrite' in params and params['overwrite'] not in ('0','')
+        with tempfile.TemporaryDirectory(prefix="foliadocserve-import-") as tmpdir:
+            with tempfile.TemporaryFile() as archive:
+                shutil.copyfileobj(cherrypy.request.body, archive)
+                archive.seek(0)
+                try:
+                    filenames = extractarchive(archive, tmpdir)
+                except (tarfile.TarError, zipfile.BadZipFile) as e:
+                    raise cherrypy.HTTPError(400, "Unable to read archive (expected zip or tar): " + str(e))
+            report = self.docstore.importdocuments(namespace, list(filenames), overwrite=overwrite, allowtextredundancy=self.allowtextredundancy)
+        for failure in report['failed']:
+            if failure['file']:
+                failure['file'] = filenames[failure['file']] #report names as in the archive
+        report['version'] = VERSION
+        return dumps(report)
 
     @cherrypy.expose
     def delete(self, *args):
         namespace, docid = self.docselector(*args)
         log("Delete, namespace=" + namespace)
         self.docstore.delete((namespace,docid))
-        return "{\"version\":\""+VERSION+"\"}"
+        return dumps({'version': VERSION})
 
     @cherrypy.expose
     def copy(self, *args,**params):
         if 'target' in params:
             key = self.docselector(*args)
             newkey = self.docselector(*params['target'].split('/'))
-            self.docstore.copy(key,newkey)
-            return "{\"version\":\""+VERSION+"\"}"
+            try:
+                if not self.docstore.copy(key,newkey):
+                    raise cherrypy.HTTPError(409, "Target document already exists: " + "/".join(newkey))
+            except NoSuchDocument:
+                raise cherrypy.HTTPError(404, "Document not found: " + "/".join(key))
+            return dumps({'version': VERSION})
         else:
             raise cherrypy.HTTPError(404, "No target specified")
 
@@ -988,11 +2494,152 @@ class Root:
         if 'target' in params:
             key = self.docselector(*args)
             newkey = self.docselector(*params['target'].split('/'))
-            self.docstore.move(key,newkey)
-            return "{\"version\":\""+VERSION+"\"}"
+            try:
+                if not self.docstore.move(key,newkey):
+                    raise cherrypy.HTTPError(409, "Target document already exists: " + "/".join(newkey))
+            except NoSuchDocument:
+                raise cherrypy.HTTPError(404, "Document not found: " + "/".join(key))
+            return dumps({'version': VERSION})
         else:
             raise cherrypy.HTTPError(404, "No target specified")
 
+    @cherrypy.expose
+    def copynamespace(self, *namespaceargs, **params):
+        return self.namespaceoperation(self.docstore.copynamespace, namespaceargs, params)
+
+    @cherrypy.expose
+    def movenamespace(self, *namespaceargs, **params):
+        return self.namespaceoperation(self.docstore.movenamespace, namespaceargs, params)
+
+    def namespaceoperation(self, operation, namespaceargs, params):
+        if 'target' not in params:
+            raise cherrypy.HTTPError(404, "No target specified")
+        namespace = validatenamespace('/'.join(namespaceargs))
+        newnamespace = validatenamespace(params['target'])
+        try:
+            if not operation(namespace, newnamespace):
+                raise cherrypy.HTTPError(409, "Target namespace already exists: " + newnamespace)
+        except NoSuchDocument:
+            raise cherrypy.HTTPError(404, "Namespace not found: " + namespace)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        return dumps({'version': VERSION})
+
+def prepareimport(task):
+    """Parses, validates, upgrades and cleans a single document for bulk import and saves it to a temporary file in the
+    target directory. Runs in a worker process, returns (source filename, document ID, temporary filename, error message)"""
+    filename, targetdir, compression, allowtextredundancy = task
+    tmpfile = os.path.join(targetdir, ".import.%016x.tmp" % random.getrandbits(64))
+    try:
+        data = readfile(filename)
+        mainprocessor = folia.Processor.create(name="foliadocserve", version=VERSION, host=getfqdn(), folia_version=folia.FOLIAVERSION, src="https://github.com/proycon/foliadocserve")
+        doc = folia.Document(string=data, loadsetdefinitions=False, autodeclare=True, allowadhocsets=True, processor=mainprocessor)
+        if needsfoliaupgrade(data):
+            upgrader = folia.Processor("foliaupgrade", version=FOLIATOOLSVERSION, src="https://github.com/proycon/foliatools")
+            mainprocessor.append(upgrader)
+            upgrade(doc, upgrader)
+        if not allowtextredundancy:
+            for e in doc.data:
+                cleantextredundancy(e)
+        if not doc.id or '/' in doc.id or doc.id[0] == '.':
+            raise ValueError("Invalid document ID: " + str(doc.id))
+        savedocument(doc, tmpfile, compression)
+    except Exception as e: #pylint: disable=broad-except
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        return filename, None, None, "[" + e.__class__.__name__ + "] " + str(e)
+    return filename, doc.id, tmpfile, None
+
+prerenderstore = None #document store of a prerender worker process
+
+def initprerender(workdir, setdefinitioncachedir, setdefinitiondir):
+    """Initialises a prerender worker process"""
+    global prerenderstore, logger #pylint: disable=global-statement
+    logger = Logger(stream=sys.stderr) #the writer thread of the parent process does not exist here
+    prerenderstore = DocStore(workdir, 0, debug=False, setdefinitions=SetDefinitionCache(setdefinitioncachedir, setdefinitiondir, log=log))
+
+def prerenderdocument(task):
+    """Renders the FLAT responses for a single document in advance. Runs in a worker process, returns (key, number of renderings, saved filename, error message).
+    Documents are saved (but not committed to git) if rendering had to assign identifiers and that is allowed"""
+    key, slices, assignids = task
+    prerenderstore.lastunloadcheck = time.time() #there is no autounloader in worker processes
+    try:
+        count = prerenderstore.prerender(key, slices, assignids)
+        saved = prerenderstore.getfilename(key) if prerenderstore.data[key].changed else None
+    except Exception as e: #pylint: disable=broad-except
+        return key, 0, None, "[" + e.__class__.__name__ + "] " + str(e)
+    finally:
+        prerenderstore.unload(key, False)
+    return key, count, saved, None
+
+RENDERCACHESIZE = 4 #number of parsed snapshots kept by each render process
+
+renderdocuments = None #parsed snapshots in a render process, filename => (document, fragments, word order), least recently used first
+rendersetdefinitions = None
+
+def initrender(setdefinitioncachedir, setdefinitiondir, setdefinitionttl, encoder):
+    """Initialises a render process"""
+    global renderdocuments, rendersetdefinitions, logger #pylint: disable=global-statement
+    logger = Logger(stream=sys.stderr) #the writer thread of the parent process does not exist here
+    setencoder(encoder)
+    renderdocuments = OrderedDict()
+    rendersetdefinitions = SetDefinitionCache(setdefinitioncachedir, setdefinitiondir, setdefinitionttl, log)
+
+def renderdocument(task):
+    """Renders query results (given by their IDs) for FLAT from a snapshot of the document. Runs in a render process, returns
+    (output, IDs of the elements left for the continuation), or None if the server has to render them itself"""
+    filename, idgroups, placeholder, flatargs = task
+    try:
+        if filename in renderdocuments:
+            renderdocuments.move_to_end(filename)
+        else:
+            doc = folia.Document(string=readfile(filename), setdefinitions=rendersetdefinitions, loadsetdefinitions=True, autodeclare=True, allowadhocsets=True)
+            renderdocuments[filename] = (doc, {}, WordOrder(doc))
+            while len(renderdocuments) > RENDERCACHESIZE:
+                renderdocuments.popitem(last=False)
+        doc, fragments, wordorder = renderdocuments[filename]
+        results = [ [ fql.SpanSet(doc[x] for x in id) if isinstance(id, tuple) else doc[id] for id in ids ] for ids in idgroups ]
+    except (FileNotFoundError, KeyError):
+        return None #snapshot replaced by a newer one in the meantime
+    indexsize = len(doc.index)
+    remainder = []
+    if placeholder:
+        flatargs['continuation'] = lambda elements: remainder.extend(elements) or placeholder
+    out = parseresults(results, doc, fragments=fragments, wordorder=wordorder, logfunction=log, **flatargs)
+    if len(doc.index) != indexsize or not all(element.id for element in remainder):
+        del renderdocuments[filename] #no longer equal to the document in the server
+        return None
+    return out, [ element.id for element in remainder ]
+
+def extractarchive(archive, targetdir):
+    """Extracts the FoLiA documents from a zip or tar archive (file object) into the target directory, skipping anything
+    else (including unsafe paths). Returns a dictionary mapping extracted filenames to their names in the archive"""
+    filenames = {}
+    def gettarget(name):
+        name = os.path.normpath(name)
+        if os.path.isabs(name) or name.startswith('..') or not isfoliafile(name):
+            return None
+        return os.path.join(targetdir, "%06d-" % len(filenames) + os.path.basename(name))
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as f:
+            for info in f.infolist():
+                target = gettarget(info.filename)
+                if target and not info.is_dir():
+                    with f.open(info) as src, open(target,'wb') as dest:
+                        shutil.copyfileobj(src, dest)
+                    filenames[target] = info.filename
+    else:
+        archive.seek(0)
+        with tarfile.open(fileobj=archive, mode='r:*') as f:
+            for info in f:
+                target = gettarget(info.name)
+                if target and info.isfile():
+                    with f.extractfile(info) as src, open(target,'wb') as dest:
+                        shutil.copyfileobj(src, dest)
+                    filenames[target] = info.name
+    return filenames
+
 def needsfoliaupgrade(data):
     if isinstance(data, bytes):
         data = str(data,'utf-8')
@@ -1010,27 +2657,58 @@ def needsfoliaupgrade(data):
 
 
 def main():
-    global logfile #pylint: disable=global-statement
+    global logger #pylint: disable=global-statement
     parser = argparse.ArgumentParser(description="FoLiA Document Server - Allows querying and manipulating FoLiA documents. Do not serve publicly in production use!", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-d','--workdir', type=str,help="Work directory", action='store',required=True)
     parser.add_argument('-p','--port', type=int,help="Port", action='store',default=8080,required=False)
     parser.add_argument('-l','--logfile', type=str,help="Log file", action='store',default="foliadocserve.log",required=False)
     parser.add_argument('-D','--debug', type=int,help="Debug level", action='store',default=0,required=False)
+    parser.add_argument('--loglevel', type=str,help="Minimum level of messages to log (debug is implied by --debug)", action='store',choices=tuple(LEVELS),default='info',required=False)
+    parser.add_argument('--logbuffer', type=int,help="Maximum number of log messages waiting to be written, further messages are dropped (and counted) if the log can't keep up", action='store',default=10000,required=False)
+    parser.add_argument('--logmaxsize', type=int,help="Rotate the log file once it exceeds this size (in MB), 0 disables rotation", action='store',default=0,required=False)
+    parser.add_argument('--logbackups', type=int,help="Number of rotated log files to keep", action='store',default=5,required=False)
     parser.add_argument('--allowtextredundancy',help="Allow text redundancy (will be stripped from documents otherwise)", action='store_true',default=False)
+    parser.add_argument('--prerendered',help="Serve FLAT responses rendered in advance (by foliadocserve-prerender) for documents that are unchanged and not loaded", action='store_true',default=False)
     parser.add_argument('--git',help="Enable versioning control using git (separate git repositories will be automatically created for each namespace, OR you can make one global one in the workdir manually)", action='store_true',default=False)
     parser.add_argument('--gitshare', type=str, help="Sets the shared option when creating new git repository (git --shared). Valid values are: false|true|umask|group|all|world|everybody|0xxx, defaults to 'group'", action='store', default="group")
     parser.add_argument('--gitmode', type=str, help="Set git mode, values are: monolithic (ALL users share a single repository, NOT recommended because of scalability); user (each user/namespace is its own git repository; this is the default); nested (each subdirectory is its own git repository, maximum scalability)", action='store', default='user')
     parser.add_argument('--expirationtime', type=int,help="Expiration time in seconds, documents will be unloaded from memory after this period of inactivity", action='store',default=900,required=False)
-    parser.add_argument('--interval', type=int,help="Interval at which the unloader checks documents (in seconds)", action='store',default=60,required=False)
+    parser.add_argument('--interval', type=int,help="Maximum interval at which the unloader checks documents (in seconds), documents are normally unloaded as soon as they expire", action='store',default=60,required=False)
+    parser.add_argument('--savethreads', type=int,help="Number of threads saving and unloading documents in parallel (commits to the same git repository are still serialised)", action='store',default=4,required=False)
+    parser.add_argument('--shutdowndeadline', type=int,help="Maximum time (in seconds) to spend saving documents when the server stops, documents not saved by then lose their unsaved changes (0 = no deadline)", action='store',default=300,required=False)
     parser.add_argument('--ignorefail', help="Ignore failures when saving documents. By default, the document server will lock up and refuse to load new documents (requiring manual restart)", action='store_true',default=False,required=False)
     parser.add_argument('--host',type=str,help="Host/IP to listen for (defaults to all interfaces)", action='store',default="0.0.0.0")
+    parser.add_argument('--compression',type=str,help="Compression method for newly saved documents: " + ", ".join(COMPRESSIONS) + " (existing documents retain their compression, use foliadocserve-compress to convert them)", action='store',choices=COMPRESSIONS,default=None)
+    parser.add_argument('--setdefinitiondir', type=str,help="Directory of local set definition files (named after the last component of their URL), these are used instead of downloading the set definitions. Allows running fully offline.", action='store',default=None,required=False)
+    parser.add_argument('--setdefinitionttl', type=int,help="Time (in seconds) after which set definitions in the persistent cache (in the .setdefinitions directory in the workdir) are refreshed", action='store',default=86400,required=False)
+    parser.add_argument('--nosetdefinitioncache',help="Do not keep a persistent cache of set definitions", action='store_true',default=False)
+    parser.add_argument('--cursorttl', type=int,help="Time (in seconds) server-side cursors for search results are kept after their last use", action='store',default=900,required=False)
+    parser.add_argument('--maxcursorids', type=int,help="Maximum number of result IDs held in server-side cursors for search results (in total), 0 disables cursors", action='store',default=1000000,required=False)
+    parser.add_argument('--maxchanges', type=int,help="Number of recent changes kept per loaded document, clients polling with a version older than that need to reload the document", action='store',default=256,required=False)
+    parser.add_argument('--noplanner',help="Execute all queries through the generic FQL engine, rather than executing queries on a single element (identified by ID) directly", action='store_true',default=False)
+    parser.add_argument('--renderprocesses', type=int,help="Number of processes rendering large FLAT results, so rendering does not hold up other requests (0 = render in the request threads)", action='store',default=0,required=False)
+    parser.add_argument('--renderthreshold', type=int,help="Minimum number of structure elements in results for rendering to be done by a render process, smaller results are rendered in the request thread", action='store',default=1000,required=False)
+    parser.add_argument('--threads', type=int,help="Number of worker threads handling requests", action='store',default=16,required=False)
+    parser.add_argument('--maxconcurrent', type=int,help="Maximum number of queries/polls processed concurrently, others have to wait for admission (0 = unlimited). Keep this below --threads", action='store',default=12,required=False)
+    parser.add_argument('--maxperdocument', type=int,help="Maximum number of queries/polls processed concurrently for a single document (0 = unlimited)", action='store',default=4,required=False)
+    parser.add_argument('--maxqueue', type=int,help="Maximum number of queries/polls waiting for admission on a single document, further requests are rejected with 503. Waiting requests occupy a thread, --maxconcurrent plus --maxqueue may not exceed --threads", action='store',default=4,required=False)
+    parser.add_argument('--admissiontimeout', type=float,help="Maximum time (in seconds) a query/poll waits for admission before it is rejected with 503", action='store',default=10.0,required=False)
+    parser.add_argument('--jsonencoder', type=str,help="JSON encoder to use for responses, auto selects orjson if installed and falls back to the standard library otherwise", action='store',choices=ENCODERS,default='auto',required=False)
+    parser.add_argument('--compressthreshold', type=int,help="Responses (XML/JSON) smaller than this many bytes are never compressed for transfer", action='store',default=4096,required=False)
+    parser.add_argument('--compresslevel', type=int,help="Compression level for compressed transfer of responses (gzip" + (" or zstd" if zstandard else "") + ", as negotiated with the client), set to 0 to disable", action='store',default=6,required=False)
     args = parser.parse_args()
-    logfile = open(args.logfile,'a',encoding='utf-8')
+    logger = Logger(args.logfile, level=DEBUG if args.debug else LEVELS[args.loglevel], buffersize=args.logbuffer, maxbytes=args.logmaxsize*1024*1024, backups=args.logbackups)
     log("foliadocserve " + VERSION)
+    if args.maxconcurrent + args.maxqueue > args.threads or args.maxqueue >= args.threads:
+        log("The requests being processed (--maxconcurrent) and waiting (--maxqueue) do not fit in the thread pool (--threads), waiting requests would starve other documents", ERROR)
+        logger.close()
+        sys.exit(2)
+    setencoder(args.jsonencoder)
+    log("Using JSON encoder " + getencoder())
     try:
         args.workdir = os.path.realpath(args.workdir)
     except:
-        log("ERROR: Document root directory " + str(args.workdir) + " does not exist")
+        log("Document root directory " + str(args.workdir) + " does not exist", ERROR)
         sys.exit(2)
     os.chdir(args.workdir)
     cherrypy.config.update({
@@ -1038,17 +2716,29 @@ def main():
         'server.socket_port': args.port,
         'server.max_request_body_size' : 1024*1024*1024, #max 1GB upload (that is a lot!)
         'server.socket_timeout': 30, #30s instead of default 10s
+        'server.thread_pool': args.threads,
         'request.show_tracebacks':False,
+        'tools.compressresponse.on': args.compresslevel > 0,
+        'tools.compressresponse.threshold': args.compressthreshold,
+        'tools.compressresponse.level': args.compresslevel,
     })
     cherrypy.process.servers.wait_for_occupied_port = fake_wait_for_occupied_port
-    docstore = DocStore(args.workdir, args.expirationtime, args.git, args.gitmode, args.gitshare, args.ignorefail, args.debug)
+    setdefinitions = SetDefinitionCache(None if args.nosetdefinitioncache else os.path.join(args.workdir, '.setdefinitions'), args.setdefinitiondir, args.setdefinitionttl, log)
+    setdefinitions.preload()
+    if args.renderprocesses:
+        renderpool = concurrent.futures.ProcessPoolExecutor(max_workers=args.renderprocesses, initializer=initrender, initargs=(None if args.nosetdefinitioncache else os.path.join(args.workdir, '.setdefinitions'), args.setdefinitiondir, args.setdefinitionttl, getencoder()))
+    else:
+        renderpool = None
+    docstore = DocStore(args.workdir, args.expirationtime, args.git, args.gitmode, args.gitshare, args.ignorefail, args.debug, args.compression, setdefinitions, args.cursorttl, args.maxcursorids, args.savethreads, maxchanges=args.maxchanges, renderpool=renderpool, renderthreshold=args.renderthreshold)
     bgtask = BackgroundTaskQueue(cherrypy.engine)
     bgtask.subscribe()
-    autounloader = AutoUnloader(cherrypy.engine, docstore, args.interval)
+    autounloader = AutoUnloader(cherrypy.engine, docstore, args.interval, args.shutdowndeadline)
     autounloader.subscribe()
     def stop():
         log("Stop signal received")
-        docstore.forceunload()
+        bgtask.stop() #drains pending tasks
+        autounloader.stop() #saves and unloads all documents
+        docstore.stoprendering()
         bgtask.unsubscribe()
         autounloader.unsubscribe()
         log("Quitting")
@@ -1057,6 +2747,116 @@ def main():
     cherrypy.engine.subscribe('graceful',  docstore.forceunload)
     cherrypy.quickstart(Root(docstore,bgtask,args))
 
+def main_compress():
+    """Bulk conversion of stored documents to another compression method. Do not run this on a workdir that is being served!"""
+    global logger #pylint: disable=global-statement
+    parser = argparse.ArgumentParser(description="FoLiA Document Server - Converts all documents in the work directory (or a namespace therein) to the specified compression method", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d','--workdir', type=str,help="Work directory", action='store',required=True)
+    parser.add_argument('-c','--compression', type=str,help="Target compression method: " + ", ".join(COMPRESSIONS) + " or none", action='store',choices=COMPRESSIONS + ('none',),required=True)
+    parser.add_argument('-n','--namespace', type=str,help="Only convert documents in this namespace (and those beneath it)", action='store',default="")
+    parser.add_argument('--git',help="Commit the conversion to git (set if the document server runs with --git)", action='store_true',default=False)
+    parser.add_argument('--gitshare', type=str, help="Sets the shared option when creating new git repository (git --shared)", action='store', default="group")
+    parser.add_argument('--gitmode', type=str, help="Set git mode, values are: monolithic, user, nested (see foliadocserve --help)", action='store', default='user')
+    args = parser.parse_args()
+    logger = Logger(stream=sys.stderr)
+    workdir = os.path.realpath(args.workdir)
+    compression = None if args.compression == 'none' else args.compression
+    docstore = DocStore(workdir, 0, args.git, args.gitmode, args.gitshare, debug=False, compression=compression)
+    converted = 0
+    for root, dirs, files in os.walk(os.path.join(workdir, validatenamespace(args.namespace))):
+        dirs[:] = [ d for d in dirs if d[0] != '.' and d != 'testflat' ]
+        for filename in sorted(files):
+            if isfoliafile(filename) and getcompression(filename) != compression:
+                if docstore.convert(docstore.getkey(os.path.join(root, filename)), compression):
+                    converted += 1
+    log(str(converted) + " document(s) converted")
+
+def main_prerender():
+    """Renders the FLAT responses for viewing all documents in advance, to be served with foliadocserve --prerendered"""
+    global logger #pylint: disable=global-statement
+    parser = argparse.ArgumentParser(description="FoLiA Document Server - Renders the FLAT responses for viewing documents (declarations, metadata, table of contents and all slices) in advance, they are stored next to the documents and served by foliadocserve --prerendered as long as the document is unchanged", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d','--workdir', type=str,help="Work directory", action='store',required=True)
+    parser.add_argument('-n','--namespace', type=str,help="Only render documents in this namespace (and those beneath it)", action='store',default="")
+    parser.add_argument('-s','--slices', type=str,help="Slices as requested by FLAT, comma separated list of xmltag:slicesize", action='store',default="p:25,s:100")
+    parser.add_argument('-j','--workers', type=int,help="Number of worker processes (defaults to the number of CPUs)", action='store',default=None)
+    parser.add_argument('--force',help="Render documents again even if their renderings are up to date", action='store_true',default=False)
+    parser.add_argument('--assignids',help="Save documents in which rendering assigns identifiers to elements that have none (documents are skipped otherwise, as later edits could not refer to these elements)", action='store_true',default=False)
+    parser.add_argument('--setdefinitiondir', type=str,help="Directory of local set definition files (see foliadocserve --help)", action='store',default=None,required=False)
+    parser.add_argument('--nosetdefinitioncache',help="Do not use the persistent cache of set definitions", action='store_true',default=False)
+    parser.add_argument('--git',help="Commit documents that had identifiers assigned to git (set if the document server runs with --git)", action='store_true',default=False)
+    parser.add_argument('--gitshare', type=str, help="Sets the shared option when creating new git repository (git --shared)", action='store', default="group")
+    parser.add_argument('--gitmode', type=str, help="Set git mode, values are: monolithic, user, nested (see foliadocserve --help)", action='store', default='user')
+    args = parser.parse_args()
+    logger = Logger(stream=sys.stderr)
+    workdir = os.path.realpath(args.workdir)
+    slices = getflatargs({'slices': args.slices})['slices']
+    setdefinitioncachedir = None if args.nosetdefinitioncache else os.path.join(workdir, '.setdefinitions')
+    docstore = DocStore(workdir, 0, args.git, args.gitmode, args.gitshare, debug=False)
+    keys = []
+    for root, dirs, files in os.walk(os.path.join(workdir, validatenamespace(args.namespace))):
+        dirs[:] = sorted( d for d in dirs if d[0] != '.' and d != 'testflat' )
+        for filename in sorted(files):
+            if isfoliafile(filename):
+                key = docstore.getkey(os.path.join(root, filename))
+                if args.force or not docstore.getprerendered(key, "PROBE", getprobeargs(slices)):
+                    keys.append(key)
+    log("Rendering " + str(len(keys)) + " document(s)...")
+    rendered = failed = 0
+    saved = defaultdict(list) #namespace => filenames
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=initprerender, initargs=(workdir, setdefinitioncachedir, args.setdefinitiondir)) as pool:
+        for key, count, filename, error in pool.map(prerenderdocument, ( (key, slices, args.assignids) for key in keys )):
+            if error:
+                log("FAILED: " + "/".join(key) + ": " + error)
+                failed += 1
+            elif count:
+                log("Rendered " + "/".join(key) + " (" + str(count) + " responses)")
+                rendered += 1
+            if filename:
+                saved[key[0]].append(filename)
+    for namespace, filenames in saved.items():
+        docstore.gitcommitbatch((namespace, ''), filenames, "Assigned identifiers to " + str(len(filenames)) + " document(s)")
+    log(str(rendered) + " document(s) rendered, " + str(failed) + " failure(s)")
+    sys.exit(1 if failed else 0)
+
+def main_import():
+    """Bulk import of FoLiA documents into a namespace. Do not run this on a workdir that is being served!"""
+    global logger #pylint: disable=global-statement
+    parser = argparse.ArgumentParser(description="FoLiA Document Server - Imports FoLiA documents (files or entire directories) into a namespace of the work directory, documents are validated, upgraded and cleaned in parallel", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d','--workdir', type=str,help="Work directory", action='store',required=True)
+    parser.add_argument('-n','--namespace', type=str,help="Namespace to import the documents into", action='store',required=True)
+    parser.add_argument('-j','--workers', type=int,help="Number of worker processes (defaults to the number of CPUs)", action='store',default=None)
+    parser.add_argument('-b','--batchsize', type=int,help="Number of documents per git commit", action='store',default=1000)
+    parser.add_argument('-c','--compression', type=str,help="Compression method for the imported documents: " + ", ".join(COMPRESSIONS) + " or none", action='store',choices=COMPRESSIONS + ('none',),default='none')
+    parser.add_argument('--overwrite',help="Overwrite existing documents with the same ID", action='store_true',default=False)
+    parser.add_argument('--allowtextredundancy',help="Allow text redundancy (see foliadocserve --help)", action='store_true',default=False)
+    parser.add_argument('--report', type=str,help="Write a JSON report (including all failures) to this file", action='store',default=None)
+    parser.add_argument('--git',help="Commit the imported documents to git (set if the document server runs with --git)", action='store_true',default=False)
+    parser.add_argument('--gitshare', type=str, help="Sets the shared option when creating new git repository (git --shared)", action='store', default="group")
+    parser.add_argument('--gitmode', type=str, help="Set git mode, values are: monolithic, user, nested (see foliadocserve --help)", action='store', default='user')
+    parser.add_argument('files', nargs='+', help='FoLiA documents and/or directories containing FoLiA documents')
+    args = parser.parse_args()
+    logger = Logger(stream=sys.stderr)
+    workdir = os.path.realpath(args.workdir)
+    compression = None if args.compression == 'none' else args.compression
+    checkcompression(compression)
+    filenames = []
+    for path in args.files:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted( d for d in dirs if d[0] != '.' )
+                filenames += [ os.path.join(root, filename) for filename in sorted(files) if isfoliafile(filename) ]
+        else:
+            filenames.append(path)
+    log("Importing " + str(len(filenames)) + " document(s)...")
+    docstore = DocStore(workdir, 0, args.git, args.gitmode, args.gitshare, debug=False, compression=compression)
+    report = docstore.importdocuments(args.namespace, filenames, args.workers, args.batchsize, args.overwrite, args.allowtextredundancy)
+    for failure in report['failed']:
+        log("FAILED: " + str(failure['file']) + ": " + failure['error'])
+    if args.report:
+        with open(args.report,'wb') as f:
+            f.write(dumps(report))
+    sys.exit(1 if report['failed'] else 0)
+
 if __name__ == '__main__':
     print("foliadocserve " + VERSION,file=sys.stderr)
     main()
@@ -0,0 +1,101 @@
+#---------------------------------------------------------------
+# FoLiA Document Server - JSON encoding module
+#   by Maarten van Gompel
+#   Centre for Language & Speech Technology, Radboud University Nijmegen
+#   & KNAW Humanities Cluster
+#   http://proycon.github.io/folia
+#   http://github.com/proycon/foliadocserve
+#   proycon AT anaproy DOT nl
+#
+# The FoLiA Document Server is a backend HTTP service to interact with
+# documents in the FoLiA format, a rich XML-based format for linguistic
+# annotation (http://proycon.github.io/folia). It provides an interface to
+# efficiently edit FoLiA documents through the FoLiA Query Language (FQL).
+#
+#   Licensed under GPLv3
+#
+#----------------------------------------------------------------
+
+"""All JSON responses are encoded through dumps() in this module. It uses a fast
+C encoder (orjson) if it is installed and falls back to the standard library
+otherwise. Either way, UTF-8 encoded bytes are returned directly."""
+
+import json
+import sys
+import time
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+ENCODERS = ('auto', 'orjson', 'json')
+
+def dumps_json(data):
+    """Encodes to JSON using the standard library, returns bytes"""
+    return json.dumps(data, separators=(',',':'), ensure_ascii=False).encode('utf-8')
+
+def dumps_orjson(data):
+    """Encodes to JSON using orjson, returns bytes. Falls back to the standard library for data orjson can't handle (e.g. non-string keys)"""
+    try:
+        return orjson.dumps(data)
+    except TypeError:
+        return dumps_json(data)
+
+encoder = dumps_orjson if orjson else dumps_json
+
+def dumps(data):
+    """Encodes the data to JSON with the selected encoder, returns UTF-8 encoded bytes"""
+    return encoder(data)
+
+def setencoder(name):
+    """Selects the JSON encoder to use (auto, orjson or json)"""
+    global encoder #pylint: disable=global-statement
+    if name == 'auto':
+        encoder = dumps_orjson if orjson else dumps_json
+    elif name == 'orjson':
+        if orjson is None:
+            raise ValueError("JSON encoder orjson is not installed")
+        encoder = dumps_orjson
+    elif name == 'json':
+        encoder = dumps_json
+    else:
+        raise ValueError("Unknown JSON encoder: " + name + ", expected one of: " + ", ".join(ENCODERS))
+
+def getencoder():
+    """Returns the name of the JSON encoder in use"""
+    return 'orjson' if encoder is dumps_orjson else 'json'
+
+
+def benchmark():
+    """Benchmarks the available encoders on FLAT responses for the bundled test document"""
+    import os #pylint: disable=import-outside-toplevel
+    import folia.main as folia #pylint: disable=import-outside-toplevel
+    from foliadocserve.flat import parseresults #pylint: disable=import-outside-toplevel
+    global encoder #pylint: disable=global-statement
+    filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'testflat.folia.xml')
+    print("Loading " + filename, file=sys.stderr)
+    doc = folia.Document(file=filename, loadsetdefinitions=False, autodeclare=True, allowadhocsets=True)
+    results = [[doc.data[0]]] #the entire text body
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    previous = encoder
+    for name, candidate in (('json', dumps_json), ('orjson', dumps_orjson if orjson else None)):
+        if candidate is None:
+            print(name + ": not installed", file=sys.stderr)
+            continue
+        encoder = candidate
+        out = parseresults(results, doc, version="benchmark", declarations=True, setdefinitions=True, metadata=True, toc=True)
+        begintime = time.time()
+        for _ in range(repeat):
+            out = parseresults(results, doc, version="benchmark", declarations=True, setdefinitions=True, metadata=True, toc=True)
+        rendertime = (time.time() - begintime) / repeat
+        data = json.loads(out)
+        begintime = time.time()
+        for _ in range(repeat):
+            candidate(data)
+        encodetime = (time.time() - begintime) / repeat
+        print("%s: %d bytes, encoding %.2f ms, full FLAT response (rendering + encoding) %.2f ms" % (name, len(out), encodetime * 1000, rendertime * 1000), file=sys.stderr)
+    encoder = previous
+
+if __name__ == '__main__':
+    benchmark()
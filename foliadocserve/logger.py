@@ -0,0 +1,159 @@
+#---------------------------------------------------------------
+# FoLiA Document Server - Logging
+#   by Maarten van Gompel
+#   Centre for Language & Speech Technology, Radboud University Nijmegen
+#   & KNAW Humanities Cluster
+#   http://proycon.github.io/folia
+#   http://github.com/proycon/foliadocserve
+#   proycon AT anaproy DOT nl
+#
+# The FoLiA Document Server is a backend HTTP service to interact with
+# documents in the FoLiA format, a rich XML-based format for linguistic
+# annotation (http://proycon.github.io/folia). It provides an interface to
+# efficiently edit FoLiA documents through the FoLiA Query Language (FQL).
+#
+#   Licensed under GPLv3
+#
+#----------------------------------------------------------------
+
+"""Log messages are queued in a bounded buffer and written by a background
+thread, so formatting, writing and flushing the log file happen off the
+request path. If the buffer is full (the disk can't keep up), messages are
+dropped and counted rather than blocking the request; errors wait briefly for
+room instead."""
+
+import os
+import sys
+import time
+import queue
+import atexit
+import threading
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVELNAMES = { value: key.upper() for key, value in LEVELS.items() }
+
+
+class Logger:
+    """Asynchronous buffered logger writing to a file (rotated by size) or to an open stream (such as stderr)"""
+
+    def __init__(self, filename=None, stream=None, level=INFO, buffersize=10000, maxbytes=0, backups=5, flushinterval=1.0):
+        self.filename = os.path.abspath(filename) if filename else None #the server changes its working directory later
+        self.level = level
+        self.maxbytes = maxbytes #rotate the log file once it exceeds this size (0 = never)
+        self.backups = backups #number of rotated log files to keep
+        self.flushinterval = flushinterval #maximum time (in seconds) written messages may remain unflushed
+        if filename:
+            self.stream = open(filename,'a',encoding='utf-8')
+            self.size = self.stream.tell()
+        else:
+            self.stream = stream if stream is not None else sys.stderr
+            self.size = 0
+        self.queue = queue.Queue(buffersize)
+        self.written = 0
+        self.dropped = 0
+        self.reporteddropped = 0
+        self.rotations = 0
+        self.thread = threading.Thread(target=self.run, name="logger", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, msg, level=INFO, **fields):
+        """Queues a message, fields are appended as key=value pairs (e.g. sid, docsel, duration)"""
+        if level < self.level:
+            return
+        record = (time.time(), level, msg, fields)
+        try:
+            if level >= ERROR:
+                self.queue.put(record, timeout=1)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1 #not exact under contention, but it need not be
+
+    def format(self, record):
+        timestamp, level, msg, fields = record
+        line = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) + " - "
+        if level != INFO:
+            line += LEVELNAMES.get(level, str(level)) + ": "
+        line += msg
+        if fields:
+            line += " |" + "".join( " " + key + "=" + formatfield(value) for key, value in fields.items() if value is not None )
+        return line + "\n"
+
+    def write(self, record):
+        if self.dropped != self.reporteddropped:
+            dropped = self.dropped
+            self.writeline(self.format( (time.time(), WARNING, "Log buffer full, " + str(dropped - self.reporteddropped) + " message(s) dropped", {}) ))
+            self.reporteddropped = dropped
+        self.writeline(self.format(record))
+        self.written += 1
+
+    def writeline(self, line):
+        self.stream.write(line)
+        if self.filename:
+            self.size += len(line) #characters rather than bytes, close enough for rotation
+            if self.maxbytes and self.size >= self.maxbytes:
+                self.rotate()
+
+    def rotate(self):
+        """Renames the log file to .1 (shifting earlier ones up to the maximum number of backups) and starts a new one"""
+        self.stream.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.filename + "." + str(i)):
+                os.replace(self.filename + "." + str(i), self.filename + "." + str(i+1))
+        if self.backups:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.unlink(self.filename)
+        self.stream = open(self.filename,'a',encoding='utf-8')
+        self.size = 0
+        self.rotations += 1
+
+    def run(self):
+        lastflush = time.time()
+        dirty = False
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flushinterval)
+            except queue.Empty:
+                record = None
+            if record is not None:
+                try:
+                    self.write(record)
+                    dirty = True
+                except Exception as e: #pylint: disable=broad-except
+                    print("Unable to write to log: " + str(e), file=sys.stderr)
+                finally:
+                    self.queue.task_done()
+            #flush when there is nothing left to write, or at least every flush interval when messages keep coming
+            if dirty and (self.queue.empty() or time.time() - lastflush >= self.flushinterval):
+                try:
+                    self.stream.flush()
+                except Exception: #pylint: disable=broad-except
+                    pass
+                lastflush = time.time()
+                dirty = False
+
+    def close(self):
+        """Waits until all queued messages are written and flushed"""
+        self.queue.join()
+        try:
+            self.stream.flush()
+        except Exception: #pylint: disable=broad-except
+            pass
+
+    def stats(self):
+        return {'level': LEVELNAMES.get(self.level), 'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped, 'rotations': self.rotations}
+
+
+def formatfield(value):
+    if isinstance(value, float):
+        return "%.3f" % value
+    elif isinstance(value, (tuple, list)):
+        return "/".join(str(x) for x in value)
+    return str(value)
@@ -0,0 +1,301 @@
+#---------------------------------------------------------------
+# FoLiA Document Server - Query planner
+#   by Maarten van Gompel
+#   Centre for Language & Speech Technology, Radboud University Nijmegen
+#   & KNAW Humanities Cluster
+#   http://proycon.github.io/folia
+#   http://github.com/proycon/foliadocserve
+#   proycon AT anaproy DOT nl
+#
+# The FoLiA Document Server is a backend HTTP service to interact with
+# documents in the FoLiA format, a rich XML-based format for linguistic
+# annotation (http://proycon.github.io/folia). It provides an interface to
+# efficiently edit FoLiA documents through the FoLiA Query Language (FQL).
+#
+#   Licensed under GPLv3
+#
+#----------------------------------------------------------------
+
+"""Most queries FLAT sends are on a single element, identified by ID: SELECT w ID "x", EDIT pos WITH class "y" FOR ID "x",
+etc. The planner recognises these from the raw query and executes them directly on the element from the document index,
+without parsing them into a generic fql.Query and evaluating its selector chain. The execution mirrors what the FQL engine
+does for these queries step by step; anything outside the recognised forms (or a situation the direct execution does not
+cover, like an EDIT that finds nothing to edit and becomes an ADD) is handed to the FQL engine."""
+
+import re
+import datetime
+import threading
+from collections import defaultdict
+from folia import fql
+import folia.main as folia
+
+ACTIONS = ('SELECT', 'EDIT', 'ADD', 'DELETE')
+
+ASSIGNMENTS = ('class', 'annotator', 'annotatortype', 'confidence', 'datetime', 'n') #attributes recognised after WITH, FLAT sets these on edits
+
+TOKENIZER = re.compile(r'"[^"\\]*"|\S+')
+
+class PlannedAction:
+    """The parts of an fql.Action that the document server looks at (see Root.addtochangelog)"""
+
+    def __init__(self, action, focus, assignments):
+        self.action = action
+        self.focus = focus #fql.Selector
+        self.assignments = assignments
+
+
+class IdQuery:
+    """A query on a single element (or the annotations of a single element) identified by ID, behaves like fql.Query"""
+
+    def __init__(self, planner, rawquery, action, Class, set, id, assignments, targetid, returntype):
+        self.planner = planner
+        self.rawquery = rawquery
+        self.action = PlannedAction(action, fql.Selector(Class, set, id, None, None, None), assignments)
+        self.targetid = targetid #None if the focus itself is selected by ID
+        self.returntype = returntype
+        self.format = "flat"
+
+    _touch = fql.Query._touch #marks added and edited elements (changedbyquery), as the FQL engine does
+
+    def __call__(self, doc, wrap=True, debug=False):
+        result = self.planner.execute(self, doc)
+        if result is None:
+            #not covered by direct execution, nothing has been changed yet
+            query = fql.Query(self.rawquery)
+            self.action = query.action
+            return query(doc, wrap, debug)
+        return result
+
+
+def tokenize(rawquery):
+    """Splits a query in keywords and quoted strings, returns None if it contains anything we do not recognise (escapes)"""
+    tokens = TOKENIZER.findall(rawquery)
+    for token in tokens:
+        if '\\' in token:
+            return None
+        if token[0] == '"':
+            if len(token) < 2 or token[-1] != '"' or '"' in token[1:-1]:
+                return None
+        elif '"' in token:
+            return None
+    return tokens
+
+def getstring(token):
+    if token is None or len(token) < 2 or token[0] != '"':
+        raise ValueError
+    return token[1:-1]
+
+def getvalue(attribute, token):
+    """Returns the value assigned to an attribute (quoted or not), as the FQL parser interprets it, raises ValueError for values
+    we leave to the FQL parser"""
+    value = token[1:-1] if token[0] == '"' else token
+    if value == "NONE":
+        return None
+    elif attribute == "confidence":
+        return float(value)
+    elif attribute == "annotatortype":
+        if value == "auto":
+            return folia.AnnotatorType.AUTO
+        elif value == "manual":
+            return folia.AnnotatorType.MANUAL
+        raise ValueError
+    elif attribute == "datetime":
+        if value == "now":
+            return datetime.datetime.now()
+        raise ValueError
+    return value
+
+def assign(element, assignments):
+    """Applies the assignments of an EDIT to an element, as the FQL engine does"""
+    for attribute, value in assignments.items():
+        if attribute == "class":
+            element.cls = value
+        else:
+            setattr(element, attribute, value)
+
+
+class Planner:
+    """Recognises ID-targeted queries and executes them directly, keeps counts of how many queries took which path"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.direct = defaultdict(int) #action => number of queries executed directly
+        self.fallback = defaultdict(int) #action => number of recognised queries handed to the FQL engine at execution
+        self.generic = 0 #number of queries not recognised
+
+    def count(self, counter, action=None):
+        with self.lock:
+            if action is None:
+                self.generic += 1
+            else:
+                counter[action] += 1
+
+    def plan(self, rawquery):
+        """Returns an IdQuery if the query is recognised, a (parsed) fql.Query otherwise"""
+        if self.enabled:
+            query = self.recognise(rawquery)
+            if query is not None:
+                return query
+        self.count(None)
+        return fql.Query(rawquery)
+
+    def recognise(self, rawquery):
+        """Recognises: ACTION TYPE [OF "set"] [ID "id"] [WITH attribute "value" ...] [FOR [TYPE] ID "id"] [RETURN focus|target] FORMAT flat,
+        with the attributes in ASSIGNMENTS"""
+        tokens = tokenize(rawquery)
+        if not tokens or len(tokens) < 4 or tokens[0] not in ACTIONS or tokens[-2:] != ['FORMAT', 'flat']:
+            return None
+        tokens = tokens[:-2]
+        action = tokens[0]
+        Class = folia.XML2CLASS.get(tokens[1])
+        if Class is None or Class is folia.Text:
+            return None #FQL selects all root elements for text
+        set = id = targetid = None
+        assignments = {}
+        returntype = "focus"
+        i = 2
+        try:
+            if i < len(tokens) and tokens[i] == "OF":
+                set = getstring(tokens[i+1])
+                i += 2
+            if i < len(tokens) and tokens[i] == "ID":
+                id = getstring(tokens[i+1])
+                i += 2
+            if i < len(tokens) and tokens[i] == "WITH":
+                i += 1
+                if tokens[i] not in ASSIGNMENTS:
+                    return None
+                while i < len(tokens) and tokens[i] in ASSIGNMENTS:
+                    assignments[tokens[i]] = getvalue(tokens[i], tokens[i+1])
+                    i += 2
+            if i < len(tokens) and tokens[i] == "FOR":
+                i += 1
+                if tokens[i] != "ID":
+                    if tokens[i] not in folia.XML2CLASS:
+                        return None
+                    i += 1 #the type is not checked when selecting by ID
+                if tokens[i] != "ID":
+                    return None
+                targetid = getstring(tokens[i+1])
+                i += 2
+            if i < len(tokens) and tokens[i] == "RETURN":
+                returntype = tokens[i+1]
+                i += 2
+        except (IndexError, ValueError):
+            return None
+        if i != len(tokens) or returntype not in ("focus", "target"):
+            return None
+        if (id is None) == (targetid is None):
+            return None #exactly one of the focus and the target is selected by ID
+        if returntype == "target" and targetid is None:
+            return None
+        if id is not None and set is not None:
+            return None
+        if action == "SELECT" and assignments:
+            return None
+        if action in ("EDIT", "ADD") and not assignments:
+            return None
+        if action == "ADD" and (targetid is None or issubclass(Class, (folia.AbstractSpanAnnotation, folia.AbstractSpanRole)) or Class in (folia.Description, folia.Comment, folia.Feature)):
+            return None
+        if action == "DELETE" and assignments:
+            return None
+        return IdQuery(self, rawquery, action, Class, set if set is not None else False, id, assignments, targetid, returntype)
+
+    def select(self, focus, target):
+        """Selects the focus elements in the target, as fql.Selector does"""
+        if issubclass(focus.Class, folia.AbstractSpanAnnotation) and isinstance(target, (folia.Word, folia.Morpheme)):
+            return target.findspans(focus.Class, focus.set, alternatives=False)
+        return target.select(focus.Class, focus.set, True)
+
+    def execute(self, query, doc):
+        """Executes a recognised query on the document, returns the results or None if the FQL engine has to do it"""
+        action = query.action
+        focus = action.focus
+        if len(doc.data) != 1:
+            #FQL visits every root element, let it
+            self.count(self.fallback, action.action)
+            return None
+        focusselection = []
+        targetselection = []
+        if query.targetid is None:
+            try:
+                element = doc[focus.id]
+            except KeyError:
+                element = None
+            if element is None and action.action == "EDIT":
+                self.count(self.fallback, action.action) #an EDIT without focus is an ADD on the targets
+                return None
+            self.count(self.direct, action.action)
+            if action.action != "SELECT":
+                focus.autodeclare(doc)
+            if element is not None:
+                focus.Class = element.__class__
+                focusselection.append(element)
+                if action.action == "DELETE":
+                    parent = element.parent
+                    parent.remove(element)
+                    element.parent = parent
+                elif action.action == "EDIT":
+                    if doc.processor:
+                        element.processor = doc.processor
+                    assign(element, action.assignments)
+                    query._touch(element)
+        else:
+            try:
+                target = doc[query.targetid]
+            except KeyError:
+                target = None
+            try:
+                nofocus = action.action == "EDIT" and (target is None or not any(True for _ in self.select(focus, target)))
+            except Exception:
+                self.count(self.direct, action.action) #the selection fails the same way in the FQL engine
+                raise
+            if nofocus:
+                self.count(self.fallback, action.action)
+                return None
+            self.count(self.direct, action.action)
+            if action.action != "SELECT":
+                focus.autodeclare(doc)
+            if target is not None and action.action == "ADD":
+                if 'set' not in action.assignments:
+                    if focus.set and focus.set != "undefined":
+                        action.assignments['set'] = focus.set
+                    else:
+                        action.assignments['set'] = focus.set = doc.defaultset(focus.Class)
+                supported = (focus.Class.REQUIRED_ATTRIBS or ()) + (focus.Class.OPTIONAL_ATTRIBS or ())
+                if doc.processor and 'processor' not in action.assignments and folia.Attrib.ANNOTATOR in supported:
+                    action.assignments['processor'] = doc.processor
+                focusselection.append(target.add(focus.Class, **action.assignments))
+                query._touch(focusselection[-1])
+                targetselection.append(target)
+            elif target is not None:
+                for element in self.select(focus, target):
+                    if target and not any(x is target for x in targetselection):
+                        targetselection.append(target)
+                    if any(x is element for x in focusselection):
+                        continue
+                    focusselection.append(element)
+                    if action.action == "DELETE":
+                        parent = element.parent
+                        parent.remove(element)
+                        element.parent = parent
+                    elif action.action == "EDIT":
+                        if doc.processor:
+                            element.processor = doc.processor
+                        assign(element, action.assignments)
+                        query._touch(element)
+        doc.pendingsort()
+        return targetselection if query.returntype == "target" else focusselection
+
+    def stats(self):
+        with self.lock:
+            direct = sum(self.direct.values())
+            total = direct + sum(self.fallback.values()) + self.generic
+            return {
+                'enabled': self.enabled,
+                'direct': dict(self.direct),
+                'fallback': dict(self.fallback),
+                'generic': self.generic,
+                'hitrate': round(direct / total, 4) if total else None,
+            }
@@ -0,0 +1,101 @@
+#---------------------------------------------------------------
+# FoLiA Document Server - Precomputed FLAT renderings
+#   by Maarten van Gompel
+#   Centre for Language & Speech Technology, Radboud University Nijmegen
+#   & KNAW Humanities Cluster
+#   http://proycon.github.io/folia
+#   http://github.com/proycon/foliadocserve
+#   proycon AT anaproy DOT nl
+#
+# The FoLiA Document Server is a backend HTTP service to interact with
+# documents in the FoLiA format, a rich XML-based format for linguistic
+# annotation (http://proycon.github.io/folia). It provides an interface to
+# efficiently edit FoLiA documents through the FoLiA Query Language (FQL).
+#
+#   Licensed under GPLv3
+#
+#----------------------------------------------------------------
+
+"""FLAT responses for read-only viewing can be rendered in advance. The
+renderings of a document are stored (gzip compressed) in a hidden directory
+next to the document, along with the modification time and size of the
+document they were rendered from. They are only valid as long as the document
+on disk is unchanged."""
+
+import os
+import json
+import hashlib
+import shutil
+import random
+import folia.main as folia
+from foliadocserve.compression import writefile
+
+PRERENDEREXTENSION = ".flat" #suffix of the directory holding the renderings
+FLATARGS = ('declarations','setdefinitions','metadata','toc','slices','textclasses') #request parameters that affect the rendering
+DEFAULTSLICES = [('p',25),('s',100)]
+
+def getprerenderdir(basename):
+    """Returns the directory holding the renderings for the document with the given basename (filename without extension)"""
+    directory, docid = os.path.split(basename)
+    return os.path.join(directory, '.' + docid + PRERENDEREXTENSION)
+
+def getrenderkey(rawquery, flatargs):
+    """Returns the key identifying a rendering, given the query (without document selector) and the FLAT arguments"""
+    return hashlib.sha1(json.dumps([" ".join(rawquery.split())] + [ flatargs.get(x) for x in FLATARGS ]).encode('utf-8')).hexdigest()
+
+def getstamp(filename, version):
+    """Returns the stamp identifying the state of the document on disk, renderings are only valid for the same stamp"""
+    stat = os.stat(filename)
+    return [version, stat.st_mtime_ns, stat.st_size]
+
+def getprobeargs(slices):
+    """Returns the FLAT arguments of the initial request a viewer makes (a PROBE query)"""
+    return {'declarations': True, 'setdefinitions': True, 'metadata': True, 'toc': True, 'slices': slices, 'textclasses': False}
+
+def getrenderrequests(doc, slices=None):
+    """Yields (query, FLAT arguments) for all requests a viewer makes: the initial probe (declarations, metadata, table of contents
+    and slice boundaries) and every individual slice"""
+    if slices is None:
+        slices = DEFAULTSLICES
+    yield "PROBE", getprobeargs(slices)
+    for tag, size in slices:
+        Class = folia.XML2CLASS[tag]
+        boundaries = [ element.id for i, element in enumerate(doc.select(Class)) if i % size == 0 ]
+        for i, startid in enumerate(boundaries):
+            if i + 1 < len(boundaries):
+                query = "SELECT FOR " + tag + " START ID \"" + startid + "\" ENDBEFORE ID \"" + boundaries[i+1] + "\" FORMAT flat"
+            else:
+                query = "SELECT FOR " + tag + " START ID \"" + startid + "\" FORMAT flat"
+            yield query, {'declarations': False, 'setdefinitions': False, 'metadata': False, 'toc': False, 'slices': "", 'textclasses': False}
+
+def writeprerendered(prerenderdir, stamp, renderings):
+    """Writes the renderings (list of (query, flatargs, response as bytes)) for a document, replacing any earlier ones at once"""
+    tmpdir = prerenderdir + ".%016x.tmp" % random.getrandbits(64)
+    os.mkdir(tmpdir)
+    index = {'stamp': stamp, 'queries': {}}
+    for rawquery, flatargs, out in renderings:
+        key = getrenderkey(rawquery, flatargs)
+        writefile(os.path.join(tmpdir, key + '.json.gz'), out, 'gz')
+        index['queries'][key] = rawquery
+    with open(os.path.join(tmpdir, 'index.json'),'w',encoding='utf-8') as f:
+        json.dump(index, f)
+    removeprerendered(prerenderdir)
+    os.rename(tmpdir, prerenderdir)
+
+def findprerendered(prerenderdir, stamp, rawquery, flatargs):
+    """Returns the filename of the (gzip compressed) rendering for the request, or None if there is none or it is outdated"""
+    try:
+        with open(os.path.join(prerenderdir, 'index.json'),'r',encoding='utf-8') as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    key = getrenderkey(rawquery, flatargs)
+    if index['stamp'] != stamp or key not in index['queries']:
+        return None
+    return os.path.join(prerenderdir, key + '.json.gz')
+
+def removeprerendered(prerenderdir):
+    if os.path.exists(prerenderdir):
+        trash = prerenderdir + ".%016x.old" % random.getrandbits(64)
+        os.rename(prerenderdir, trash) #so readers never see a partially removed directory
+        shutil.rmtree(trash)
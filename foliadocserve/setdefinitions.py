@@ -0,0 +1,177 @@
+#---------------------------------------------------------------
+# FoLiA Document Server - Set Definition Cache
+#   by Maarten van Gompel
+#   Centre for Language & Speech Technology, Radboud University Nijmegen
+#   & KNAW Humanities Cluster
+#   http://proycon.github.io/folia
+#   http://github.com/proycon/foliadocserve
+#   proycon AT anaproy DOT nl
+#
+# The FoLiA Document Server is a backend HTTP service to interact with
+# documents in the FoLiA format, a rich XML-based format for linguistic
+# annotation (http://proycon.github.io/folia). It provides an interface to
+# efficiently edit FoLiA documents through the FoLiA Query Language (FQL).
+#
+#   Licensed under GPLv3
+#
+#----------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+from folia.foliaset import SetDefinition
+
+
+class SetDefinitionCache(dict):
+    """Shared store of set definitions (set URL => folia.foliaset.SetDefinition), passed to every folia.Document.
+
+    Set definitions that are downloaded by the FoLiA library are persisted to the cache directory (as turtle RDF, along
+    with their precomputed JSON serialisation), so they need not be downloaded and parsed again after a restart. Entries
+    older than the TTL (whether in memory or on disk) are refreshed in the background, the cached copy is served until the
+    new one is in, and is kept if the set definition can not be downloaded. Set definitions may also be seeded from a local directory of set definition files (named after the last component of
+    their URL), which allows running fully offline.
+    """
+
+    def __init__(self, cachedir=None, seeddir=None, ttl=86400, log=lambda s: print(s,file=sys.stderr)):
+        super().__init__()
+        self.cachedir = cachedir
+        self.seeddir = seeddir
+        self.ttl = ttl
+        self.log = log
+        self.jsoncache = {} #set URL => precomputed JSON (dict)
+        self.timestamps = {} #set URL => time the set definition was obtained (or last attempted to refresh)
+        self.refreshing = set() #set URLs being refreshed in the background
+        self.lock = threading.RLock()
+        self.hits = 0 #found in memory
+        self.diskhits = 0 #loaded from the persistent cache
+        self.seedhits = 0 #loaded from the seed directory
+        self.misses = 0 #had to be downloaded
+        if self.cachedir and not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def getcachefile(self, url, extension):
+        return os.path.join(self.cachedir, hashlib.sha1(url.encode('utf-8')).hexdigest() + extension)
+
+    def getseedfile(self, url):
+        if self.seeddir:
+            filename = os.path.join(self.seeddir, os.path.basename(url.rstrip('/')))
+            if os.path.exists(filename):
+                return filename
+        return None
+
+    def __contains__(self, url):
+        with self.lock:
+            if dict.__contains__(self, url):
+                self.hits += 1
+                if time.time() - self.timestamps.get(url, 0) >= self.ttl:
+                    self.schedulerefresh(url)
+                return True
+            if not url:
+                return False #setless annotation type
+            #not in memory, can we get it from disk without downloading?
+            return self.loadlocal(url)
+
+    def loadlocal(self, url):
+        """Attempts to load the set definition from the persistent cache or the seed directory, returns True on success"""
+        if self.cachedir and os.path.exists(self.getcachefile(url, '.json')):
+            with open(self.getcachefile(url, '.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            try:
+                setdefinition = SetDefinition(self.getcachefile(url, '.ttl'), format='text/turtle')
+            except Exception as e: #pylint: disable=broad-except
+                self.log("Unable to load cached set definition for " + url + ": " + str(e))
+                return False
+            dict.__setitem__(self, url, setdefinition)
+            self.jsoncache[url] = meta['json']
+            self.timestamps[url] = meta['timestamp']
+            self.diskhits += 1
+            if time.time() - meta['timestamp'] >= self.ttl:
+                self.schedulerefresh(url)
+            return True
+        seedfile = self.getseedfile(url)
+        if seedfile:
+            try:
+                setdefinition = SetDefinition(os.path.abspath(seedfile))
+            except Exception as e: #pylint: disable=broad-except
+                self.log("Unable to load set definition for " + url + " from " + seedfile + ": " + str(e))
+                return False
+            self.log("Seeded set definition for " + url + " from " + seedfile)
+            self.seedhits += 1
+            self.store(url, setdefinition)
+            return True
+        return False
+
+    def schedulerefresh(self, url):
+        """Refreshes an expired set definition in the background, call with the lock held"""
+        if url not in self.refreshing:
+            self.refreshing.add(url)
+            threading.Thread(target=self.refresh, args=(url,), name="setdefinition-refresh", daemon=True).start()
+
+    def refresh(self, url):
+        """Downloads the set definition again (without holding the lock), returns False if that fails"""
+        self.log("Refreshing expired set definition " + url)
+        try:
+            try:
+                setdefinition = SetDefinition(url)
+            except Exception as e: #pylint: disable=broad-except
+                self.log("Unable to refresh set definition " + url + ", using cached copy: " + str(e))
+                with self.lock:
+                    self.timestamps[url] = time.time() #try again after another TTL
+                return False
+            with self.lock:
+                self.misses += 1
+                self.store(url, setdefinition)
+            return True
+        finally:
+            with self.lock:
+                self.refreshing.discard(url)
+
+    def __setitem__(self, url, setdefinition):
+        """Called by the FoLiA library after it downloaded a set definition"""
+        with self.lock:
+            self.misses += 1
+            self.store(url, setdefinition)
+
+    def store(self, url, setdefinition):
+        """Adds the set definition to the cache, persisting it to disk"""
+        with self.lock:
+            dict.__setitem__(self, url, setdefinition)
+            self.jsoncache[url] = setdefinition.json()
+            self.timestamps[url] = time.time()
+            if self.cachedir:
+                try:
+                    setdefinition.graph.serialize(destination=self.getcachefile(url, '.ttl.tmp'), format='turtle')
+                    os.rename(self.getcachefile(url, '.ttl.tmp'), self.getcachefile(url, '.ttl'))
+                    with open(self.getcachefile(url, '.json.tmp'), 'w', encoding='utf-8') as f:
+                        json.dump({'url': url, 'timestamp': self.timestamps[url], 'json': self.jsoncache[url]}, f)
+                    os.rename(self.getcachefile(url, '.json.tmp'), self.getcachefile(url, '.json'))
+                except Exception as e: #pylint: disable=broad-except
+                    self.log("Unable to persist set definition " + url + ": " + str(e))
+
+    def json(self, url):
+        """Returns the precomputed JSON serialisation of the set definition"""
+        with self.lock:
+            if url not in self.jsoncache:
+                self.jsoncache[url] = self[url].json()
+            return self.jsoncache[url]
+
+    def preload(self):
+        """Loads all set definitions from the persistent cache into memory, call at startup"""
+        urls = []
+        if self.cachedir:
+            for filename in os.listdir(self.cachedir):
+                if filename.endswith('.json'):
+                    with open(os.path.join(self.cachedir, filename), 'r', encoding='utf-8') as f:
+                        urls.append(json.load(f)['url'])
+        for url in urls:
+            url in self #pylint: disable=pointless-statement
+        if self.seeddir:
+            #seeded sets are only identified by filename, they are matched against URLs once requested
+            self.log("Set definitions will be seeded from " + self.seeddir)
+        self.log(str(len(self)) + " set definition(s) preloaded")
+
+    def stats(self):
+        return {'loaded': len(self), 'hits': self.hits, 'diskhits': self.diskhits, 'seedhits': self.seedhits, 'misses': self.misses}
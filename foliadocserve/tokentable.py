@@ -0,0 +1,332 @@
+#---------------------------------------------------------------
+# FoLiA Document Server - Token table
+#   by Maarten van Gompel
+#   Centre for Language & Speech Technology, Radboud University Nijmegen
+#   & KNAW Humanities Cluster
+#   http://proycon.github.io/folia
+#   http://github.com/proycon/foliadocserve
+#   proycon AT anaproy DOT nl
+#
+# The FoLiA Document Server is a backend HTTP service to interact with
+# documents in the FoLiA format, a rich XML-based format for linguistic
+# annotation (http://proycon.github.io/folia). It provides an interface to
+# efficiently edit FoLiA documents through the FoLiA Query Language (FQL).
+#
+#   Licensed under GPLv3
+#
+#----------------------------------------------------------------
+
+"""A compact, columnar view on the tokens of a document: one row per (authoritative) word in document order, with columns
+for the ID, the text, the containing sentence and a number of token annotation layers (pos and lemma by default). Strings are
+interned and every column is an integer array of string codes (-1 for none), so a table costs a few bytes per token
+instead of the Python objects of the tree, and scans over a column do not touch the tree at all."""
+
+import sys
+import json
+import zipfile
+from array import array
+from collections import OrderedDict
+from folia import fql
+import folia.main as folia
+
+TOKENS = (folia.Word,)
+
+#name, annotation type, set (None for any set)
+LAYERS = (('pos', folia.PosAnnotation, None), ('lemma', folia.LemmaAnnotation, None))
+
+NONE = -1 #code of a missing value
+
+def getlayers(specs):
+    """Parses layer specifications (annotation type, optionally followed by a colon and a set, e.g. ``pos`` or
+    ``entity:https://...``) to (name, annotation type, set) tuples; a type requested more than once is numbered. Raises
+    ValueError for anything that is not a token or span annotation type"""
+    layers = []
+    names = set()
+    for spec in specs:
+        tag, _, annotationset = spec.strip().partition(':')
+        Class = folia.XML2CLASS.get(tag)
+        if Class is None or not issubclass(Class, (folia.AbstractInlineAnnotation, folia.AbstractSpanAnnotation)):
+            raise ValueError("Not a token or span annotation type: " + tag)
+        name = tag
+        i = 1
+        while name in names or name in ('id', 'text', 'sentence'):
+            i += 1
+            name = tag + "." + str(i)
+        names.add(name)
+        layers.append( (name, Class, annotationset or None) )
+    return tuple(layers)
+
+def getsentence(element):
+    """Returns the nearest sentence the element is in, or None"""
+    sentence = element.parent
+    while sentence is not None and not isinstance(sentence, folia.Sentence):
+        sentence = sentence.parent
+    return sentence
+
+def gettoken(element):
+    """Returns the token an (annotation) element belongs to, or None"""
+    while element is not None and not isinstance(element, TOKENS):
+        element = element.parent
+    return element
+
+def getvalue(token, Class, set=None):
+    """Returns the class of the annotation of the given type (and set) on the token, for span annotations that of the first
+    span the token is part of, or None"""
+    if set is None:
+        set = False #any set
+    try:
+        if issubclass(Class, folia.AbstractSpanAnnotation):
+            for span in token.findspans(Class, set):
+                return span.cls
+            return None
+        return token.annotation(Class, set).cls
+    except (folia.NoSuchAnnotation, KeyError):
+        return None
+
+def gettext(token):
+    try:
+        return token.text()
+    except folia.NoSuchText:
+        return None
+
+
+class TokenTable:
+    """Token table of a document, built once per document and updated after edits (see update()): annotation edits rewrite
+    the rows of the affected tokens in place, structural edits replace the rows of the affected sentences"""
+
+    def __init__(self, doc, layers=None):
+        self.doc = doc
+        self.layers = tuple(layers) if layers else LAYERS
+        self.names = ('id', 'text', 'sentence') + tuple(name for name, _, _ in self.layers)
+        self.rebuild()
+
+    def rebuild(self):
+        """Builds the table from scratch"""
+        self.strings = [] #code => string
+        self.codes = {} #string => code
+        self.columns = OrderedDict((name, array('i')) for name in self.names)
+        self.segmented = set() #codes of sentences whose tokens are not contiguous (nested sentences), these always trigger a full rebuild
+        self.rowmap = None #token ID code => row, built on first use and dropped when rows shift
+        seen = set()
+        last = None
+        for root in self.doc.data:
+            for token in root.select(TOKENS, ignore=[True, folia.AbstractAnnotationLayer]):
+                row = self.getrow(token)
+                for column, code in zip(self.columns.values(), row):
+                    column.append(code)
+                if row[2] != last:
+                    if row[2] in seen:
+                        self.segmented.add(row[2])
+                    seen.add(row[2])
+                    last = row[2]
+
+    def copy(self, doc):
+        """Returns a copy of the table for a copy of the document (see DocStore.detach())"""
+        table = TokenTable.__new__(TokenTable)
+        table.doc = doc
+        table.layers = self.layers
+        table.names = self.names
+        table.strings = list(self.strings)
+        table.codes = dict(self.codes)
+        table.columns = OrderedDict((name, array('i', column)) for name, column in self.columns.items())
+        table.segmented = set(self.segmented)
+        table.rowmap = None
+        return table
+
+    def intern(self, s):
+        """Returns the code of a string, adding it if it is new"""
+        if s is None:
+            return NONE
+        code = self.codes.get(s)
+        if code is None:
+            code = self.codes[s] = len(self.strings)
+            self.strings.append(s)
+        return code
+
+    def getrow(self, token):
+        """Returns the codes of a token's row"""
+        sentence = getsentence(token)
+        row = [ self.intern(token.id), self.intern(gettext(token)), self.intern(sentence.id if sentence is not None else None) ]
+        for _, Class, set in self.layers:
+            row.append(self.intern(getvalue(token, Class, set)))
+        return row
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def locate(self, id):
+        """Returns the row of the token with the given ID, or None"""
+        code = self.codes.get(id)
+        if code is None or code == NONE:
+            return None
+        if self.rowmap is None:
+            self.rowmap = dict(zip(self.columns['id'], range(len(self))))
+            self.rowmap.pop(NONE, None)
+        return self.rowmap.get(code)
+
+    def get(self, row, name):
+        """Returns the value of a cell"""
+        code = self.columns[name][row]
+        return self.strings[code] if code != NONE else None
+
+    def getrows(self, rows, names=None):
+        """Yields the given rows as dictionaries (column name => value)"""
+        if names is None:
+            names = self.names
+        for row in rows:
+            yield { name: self.get(row, name) for name in names }
+
+    def find(self, name, value):
+        """Returns the rows where the column has the given value, in document order"""
+        code = self.codes.get(value) if value is not None else NONE
+        if code is None:
+            return []
+        return [ row for row, c in enumerate(self.columns[name]) if c == code ]
+
+    def count(self, name, value):
+        """Returns the number of rows where the column has the given value"""
+        code = self.codes.get(value) if value is not None else NONE
+        if code is None:
+            return 0
+        return self.columns[name].count(code)
+
+    def sentencerows(self, sentenceid):
+        """Returns the range of rows of the tokens of a sentence"""
+        code = self.codes.get(sentenceid, NONE)
+        column = self.columns['sentence']
+        if code == NONE:
+            return range(0)
+        try:
+            start = end = column.index(code)
+        except ValueError:
+            return range(0)
+        while end < len(column) and column[end] == code:
+            end += 1
+        return range(start, end)
+
+    def ids(self, start=0, stop=None, step=1):
+        """Returns the token IDs of a range of rows (None for tokens without ID)"""
+        return [ self.strings[code] if code != NONE else None for code in self.columns['id'][start:stop:step] ]
+
+    def refreshtoken(self, token):
+        """Rewrites the row of a single token after an annotation edit, returns False if the token is not in the table"""
+        row = self.locate(token.id) if token.id else None
+        if row is None:
+            return False
+        for column, code in zip(self.columns.values(), self.getrow(token)):
+            column[row] = code
+        return True
+
+    def refresh(self, code):
+        """Replaces the rows of a single sentence (given its code) after a structural edit"""
+        if code == NONE or code in self.segmented:
+            self.rebuild()
+            return
+        rows = self.sentencerows(self.strings[code])
+        sentence = self.doc.index.get(self.strings[code])
+        if not rows:
+            if sentence is not None and any(True for _ in sentence.select(TOKENS, ignore=[True, folia.AbstractAnnotationLayer])):
+                self.rebuild() #a new sentence, the order of sentences changed
+            return
+        if sentence is None or sentence.parent is None:
+            newrows = [] #sentence was deleted
+        else:
+            newrows = [ self.getrow(token) for token in sentence.select(TOKENS, ignore=[True, folia.AbstractAnnotationLayer]) if getsentence(token) is sentence ]
+        for i, column in enumerate(self.columns.values()):
+            column[rows.start:rows.stop] = array('i', (row[i] for row in newrows))
+        self.rowmap = None
+
+    def update(self, elements):
+        """Updates the table after an edit, given the elements returned by the query"""
+        codes = set() #sentences to refresh
+        tokens = [] #tokens whose annotations changed
+        for element in elements:
+            if isinstance(element, fql.SpanSet):
+                self.update(element)
+                continue
+            if not isinstance(element, folia.AbstractElement):
+                continue
+            if isinstance(element, (folia.AbstractStructureElement, folia.Correction)):
+                sentence = getsentence(element) #for deleted elements the parent is still set
+                if isinstance(element, folia.Sentence):
+                    codes.add(self.intern(element.id))
+                    if sentence is not None:
+                        codes.add(self.intern(sentence.id)) #nested sentence
+                elif sentence is not None or isinstance(element, (folia.Correction,) + TOKENS):
+                    row = self.locate(element.id) if element.id else None
+                    if row is not None:
+                        codes.add(self.columns['sentence'][row]) #where it was
+                    codes.add(self.intern(sentence.id) if sentence is not None else NONE) #where it is now
+                elif any(True for _ in element.select(TOKENS, ignore=[True, folia.AbstractAnnotationLayer])):
+                    #a container above the sentence level holding tokens was added, moved or deleted
+                    self.rebuild()
+                    return
+            elif isinstance(element, folia.AbstractSpanAnnotation):
+                tokens += element.wrefs()
+            else:
+                token = gettoken(element)
+                if token is not None:
+                    tokens.append(token)
+        for code in codes:
+            self.refresh(code)
+        for token in tokens:
+            if not self.refreshtoken(token) and token.parent is not None:
+                #token without ID or not (yet) in the table
+                sentence = getsentence(token)
+                self.refresh(self.intern(sentence.id) if sentence is not None else NONE)
+
+
+def getnpy(column):
+    """Returns an integer array in NumPy's .npy format (version 1.0), so it can be read without us depending on NumPy"""
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    header = "{'descr': '<i" + str(column.itemsize) + "', 'fortran_order': False, 'shape': (" + str(len(column)) + ",), }"
+    header += " " * (63 - (10 + len(header)) % 64) + "\n" #pad so the data is aligned to 64 bytes
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, 'little') + header.encode('latin-1') + column.tobytes()
+
+
+class StreamBuffer:
+    """Write-only file object that collects what is written until it is taken, for producing archives in streamed responses"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def exporttables(tables, layers, manifest=None):
+    """Generator producing a zip archive (readable with numpy.load() as an .npz file) of token tables, one at a time, given
+    (docid, TokenTable) pairs; the table may also be an exception if the document could not be read. Every document has a
+    string dictionary (DOCID/strings.json, a JSON list) and per column an array of codes into it (DOCID/COLUMN.npy, -1 for none).
+    The archive starts with manifest.json and ends with documents.json, listing the number of tokens (or error) per document"""
+    buffer = StreamBuffer()
+    archive = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
+    manifest = dict(manifest) if manifest else {}
+    manifest['columns'] = ['id', 'text', 'sentence'] + [ name for name, _, _ in layers ]
+    manifest['layers'] = [ {'name': name, 'type': Class.XMLTAG, 'set': set} for name, Class, set in layers ]
+    archive.writestr('manifest.json', json.dumps(manifest))
+    yield buffer.take()
+    documents = OrderedDict()
+    for docid, table in tables:
+        if isinstance(table, Exception):
+            documents[docid] = {'error': str(table)}
+            continue
+        archive.writestr(docid + '/strings.json', json.dumps(table.strings, ensure_ascii=False).encode('utf-8'))
+        for name in manifest['columns']:
+            archive.writestr(docid + '/' + name + '.npy', getnpy(table.columns[name]))
+            yield buffer.take()
+        documents[docid] = {'tokens': len(table)}
+    archive.writestr('documents.json', json.dumps(documents))
+    archive.close()
+    yield buffer.take()
@@ -42,9 +42,13 @@ setup(
     ],
     entry_points = {
         'console_scripts': [
-            'foliadocserve = foliadocserve.foliadocserve:main'
+            'foliadocserve = foliadocserve.foliadocserve:main',
+            'foliadocserve-compress = foliadocserve.foliadocserve:main_compress',
+            'foliadocserve-import = foliadocserve.foliadocserve:main_import',
+            'foliadocserve-prerender = foliadocserve.foliadocserve:main_prerender',
         ]
     },
     package_data = {'foliadocserve':['templates/index.html','testflat.folia.xml'] },
-    install_requires=['lxml >= 2.2','folia >= 2.0.8','pynlpl','FoLiA-tools >= 2.0.7','cherrypy','Jinja2']
+    install_requires=['lxml >= 2.2','folia >= 2.0.8','pynlpl','FoLiA-tools >= 2.0.7','cherrypy','Jinja2'],
+    extras_require={'fast': ['orjson','zstandard']}
 )
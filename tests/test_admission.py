@@ -0,0 +1,82 @@
+import time
+import threading
+import argparse
+import pytest
+from foliadocserve.foliadocserve import AdmissionControl, Overloaded, getmaxwaiting
+
+def wait(admission, key, errors):
+    """Waits for admission in a separate thread (as a worker thread would), records whether it was rejected"""
+    def run():
+        try:
+            admission.admit(key)
+        except Overloaded as e:
+            errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+def waitfor(condition):
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_maxwaiting():
+    """Waiters spread over several documents are bounded in total, further requests are rejected right away"""
+    admission = AdmissionControl(maxconcurrent=1, maxperdocument=1, maxqueue=2, timeout=5, maxwaiting=2)
+    admission.admit(('ns','a'))
+    errors = []
+    threads = [ wait(admission, ('ns','a'), errors), wait(admission, ('ns','b'), errors) ]
+    waitfor(lambda: admission.queuedcount == 2)
+    with pytest.raises(Overloaded):
+        admission.admit(('ns','c'))
+    assert admission.rejected == 1
+    admission.release(('ns','a'))
+    waitfor(lambda: admission.admitted == 2)
+    admission.release(next(iter(admission.active)))
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert admission.queuedcount == 0
+
+def test_maxqueue():
+    """A single busy document can not take all waiting slots"""
+    admission = AdmissionControl(maxconcurrent=4, maxperdocument=1, maxqueue=1, timeout=5, maxwaiting=3)
+    admission.admit(('ns','a'))
+    errors = []
+    thread = wait(admission, ('ns','a'), errors)
+    waitfor(lambda: admission.queuedcount == 1)
+    with pytest.raises(Overloaded):
+        admission.admit(('ns','a'))
+    admission.admit(('ns','b')) #other documents are still admitted
+    admission.release(('ns','a'))
+    thread.join()
+    assert not errors
+
+def test_getmaxwaiting():
+    assert getmaxwaiting(argparse.Namespace(threads=16, maxconcurrent=12, maxqueue=4)) == 4
+    assert getmaxwaiting(argparse.Namespace(threads=16, maxconcurrent=0, maxqueue=4)) == 4
+
+def test_busydocument():
+    """Requests waiting for a busy document do not hold up requests for other documents (default settings)"""
+    admission = AdmissionControl(maxconcurrent=12, maxperdocument=4, maxqueue=4, timeout=5, maxwaiting=4)
+    for _ in range(4):
+        admission.admit(('alice','hot'))
+    errors = []
+    threads = [ wait(admission, ('alice','hot'), errors) for _ in range(4) ]
+    waitfor(lambda: admission.queuedcount == 4)
+    admission.admit(('bob','idle')) #admitted right away
+    admission.admit(('alice','other'))
+    assert admission.activecount == 6
+    admission.release(('bob','idle'))
+    admission.release(('alice','other'))
+    for _ in range(4):
+        admission.release(('alice','hot'))
+    waitfor(lambda: admission.queuedcount == 0)
+    for _ in range(4):
+        admission.release(('alice','hot'))
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert admission.rejected == 0
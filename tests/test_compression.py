@@ -0,0 +1,67 @@
+import os
+import pytest
+import folia.main as folia
+from foliadocserve.foliadocserve import DocStore
+from foliadocserve.compression import getextension, getcompression, readfile, writefile, decompress, zstandard
+
+TESTFLAT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'foliadocserve', 'testflat.folia.xml')
+
+KEY = ('ns', 'doc')
+WORD = 'untitleddoc.p.3.s.1.w.2'
+
+MAGIC = {'gz': b'\x1f\x8b', 'xz': b'\xfd7zXZ\x00', 'zst': b'\x28\xb5\x2f\xfd'} #how each compressed file starts
+
+COMPRESSIONS = [ 'gz', 'xz', pytest.param('zst', marks=pytest.mark.skipif(zstandard is None, reason="zstandard is not installed")) ]
+
+def store(tmp_path, compression, default=None):
+    """Returns a document store with the test document stored with the given compression"""
+    os.makedirs(str(tmp_path / 'ns'))
+    with open(TESTFLAT, 'rb') as f:
+        writefile(str(tmp_path / 'ns' / ('doc' + getextension(compression))), f.read(), compression)
+    return DocStore(str(tmp_path), 600, compression=default)
+
+def edit(docstore):
+    doc = docstore[KEY]
+    doc[WORD].annotation(folia.PosAnnotation).cls = "compressed"
+    docstore.markchanged(KEY, [doc[WORD]])
+
+def readraw(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_roundtrip(tmp_path, compression):
+    """An edited document is saved with the compression it was stored in, and reads back with the edit"""
+    docstore = store(tmp_path, compression)
+    filename = docstore.getfilename(KEY)
+    assert getcompression(filename) == compression
+    edit(docstore)
+    docstore.unload(KEY)
+    assert os.listdir(str(tmp_path / 'ns')) == ['doc' + getextension(compression)]
+    data = readraw(filename)
+    assert data.startswith(MAGIC[compression])
+    assert b'class="compressed"' in decompress(data, compression)
+    assert b'class="compressed"' in readfile(filename)
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_keepcompression(tmp_path, compression):
+    """Existing documents retain their compression, new documents get the default one"""
+    docstore = store(tmp_path, None, default=compression)
+    assert docstore.getfilename(KEY).endswith(getextension(None))
+    edit(docstore)
+    docstore.unload(KEY)
+    assert readraw(docstore.getfilename(KEY)).startswith(b'<?xml')
+    assert docstore.getfilename(('ns', 'new')).endswith(getextension(compression))
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_convert(tmp_path, compression):
+    docstore = store(tmp_path, None)
+    edit(docstore)
+    assert docstore.convert(KEY, compression)
+    assert os.listdir(str(tmp_path / 'ns')) == ['doc' + getextension(compression)]
+    assert b'class="compressed"' in readfile(docstore.getfilename(KEY)) #pending changes were saved first
+    assert not docstore.convert(KEY, compression)
+    assert docstore.convert(KEY, None)
+    assert os.listdir(str(tmp_path / 'ns')) == ['doc' + getextension(None)]
+    assert b'class="compressed"' in readfile(docstore.getfilename(KEY))
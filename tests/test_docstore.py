@@ -0,0 +1,375 @@
+import os
+import re
+import json
+import shutil
+import sys
+import time
+import threading
+import subprocess
+import concurrent.futures
+import pytest
+from folia import fql
+import folia.main as folia
+import foliadocserve.foliadocserve as foliadocserve
+from foliadocserve.foliadocserve import DocStore, NoSuchDocument, VERSION
+from foliadocserve.flat import parseresults, parsedelta, getflatargs
+from foliadocserve.jsonencoding import getencoder
+from foliadocserve.setdefinitions import SetDefinitionCache
+
+TESTFLAT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'foliadocserve', 'testflat.folia.xml')
+
+KEY = ('ns', 'doc')
+
+OPENSET = """@prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+@prefix fsd: <http://folia.science.ru.nl/setdefinition#> .
+<%s#set> a skos:Collection ;
+    fsd:open true .
+"""
+
+@pytest.fixture
+def docstore(tmp_path):
+    os.makedirs(str(tmp_path / 'ns'))
+    shutil.copyfile(TESTFLAT, str(tmp_path / 'ns' / 'doc.folia.xml'))
+    return DocStore(str(tmp_path), 600)
+
+@pytest.fixture
+def gitdocstore(tmp_path, monkeypatch):
+    for var in ('GIT_AUTHOR', 'GIT_COMMITTER'):
+        monkeypatch.setenv(var + '_NAME', 'test')
+        monkeypatch.setenv(var + '_EMAIL', 'test@example.org')
+    os.makedirs(str(tmp_path / 'ns'))
+    shutil.copyfile(TESTFLAT, str(tmp_path / 'ns' / 'doc.folia.xml'))
+    docstore = DocStore(str(tmp_path), 600, git=True, gitmode="monolithic", gitshare="false")
+    docstore.gitcommit(KEY, "Added")
+    return docstore
+
+@pytest.fixture
+def renderdocstore(tmp_path):
+    """Document store with a render pool. Render processes parse the document as serialised by the server, which requires
+    its set definitions, so we seed an open set for each of them (the test document is not valid FoLiA v2, we make one)"""
+    os.makedirs(str(tmp_path / 'ns'))
+    doc = folia.Document(id='doc')
+    text = doc.append(folia.Text(doc, id='doc.text'))
+    for i in range(1, 4):
+        paragraph = text.append(folia.Paragraph, id='doc.p.%d' % i)
+        for j in range(1, 4):
+            sentence = paragraph.append(folia.Sentence, id='doc.p.%d.s.%d' % (i, j))
+            for k, word in enumerate(("this", "is", "a", "sentence"), 1):
+                word = sentence.append(folia.Word, word, id='doc.p.%d.s.%d.w.%d' % (i, j, k))
+                word.append(folia.PosAnnotation, cls="N", set="pos")
+                word.append(folia.LemmaAnnotation, cls=word.text(), set="lemma")
+    doc.save(str(tmp_path / 'ns' / 'doc.folia.xml'))
+    seeddir = str(tmp_path / 'sets')
+    os.makedirs(seeddir)
+    for url in set(re.findall(r'set="(https?://[^"]+)"', doc.xmlstring())):
+        with open(os.path.join(seeddir, os.path.basename(url)), 'w', encoding='utf-8') as f:
+            f.write(OPENSET % url)
+    renderpool = concurrent.futures.ProcessPoolExecutor(max_workers=1, initializer=foliadocserve.initrender, initargs=(None, seeddir, 86400, getencoder()))
+    docstore = DocStore(str(tmp_path), 600, setdefinitions=SetDefinitionCache(None, seeddir, log=lambda s: None), renderpool=renderpool, renderthreshold=1)
+    yield docstore
+    docstore.stoprendering()
+
+def getprovenance(docstore):
+    """Renders the provenance block like a FLAT request with declarations does"""
+    out = parseresults([], docstore[KEY], version=VERSION, declarations=True, fragments=docstore.getfragments(KEY))
+    return json.loads(out)['provenance']
+
+def getprocessorids(processors):
+    for processor in processors:
+        yield processor['id']
+        yield from getprocessorids(processor['processors'])
+
+
+def test_fragments_subprocessor(docstore):
+    assert 'sub.1' not in getprocessorids(getprovenance(docstore)['processors'])
+    doc = docstore[KEY]
+    doc.provenance.processors[0].append(folia.Processor.create(name="sub", id="sub.1"))
+    docstore.markchanged(KEY)
+    assert 'sub.1' in getprocessorids(getprovenance(docstore)['processors'])
+
+def test_fragments_processorupdate(docstore):
+    getprovenance(docstore)
+    doc = docstore[KEY]
+    doc.provenance.processors[0].version = "changed"
+    docstore.markchanged(KEY)
+    assert getprovenance(docstore)['processors'][0]['version'] == "changed"
+
+def test_fragments_cached(docstore):
+    """Without edits, the encoded blocks are reused"""
+    getprovenance(docstore)
+    fragments = docstore.getfragments(KEY)
+    assert 'provenance' in fragments
+    assert docstore.getfragments(KEY) is fragments
+    docstore.markchanged(KEY)
+    assert docstore.getfragments(KEY) is not fragments
+
+def test_cursor_slicesize(docstore):
+    """Cursors page with the page size of the customslices the client received"""
+    doc = docstore[KEY]
+    words = list(doc.words())
+    assert docstore.addcursor(KEY, 's1', 'q', words[:20], slicesize=20) is None #a single page
+    cursorid = docstore.addcursor(KEY, 's1', 'q', words[:30], slicesize=20)
+    assert docstore.getcursor(cursorid)[3] == 20
+    assert docstore.findcursor(KEY, 's1', 'q', 20) == cursorid
+    assert docstore.findcursor(KEY, 's1', 'q') is None
+
+def test_copymove_exists(docstore, tmp_path):
+    """Copies and moves never overwrite, they report whether they were done"""
+    assert docstore.copy(KEY, ('ns','copy'))
+    assert not docstore.copy(KEY, ('ns','copy'))
+    assert not docstore.move(KEY, ('ns','copy'))
+    assert os.path.exists(str(tmp_path / 'ns' / 'doc.folia.xml'))
+    assert docstore.move(('ns','copy'), ('ns','moved'))
+    with pytest.raises(NoSuchDocument):
+        docstore.copy(('ns','nonexistent'), ('ns','other'))
+
+def test_history_commitduringlog(gitdocstore, monkeypatch):
+    """A commit made while the history is being read is not lost behind a stale cache entry"""
+    run = subprocess.run
+    committers = []
+    def commitduringlog(*args, **kwargs):
+        if not committers:
+            committers.append(threading.Thread(target=gitdocstore.gitcommit, args=(KEY, "Second"), kwargs={'filename': gitdocstore.getfilename(KEY)}))
+            with open(gitdocstore.getfilename(KEY), 'a', encoding='utf-8') as f:
+                f.write("\n")
+            committers[0].start()
+            committers[0].join(0.5) #blocks on the git lock
+        return run(*args, **kwargs)
+    monkeypatch.setattr(foliadocserve.subprocess, 'run', commitduringlog)
+    history, _ = gitdocstore.gethistory(KEY)
+    committers[0].join()
+    assert len(history) == 1
+    history, _ = gitdocstore.gethistory(KEY)
+    assert len(history) == 2
+
+def test_revert_removedelement(gitdocstore):
+    """Elements that a revert removes are reported to other sessions"""
+    commit = gitdocstore.gethistory(KEY)[0][0]['commit']
+    doc = gitdocstore[KEY]
+    doc.data[0].append(folia.Paragraph, id="new.p")
+    gitdocstore.markchanged(KEY, [doc["new.p"]])
+    gitdocstore.save(KEY)
+    gitdocstore.updateq[KEY]['s1'] #pylint: disable=pointless-statement
+    gitdocstore.revert(KEY, commit)
+    assert gitdocstore.updateq[KEY]['s1'] == {"new.p"}
+    response = json.loads(parsedelta(gitdocstore.updateq[KEY]['s1'], gitdocstore[KEY], version=VERSION))
+    assert response['removedelements'] == ["new.p"]
+
+def test_detach_attempts(docstore, monkeypatch):
+    """Copying a document that is being read is retried a bounded number of times, a RecursionError is not retried at all"""
+    doc, _ = docstore.pin(KEY)
+    attempts = []
+    def failingcopy(exception):
+        def deepcopy(*args):
+            attempts.append(exception)
+            raise exception("copy failed")
+        return deepcopy
+    docstore.use(KEY)
+    try:
+        monkeypatch.setattr(foliadocserve.copy, 'deepcopy', failingcopy(RuntimeError))
+        with pytest.raises(RuntimeError):
+            docstore.detach(KEY)
+        assert len(attempts) == foliadocserve.MAXCOPYATTEMPTS
+        attempts.clear()
+        monkeypatch.setattr(foliadocserve.copy, 'deepcopy', failingcopy(RecursionError))
+        with pytest.raises(RecursionError):
+            docstore.detach(KEY)
+        assert len(attempts) == 1
+        assert docstore.data[KEY] is doc
+    finally:
+        docstore.done(KEY)
+        docstore.unpin(KEY, doc)
+
+def test_detach_carryids(docstore):
+    """Identifiers a reader assigns after the document was copied are carried over to the copy"""
+    doc, _ = docstore.pin(KEY)
+    docstore.use(KEY)
+    try:
+        live = docstore.detach(KEY)
+    finally:
+        docstore.done(KEY)
+    assert live is not doc
+    word = doc['untitleddoc.p.3.s.1.w.2']
+    pos = word.annotation(folia.PosAnnotation)
+    pos.id = 'new.pos'
+    doc.index['new.pos'] = pos
+    docstore.unpin(KEY, doc)
+    assert live['new.pos'].parent.id == 'untitleddoc.p.3.s.1.w.2'
+    assert not docstore.detached
+
+def test_cachedxml(docstore):
+    """A cached serialisation is served without pinning the document, but not while it is being edited"""
+    assert docstore.getcachedxml(KEY) is None
+    etag, xml = docstore.getxml(KEY)
+    assert docstore.getcachedxml(KEY) == (etag, xml, docstore.getversion(KEY))
+    assert not docstore.readers
+    editing = threading.Event()
+    done = threading.Event()
+    def edit():
+        docstore.use(KEY)
+        editing.set()
+        done.wait()
+        docstore.done(KEY)
+    thread = threading.Thread(target=edit)
+    thread.start()
+    editing.wait()
+    assert docstore.getcachedxml(KEY) is None
+    done.set()
+    thread.join()
+    docstore.markchanged(KEY)
+    assert docstore.getcachedxml(KEY) is None
+
+def test_cursors_concurrent(docstore):
+    """Cursors are added, looked up and evicted by requests for many documents at the same time"""
+    docstore.maxcursorids = 500
+    words = list(docstore[KEY].words())[:60]
+    errors = []
+    def run(n):
+        try:
+            for i in range(200):
+                cursorid = docstore.addcursor(KEY, 's' + str(n), 'q' + str(i % 7), words, slicesize=20)
+                docstore.findcursor(KEY, 's' + str(n), 'q' + str(i % 5), 20)
+                try:
+                    docstore.getcursor(cursorid)
+                except KeyError:
+                    pass #evicted by another thread
+        except Exception as e: #pylint: disable=broad-except
+            errors.append(e)
+    threads = [ threading.Thread(target=run, args=(n,)) for n in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert docstore.cursorids == sum( len(cursor[4]) for cursor in docstore.cursors.values() ) <= 500
+
+def test_continuations_concurrent(docstore, monkeypatch):
+    """Continuation tokens are added, used and evicted by requests for many documents at the same time"""
+    monkeypatch.setattr(foliadocserve, 'MAXCONTINUATIONS', 16)
+    switchinterval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6) #switch threads as often as possible
+    remainder = list(docstore[KEY].words())[:5]
+    errors = []
+    def run(n):
+        try:
+            for i in range(300):
+                token = docstore.addcontinuation(KEY, remainder, ['q' + str(n)])
+                if i % 2:
+                    try:
+                        assert docstore.getcontinuation(token)[1] is remainder
+                    except KeyError:
+                        pass #evicted by another thread
+        except Exception as e: #pylint: disable=broad-except
+            errors.append(e)
+    threads = [ threading.Thread(target=run, args=(n,)) for n in range(8) ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switchinterval)
+    assert not errors
+    assert len(docstore.continuations) <= 16
+
+def test_move_opposite(docstore, monkeypatch):
+    """Opposite moves of two documents take their locks in the same order, so they can not deadlock"""
+    other = ('ns','other')
+    shutil.copyfile(TESTFLAT, docstore.getfilename(other))
+    use = docstore.use
+    def slowuse(key):
+        use(key)
+        time.sleep(0.001) #give the other thread the opportunity to take a lock in between
+    monkeypatch.setattr(docstore, 'use', slowuse)
+    def run(source, target):
+        for _ in range(50):
+            assert not docstore.move(source, target) #both exist, never overwritten
+    threads = [ threading.Thread(target=run, args=(KEY, other), daemon=True), threading.Thread(target=run, args=(other, KEY), daemon=True) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert not any( thread.is_alive() for thread in threads )
+
+def gitfiles(docstore):
+    return subprocess.run(["git","ls-files"], stdout=subprocess.PIPE, cwd=docstore.workdir, check=True).stdout.decode('utf-8').split()
+
+def test_namespace_prerendered(gitdocstore, tmp_path):
+    """Prerendered output is not copied along with a namespace, and never committed to git"""
+    os.makedirs(str(tmp_path / 'ns' / '.doc.flat'))
+    with open(str(tmp_path / 'ns' / '.doc.flat' / 'probe.json.gz'), 'wb') as f:
+        f.write(b'rendered')
+    assert gitdocstore.copynamespace('ns', 'copied')
+    assert not os.path.exists(str(tmp_path / 'copied' / '.doc.flat'))
+    assert gitdocstore.movenamespace('ns', 'moved')
+    assert os.path.exists(str(tmp_path / 'moved' / '.doc.flat' / 'probe.json.gz')) #still valid for the moved document
+    assert sorted(gitfiles(gitdocstore)) == ['copied/doc.folia.xml', 'moved/doc.folia.xml']
+
+def test_import_report(docstore, tmp_path):
+    """Bulk imports report duplicate document IDs, invalid files and existing documents, and import the rest"""
+    sources = tmp_path / 'sources'
+    os.makedirs(str(sources))
+    with open(TESTFLAT, 'rb') as f:
+        data = f.read()
+    for name, content in (('a', data), ('b', data), ('c', data.replace(b'xml:id="untitleddoc"', b'xml:id="other"', 1)), ('bad', b'<notfolia>')):
+        with open(str(sources / (name + '.folia.xml')), 'wb') as f:
+            f.write(content)
+    filenames = [ str(sources / (name + '.folia.xml')) for name in ('a', 'b', 'c', 'bad') ]
+    report = docstore.importdocuments('imported', filenames, workers=2)
+    assert report['imported'] == 2
+    assert [ failure['file'] for failure in report['failed'] ] == filenames[1::2]
+    assert report['failed'][0]['error'] == "Duplicate document ID untitleddoc"
+    assert report['failed'][1]['error'].startswith("[")
+    assert sorted(os.listdir(str(tmp_path / 'imported'))) == ['other.folia.xml', 'untitleddoc.folia.xml'] #no temporary files are left behind
+    report = docstore.importdocuments('imported', filenames[2:3], workers=1)
+    assert report['imported'] == 0
+    assert report['failed'] == [{'file': filenames[2], 'error': "Document other already exists"}]
+    report = docstore.importdocuments('imported', filenames[2:3], workers=1, overwrite=True)
+    assert report['imported'] == 1
+    assert report['failed'] == []
+
+def test_expiry_inuse(docstore):
+    """Documents that are still in use when their expiry check is due are rescheduled rather than unloaded"""
+    docstore[KEY] #pylint: disable=pointless-statement
+    now = time.time()
+    docstore.lastaccess[KEY]['NOSID'] = now - 1000
+    docstore.lastaccess[KEY]['s1'] = now - 100 #still active
+    docstore.expiryschedule[:] = [(now - 1, KEY)]
+    docstore.autounload(save=False)
+    assert KEY in docstore
+    assert docstore.expiryschedule == [(now - 100 + docstore.expiretime, KEY)] #when the last session expires
+    begin = time.time()
+    docstore.waitforexpiry(0.5)
+    assert time.time() - begin >= 0.4 #nothing is due yet
+    docstore.lastaccess[KEY]['s1'] = now - 1000
+    docstore.expiryschedule[:] = [(now - 1, KEY)]
+    begin = time.time()
+    docstore.waitforexpiry(10)
+    assert time.time() - begin < 5 #due right away
+    docstore.autounload(save=False)
+    assert KEY not in docstore
+    assert docstore.expiryschedule == []
+
+@pytest.mark.parametrize("params", [{}, {'declarations': '1', 'setdefinitions': '1', 'metadata': '1', 'toc': '1', 'slices': 'p:2,s:4'}], ids=["plain", "declarations"])
+def test_renderpool(renderdocstore, params):
+    """Rendering in the render pool gives the same output as rendering in the request thread, also after an edit"""
+    flatargs = getflatargs(params)
+    flatargs['version'] = VERSION
+    doc = renderdocstore[KEY]
+    for cls in (None, "N(x)"):
+        if cls:
+            word = doc['doc.p.2.s.1.w.2']
+            word.annotation(folia.PosAnnotation).cls = cls
+            renderdocstore.markchanged(KEY, [word.annotation(folia.PosAnnotation)])
+        results = [ fql.Query('SELECT s FORMAT flat')(doc, False) ]
+        pooled = renderdocstore.renderinpool(KEY, doc, results, dict(flatargs))
+        assert pooled is not None
+        threshold, renderdocstore.renderthreshold = renderdocstore.renderthreshold, float('inf')
+        try:
+            inthread = renderdocstore.render(KEY, doc, results, **flatargs)
+        finally:
+            renderdocstore.renderthreshold = threshold
+        assert json.loads(pooled) == json.loads(inthread)
+        if cls:
+            assert cls in json.dumps(json.loads(pooled))
+    assert len(os.listdir(renderdocstore.snapshotdir)) == 1 #the snapshot of the previous version was removed
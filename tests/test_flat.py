@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import threading
+import pytest
+import folia.main as folia
+from folia import fql
+from foliadocserve import flat
+from foliadocserve.planner import Planner
+
+TESTFLAT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'foliadocserve', 'testflat.folia.xml')
+
+SENTENCE = 'untitleddoc.p.3.s.1'
+WORD = 'untitleddoc.p.3.s.1.w.2'
+POS = WORD + '/pos/http://ilk.uvt.nl/folia/sets/frog-mbpos-cgn-nonexistant'
+LEMMA = WORD + '/lemma/http://ilk.uvt.nl/folia/sets/frog-mblem-nl'
+
+@pytest.fixture
+def doc():
+    return folia.Document(file=TESTFLAT, autodeclare=True, allowadhocsets=True, loadsetdefinitions=False)
+
+def edit(doc, rawquery, planned=False):
+    """Runs the query like the document server does, returns what changed"""
+    query = Planner().plan(rawquery) if planned else fql.Query(rawquery)
+    return flat.getchanges(query(doc, False), query)
+
+def delta(doc, changes):
+    return json.loads(flat.parsedelta(changes, doc, version='test'))
+
+
+@pytest.mark.parametrize("planned", [False, True], ids=["fql", "planner"])
+@pytest.mark.parametrize("rawquery", [
+    'EDIT pos WITH class "N(x)" FOR ID "%s" FORMAT flat' % WORD,
+    'EDIT pos WITH class "N(x)" FOR w ID "%s" RETURN target FORMAT flat' % WORD,
+])
+def test_annotation(doc, rawquery, planned):
+    """Only the changed annotation is rendered, with the links of its structure element"""
+    changes = edit(doc, rawquery, planned)
+    assert changes == {(WORD, POS)}
+    response = delta(doc, changes)
+    assert response['elements'] == []
+    assert list(response['annotations']) == [POS]
+    assert response['annotations'][POS]['class'] == 'N(x)'
+    assert POS in response['links'][WORD]
+    assert LEMMA in response['links'][WORD]
+
+def test_removedannotation(doc):
+    changes = edit(doc, 'DELETE pos FOR ID "%s" FORMAT flat' % WORD)
+    assert changes == {(WORD, POS)}
+    response = delta(doc, changes)
+    assert response['removed'] == [POS]
+    assert response['annotations'] == {}
+    assert POS not in response['links'][WORD]
+
+def test_text(doc):
+    """Text has no annotation of its own in FLAT, the structure element is rendered anew"""
+    changes = edit(doc, 'EDIT t WITH text "x" FOR ID "%s" FORMAT flat' % WORD)
+    assert changes == {WORD}
+    response = delta(doc, changes)
+    assert [ element['elementid'] for element in response['elements'] ] == [WORD]
+    assert POS in response['annotations']
+
+def test_removedelement(doc):
+    changes = edit(doc, 'DELETE w ID "%s" FORMAT flat' % WORD)
+    assert changes == {WORD}
+    response = delta(doc, changes | {(WORD, POS)}) #annotations of removed elements are not listed separately
+    assert response['removedelements'] == [WORD]
+    assert response['removed'] == []
+    assert response['elements'] == []
+
+def test_wordorder_concurrent(doc):
+    """Neighbour lookups by concurrent readers are correct while the shared token order is being rebuilt"""
+    wordorder = flat.WordOrder(doc)
+    words = list(doc.words())
+    errors = []
+    stop = threading.Event()
+    def rebuild():
+        while not stop.is_set():
+            wordorder.rebuild()
+    def lookup():
+        try:
+            for _ in range(5):
+                for i, word in enumerate(words[1:-1], 1):
+                    assert wordorder.previous(word) is words[i-1]
+                    assert wordorder.next(word) is words[i+1]
+        except Exception as e: #pylint: disable=broad-except
+            errors.append(e)
+    rebuilder = threading.Thread(target=rebuild)
+    readers = [ threading.Thread(target=lookup) for _ in range(4) ]
+    switchinterval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    try:
+        rebuilder.start()
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+    finally:
+        stop.set()
+        rebuilder.join()
+        sys.setswitchinterval(switchinterval)
+    assert not errors
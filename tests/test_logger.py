@@ -0,0 +1,72 @@
+import os
+import threading
+from foliadocserve.logger import Logger, DEBUG, INFO, WARNING, ERROR
+
+class BlockingStream:
+    """Stream that blocks writing until released, like a disk that can't keep up"""
+
+    def __init__(self):
+        self.lines = []
+        self.writing = threading.Event()
+        self.released = threading.Event()
+
+    def write(self, line):
+        self.writing.set()
+        self.released.wait()
+        self.lines.append(line)
+
+    def flush(self):
+        pass
+
+def readlines(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return f.readlines()
+
+
+def test_level(tmp_path):
+    logger = Logger(str(tmp_path / 'log'), level=WARNING)
+    logger.log("debug", DEBUG)
+    logger.log("info", INFO)
+    logger.log("warning", WARNING, sid="s1", docsel=('ns','doc'), duration=0.5)
+    logger.log("error", ERROR)
+    logger.close()
+    lines = readlines(str(tmp_path / 'log'))
+    assert [ line.split(" - ", 1)[1] for line in lines ] == ["WARNING: warning | sid=s1 docsel=ns/doc duration=0.500\n", "ERROR: error\n"]
+    assert logger.stats()['written'] == 2
+
+def test_dropped():
+    """Messages that do not fit in the buffer are dropped without blocking, and counted in the log once there is room"""
+    stream = BlockingStream()
+    logger = Logger(stream=stream, buffersize=2)
+    logger.log("first")
+    assert stream.writing.wait(10) #the writer is stuck on the first message
+    for i in range(5):
+        logger.log("message " + str(i))
+    assert logger.stats()['dropped'] == 3
+    stream.released.set()
+    logger.close()
+    assert [ line.split(" - ", 1)[1] for line in stream.lines ] == ["first\n", "WARNING: Log buffer full, 3 message(s) dropped\n", "message 0\n", "message 1\n"]
+    assert logger.stats() == {'level': 'INFO', 'queued': 0, 'written': 3, 'dropped': 3, 'rotations': 0}
+
+def test_rotation(tmp_path):
+    """The log is rotated once it exceeds the maximum size, keeping the configured number of backups"""
+    filename = str(tmp_path / 'log')
+    logger = Logger(filename, maxbytes=1000, backups=2)
+    for i in range(100):
+        logger.log("message %03d" % i)
+    logger.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['log', 'log.1', 'log.2']
+    assert logger.stats()['rotations'] > 2
+    for backup in (filename + '.2', filename + '.1'):
+        assert os.path.getsize(backup) >= 1000
+    messages = [ line.split(" - ", 1)[1].strip() for backup in (filename + '.2', filename + '.1', filename) for line in readlines(backup) ]
+    assert messages == [ "message %03d" % i for i in range(100 - len(messages), 100) ] #the most recent messages, in order
+
+def test_rotation_nobackups(tmp_path):
+    filename = str(tmp_path / 'log')
+    logger = Logger(filename, maxbytes=1000, backups=0)
+    for i in range(100):
+        logger.log("message %03d" % i)
+    logger.close()
+    assert os.listdir(str(tmp_path)) == ['log']
+    assert os.path.getsize(filename) < 1000
@@ -0,0 +1,139 @@
+import os
+from collections import defaultdict
+import pytest
+import folia.main as folia
+from folia import fql
+from foliadocserve.planner import Planner, IdQuery
+
+TESTFLAT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'foliadocserve', 'testflat.folia.xml')
+
+WORD = "untitleddoc.p.3.s.1.w.3"
+ENTITYWORD = "untitleddoc.p.3.s.9.w.8" #covered by a named entity
+POSSET = "http://ilk.uvt.nl/folia/sets/frog-mbpos-cgn-nonexistant"
+LEMMASET = "http://ilk.uvt.nl/folia/sets/frog-mblem-nl"
+ENTITYSET = "http://ilk.uvt.nl/folia/sets/frog-ner-nl"
+
+#query, path it is expected to take: direct (executed by the planner), fallback (recognised, but handed to the FQL engine) or generic (not recognised)
+QUERIES = [
+    ('SELECT w ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('SELECT s ID "%s" FORMAT flat' % WORD, 'direct'), #the type is not checked when selecting by ID
+    ('SELECT w ID "nonexistent" FORMAT flat', 'direct'),
+    ('SELECT pos FOR ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('SELECT pos FOR w ID "%s" RETURN target FORMAT flat' % WORD, 'direct'),
+    ('SELECT pos OF "%s" FOR ID "%s" FORMAT flat' % (POSSET, WORD), 'direct'),
+    ('SELECT pos OF "other" FOR ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('SELECT entity FOR ID "%s" FORMAT flat' % ENTITYWORD, 'direct'),
+    ('SELECT lemma FOR ID "nonexistent" FORMAT flat', 'direct'),
+    ('EDIT pos WITH class "N(x)" FOR ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('EDIT pos OF "%s" WITH class "N(y)" FOR w ID "%s" RETURN target FORMAT flat' % (POSSET, WORD), 'direct'),
+    ('EDIT lemma WITH class "q" FOR ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('EDIT entity WITH class "per" FOR ID "%s" FORMAT flat' % ENTITYWORD, 'direct'),
+    ('EDIT entity OF "%s" WITH class "org" FOR ID "%s" RETURN target FORMAT flat' % (ENTITYSET, ENTITYWORD), 'direct'),
+    ('EDIT w ID "%s" WITH class "PUNCT" FORMAT flat' % WORD, 'direct'),
+    ('EDIT entity OF "http://other" WITH class "org" FOR ID "%s" FORMAT flat' % ENTITYWORD, 'fallback'), #nothing to edit, an ADD of a span fails
+    ('EDIT w ID "nonexistent" WITH class "PUNCT" FORMAT flat', 'fallback'), #no focus, FQL decides what happens
+    ('EDIT lemma OF "http://other" WITH class "x" FOR ID "%s" FORMAT flat' % WORD, 'fallback'), #nothing to edit, becomes an ADD
+    ('EDIT sense WITH class "s1" FOR ID "%s" FORMAT flat' % WORD, 'fallback'),
+    ('EDIT pos WITH class "N" FOR ID "nonexistent" FORMAT flat', 'fallback'),
+    ('ADD sense OF "http://sense" WITH class "s1" FOR ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('ADD pos WITH class "N" FOR ID "%s" FORMAT flat' % ENTITYWORD, 'direct'), #duplicate annotation
+    ('ADD lemma OF "http://other" WITH class "x" FOR ID "%s" RETURN target FORMAT flat' % WORD, 'direct'),
+    ('ADD pos WITH class "N" FOR ID "nonexistent" FORMAT flat', 'direct'),
+    ('EDIT pos WITH class "N(x)" annotator "proycon" annotatortype "manual" confidence 0.5 FOR ID "%s" FORMAT flat' % WORD, 'direct'), #as FLAT edits
+    ('EDIT lemma WITH class "q" annotator "proycon" annotatortype "auto" confidence "1.0" FOR w ID "%s" RETURN target FORMAT flat' % WORD, 'direct'),
+    ('EDIT pos WITH class "N" annotator NONE n "1" FOR ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('EDIT pos WITH text "x" FOR ID "%s" FORMAT flat' % WORD, 'generic'),
+    ('ADD sense OF "http://sense" WITH class "s1" annotator "proycon" annotatortype "manual" FOR ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('ADD comment WITH class "x" FOR ID "%s" FORMAT flat' % WORD, 'generic'),
+    ('DELETE pos FOR ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('DELETE lemma OF "%s" FOR ID "%s" RETURN target FORMAT flat' % (LEMMASET, WORD), 'direct'),
+    ('DELETE w ID "%s" FORMAT flat' % WORD, 'direct'),
+    ('DELETE w ID "nonexistent" FORMAT flat', 'direct'),
+    ('DELETE entity FOR ID "%s" FORMAT flat' % ENTITYWORD, 'direct'),
+    ('SELECT w WHERE text = "x" FORMAT flat', 'generic'),
+    ('SELECT w ID "%s" FORMAT xml' % WORD, 'generic'),
+    ('SELECT w ID "%s" FOR ID "%s" FORMAT flat' % (WORD, WORD), 'generic'),
+    ('EDIT pos WITH class "a\\"b" FOR ID "%s" FORMAT flat' % WORD, 'generic'), #escapes are left to the FQL parser
+]
+
+def load(processor):
+    return folia.Document(file=TESTFLAT, autodeclare=True, allowadhocsets=True, loadsetdefinitions=False, processor=folia.Processor("test", id="p.test") if processor else None)
+
+def run(query, doc):
+    """Returns the results of the query (in a comparable form) and the exception it raised, if any"""
+    try:
+        results = query(doc, False)
+    except Exception as e: #pylint: disable=broad-except
+        return None, (e.__class__, str(e))
+    if isinstance(results, str):
+        return results, None
+    return [ (e.__class__, e.id, getattr(e, 'cls', None), e.xmlstring()) for e in results ], None
+
+
+@pytest.mark.parametrize("processor", [False, True], ids=["noprocessor", "processor"])
+@pytest.mark.parametrize("rawquery,path", QUERIES, ids=[ q for q, _ in QUERIES ])
+def test_equivalence(rawquery, path, processor):
+    """The planned query has the same results, raises the same exceptions and leaves the same document as the FQL engine"""
+    reference, planned = load(processor), load(processor)
+    planner = Planner()
+    query = planner.plan(rawquery)
+    assert isinstance(query, IdQuery) == (path != 'generic')
+    assert run(query, planned) == run(fql.Query(rawquery), reference)
+    assert planned.xmlstring() == reference.xmlstring()
+    stats = planner.stats()
+    if path == 'generic':
+        assert stats['generic'] == 1
+    else:
+        assert stats[path] == {query.action.action: 1}
+
+def test_disabled():
+    planner = Planner(False)
+    query = planner.plan(QUERIES[0][0])
+    assert isinstance(query, fql.Query)
+    assert planner.stats() == {'enabled': False, 'direct': {}, 'fallback': {}, 'generic': 1, 'hitrate': 0.0}
+
+def test_stats():
+    planner = Planner()
+    assert planner.stats()['hitrate'] is None
+    expected = {'direct': defaultdict(int), 'fallback': defaultdict(int), 'generic': 0}
+    for rawquery, path in QUERIES:
+        query = planner.plan(rawquery)
+        run(query, load(False))
+        if path == 'generic':
+            expected['generic'] += 1
+        else:
+            expected[path][rawquery.split()[0]] += 1
+    stats = planner.stats()
+    assert stats['direct'] == expected['direct']
+    assert stats['fallback'] == expected['fallback']
+    assert stats['generic'] == expected['generic']
+    assert stats['hitrate'] == round(sum(expected['direct'].values()) / len(QUERIES), 4)
+
+@pytest.mark.parametrize("rawquery", [
+    'EDIT pos WITH class "N(x)" annotator "proycon" annotatortype "manual" datetime now FOR ID "%s" FORMAT flat' % WORD,
+    'ADD sense OF "http://sense" WITH class "s1" datetime "now" FOR ID "%s" FORMAT flat' % WORD,
+])
+def test_datetime(rawquery):
+    """The time of the edit differs between runs, so compare everything but the datetime"""
+    reference, planned = load(True), load(True)
+    planner = Planner()
+    query = planner.plan(rawquery)
+    assert isinstance(query, IdQuery)
+    results, referenceresults = query(planned, False), fql.Query(rawquery)(reference, False)
+    assert len(results) == len(referenceresults) == 1
+    assert results[0].datetime is not None
+    for result in (results[0], referenceresults[0]):
+        result.datetime = None
+    assert planned.xmlstring() == reference.xmlstring()
+    assert planner.stats()['direct'] == {query.action.action: 1}
+
+@pytest.mark.parametrize("rawquery", [
+    'EDIT pos WITH class "N" annotatortype "other" FOR ID "%s" FORMAT flat' % WORD,
+    'EDIT pos WITH class "N" confidence "high" FOR ID "%s" FORMAT flat' % WORD,
+])
+def test_invalidassignment(rawquery):
+    """Invalid values are left to the FQL parser, which reports them"""
+    planner = Planner()
+    with pytest.raises(fql.SyntaxError):
+        planner.plan(rawquery)
+    assert planner.stats()['generic'] == 1
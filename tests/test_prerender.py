@@ -0,0 +1,54 @@
+import os
+import json
+import shutil
+import pytest
+import foliadocserve.foliadocserve as foliadocserve
+from foliadocserve.foliadocserve import DocStore
+from foliadocserve.prerender import getprerenderdir, getprobeargs, getrenderrequests, DEFAULTSLICES
+from foliadocserve.compression import readfile
+
+TESTFLAT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'foliadocserve', 'testflat.folia.xml')
+
+KEY = ('ns', 'doc')
+
+@pytest.fixture
+def docstore(tmp_path):
+    os.makedirs(str(tmp_path / 'ns'))
+    shutil.copyfile(TESTFLAT, str(tmp_path / 'ns' / 'doc.folia.xml'))
+    docstore = DocStore(str(tmp_path), 600)
+    count = docstore.prerender(KEY, assignids=True)
+    assert count == len(list(getrenderrequests(docstore[KEY])))
+    return docstore
+
+def getprobe(docstore):
+    """Returns the rendering of the initial request of a viewer"""
+    return docstore.getprerendered(KEY, "PROBE", getprobeargs(DEFAULTSLICES))
+
+
+def test_prerendered(docstore):
+    assert getprobe(docstore) is None #loaded documents may have unsaved edits
+    docstore.unload(KEY)
+    filename = getprobe(docstore)
+    assert os.path.dirname(filename) == getprerenderdir(docstore.getbasename(KEY))
+    assert 'toc' in json.loads(readfile(filename, 'gz'))
+    assert docstore.getprerendered(KEY, "PROBE", getprobeargs([('s', 10)])) is None #rendered with other arguments
+
+def test_stamp_modified(docstore):
+    """Renderings are no longer served once the document on disk changes"""
+    docstore.unload(KEY)
+    filename = docstore.getfilename(KEY)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert getprobe(docstore) is None
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert getprobe(docstore) is not None
+    with open(filename, 'a', encoding='utf-8') as f:
+        f.write("\n")
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert getprobe(docstore) is None #same modification time, different size
+
+def test_stamp_version(docstore, monkeypatch):
+    """Renderings made by another version of the document server are not served"""
+    docstore.unload(KEY)
+    monkeypatch.setattr(foliadocserve, 'VERSION', foliadocserve.VERSION + ".other")
+    assert getprobe(docstore) is None
@@ -0,0 +1,301 @@
+import os
+import io
+import ast
+import gzip
+import json
+import zipfile
+import shutil
+import socket
+import argparse
+import http.client
+from urllib.parse import urlencode
+import pytest
+import cherrypy
+import folia.main as folia
+from foliadocserve.foliadocserve import DocStore, Root, BackgroundTaskQueue, fake_wait_for_occupied_port
+from foliadocserve.compression import getextension, writefile
+from foliadocserve.tokentable import TokenTable
+
+TESTFLAT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'foliadocserve', 'testflat.folia.xml')
+
+WORD = 'untitleddoc.p.3.s.1.w.2'
+POS = WORD + '/pos/http://ilk.uvt.nl/folia/sets/frog-mbpos-cgn-nonexistant'
+
+class Server:
+    """The document server running in this process"""
+
+    def __init__(self, workdir, port, docstore):
+        self.workdir = workdir
+        self.port = port
+        self.docstore = docstore
+
+    def adddocument(self, docid, namespace='ns', compression=None):
+        """Adds a copy of the test document, returns its document selector"""
+        os.makedirs(os.path.join(self.workdir, namespace), exist_ok=True)
+        if compression:
+            with open(TESTFLAT, 'rb') as f:
+                writefile(os.path.join(self.workdir, namespace, docid + getextension(compression)), f.read(), compression)
+        else:
+            shutil.copyfile(TESTFLAT, os.path.join(self.workdir, namespace, docid + '.folia.xml'))
+        return namespace + '/' + docid
+
+    def request(self, path, params=None, headers=None, body=None):
+        """Returns the status, headers and (raw, not decoded) body of the response, requests with a body are posted"""
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            connection.request('GET' if body is None else 'POST', path + ('?' + urlencode(params, doseq=True) if params else ''), body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            connection.close()
+
+    def query(self, query, headers=None, **params):
+        params['query'] = query
+        return self.request('/query/', params, headers)
+
+    def edit(self, docsel, cls, headers=None, **params):
+        """Edits the part-of-speech tag of a word, returns the response"""
+        return self.query('USE ' + docsel + ' EDIT pos WITH class "' + cls + '" FOR ID "' + WORD + '" FORMAT flat', headers, **params)
+
+    def poll(self, docsel, sid, **params):
+        status, _, body = self.request('/poll/' + docsel, params, {'X-Sessionid': sid})
+        assert status == 200
+        return json.loads(body)
+
+def readnpy(data):
+    """Reads an integer array in NumPy's .npy format (version 1.0) to a list, without depending on NumPy"""
+    assert data[:8] == b"\x93NUMPY\x01\x00"
+    headersize = int.from_bytes(data[8:10], 'little')
+    assert (10 + headersize) % 64 == 0 #the data is aligned
+    header = ast.literal_eval(data[10:10+headersize].decode('latin-1'))
+    itemsize = int(header['descr'][2:])
+    assert header['descr'][:2] == '<i' and not header['fortran_order']
+    data = data[10+headersize:]
+    assert len(data) == header['shape'][0] * itemsize
+    return [ int.from_bytes(data[i:i+itemsize], 'little', signed=True) for i in range(0, len(data), itemsize) ]
+
+def getexpectedcolumns():
+    """Returns the (decoded) columns of the token table of the test document"""
+    table = TokenTable(folia.Document(file=TESTFLAT, autodeclare=True, allowadhocsets=True, loadsetdefinitions=False))
+    return { name: [ table.get(row, name) for row in range(len(table)) ] for name in table.names }
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    workdir = str(tmp_path_factory.mktemp('workdir'))
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    args = argparse.Namespace(workdir=workdir, debug=0, allowtextredundancy=False, prerendered=False, threads=16, maxconcurrent=12, maxperdocument=4, maxqueue=4, admissiontimeout=10.0, noplanner=False)
+    cherrypy.config.update({
+        'server.socket_host': '127.0.0.1',
+        'server.socket_port': port,
+        'server.thread_pool': args.threads,
+        'engine.autoreload.on': False,
+        'log.screen': False,
+        'request.show_tracebacks': False,
+    })
+    cherrypy.process.servers.wait_for_occupied_port = fake_wait_for_occupied_port
+    docstore = DocStore(workdir, 600)
+    bgtask = BackgroundTaskQueue(cherrypy.engine)
+    bgtask.subscribe()
+    cherrypy.tree.mount(Root(docstore, bgtask, args), '/', {'/': {
+        'tools.compressresponse.on': True,
+        'tools.compressresponse.threshold': 4096,
+        'tools.compressresponse.level': 6,
+    }})
+    cherrypy.engine.start()
+    cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+    try:
+        yield Server(workdir, port, docstore)
+    finally:
+        cherrypy.engine.exit() #also stops the background task queue
+
+
+def test_etag_fromdisk(server):
+    """Documents that are not loaded are served from disk, with an ETag the client can revalidate with"""
+    docsel = server.adddocument('etagdisk')
+    status, headers, body = server.query('USE ' + docsel + ' GET')
+    assert status == 200
+    etag = headers['ETag']
+    assert etag and body.startswith(b'<?xml')
+    status, headers, body = server.query('USE ' + docsel + ' GET', {'If-None-Match': etag})
+    assert status == 304
+    assert body == b''
+    assert server.query('USE ' + docsel + ' GET', {'If-None-Match': 'W/' + etag})[0] == 304
+    assert server.query('USE ' + docsel + ' GET', {'If-None-Match': '"other"'})[0] == 200
+
+def test_etag_edit(server):
+    """The ETag of a loaded document changes with every edit"""
+    docsel = server.adddocument('etagedit')
+    server.query('USE ' + docsel + ' SELECT w ID "' + WORD + '" FORMAT flat')
+    status, headers, body = server.query('USE ' + docsel + ' GET')
+    assert status == 200
+    etag = headers['ETag']
+    assert server.query('USE ' + docsel + ' GET', {'If-None-Match': etag})[0] == 304
+    assert server.query('USE ' + docsel + ' EDIT pos WITH class "N(x)" FOR ID "' + WORD + '" FORMAT flat')[0] == 200
+    status, headers, body = server.query('USE ' + docsel + ' GET', {'If-None-Match': etag})
+    assert status == 200
+    assert headers['ETag'] != etag
+    assert b'class="N(x)"' in body
+    assert server.query('USE ' + docsel + ' GET', {'If-None-Match': headers['ETag']})[0] == 304
+
+def test_etag_documents(server):
+    """Document listings can be revalidated until a document is added"""
+    server.adddocument('first', 'listing')
+    status, headers, body = server.request('/documents/listing')
+    assert status == 200
+    assert json.loads(body)['documents'] == ['first.folia.xml']
+    etag = headers['ETag']
+    assert server.request('/documents/listing', headers={'If-None-Match': etag})[0] == 304
+    server.adddocument('second', 'listing')
+    status, headers, body = server.request('/documents/listing', headers={'If-None-Match': etag})
+    assert status == 200
+    assert sorted(json.loads(body)['documents']) == ['first.folia.xml', 'second.folia.xml']
+
+def test_encoding(server):
+    """Large responses are compressed if the client accepts it, revalidating works for either variant"""
+    docsel = server.adddocument('encoding')
+    status, headers, plain = server.query('USE ' + docsel + ' GET')
+    assert status == 200
+    assert 'Content-Encoding' not in headers
+    assert len(plain) > 4096
+    etag = headers['ETag']
+    status, headers, body = server.query('USE ' + docsel + ' GET', {'Accept-Encoding': 'gzip'})
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(body) == plain
+    assert headers['ETag'] != etag
+    assert server.query('USE ' + docsel + ' GET', {'Accept-Encoding': 'gzip', 'If-None-Match': headers['ETag']})[0] == 304
+    assert server.query('USE ' + docsel + ' GET', {'Accept-Encoding': 'gzip', 'If-None-Match': etag})[0] == 304
+    status, headers, body = server.query('USE ' + docsel + ' GET', {'Accept-Encoding': 'gzip;q=0, identity'})
+    assert 'Content-Encoding' not in headers
+    assert body == plain
+
+def test_encoding_threshold(server):
+    """Small responses are not worth compressing"""
+    server.adddocument('threshold', 'small')
+    status, headers, body = server.request('/documents/small', headers={'Accept-Encoding': 'gzip'})
+    assert status == 200
+    assert len(body) < 4096
+    assert 'Content-Encoding' not in headers
+    assert json.loads(body)['documents'] == ['threshold.folia.xml']
+
+def test_encoding_stored(server):
+    """Documents stored with the compression the client accepts are sent as stored"""
+    docsel = server.adddocument('stored', compression='gz')
+    status, headers, body = server.query('USE ' + docsel + ' GET', {'Accept-Encoding': 'gzip'})
+    assert status == 200
+    assert headers['Content-Encoding'] == 'gzip'
+    with open(os.path.join(server.workdir, 'ns', 'stored' + getextension('gz')), 'rb') as f:
+        assert body == f.read()
+    status, headers, plain = server.query('USE ' + docsel + ' GET')
+    assert 'Content-Encoding' not in headers
+    assert plain == gzip.decompress(body)
+
+def test_bulkimport(server):
+    """Failures are reported with the names of the files in the archive, other files in the archive are skipped"""
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as f:
+        f.write(TESTFLAT, 'docs/first.folia.xml')
+        f.write(TESTFLAT, 'docs/duplicate.folia.xml')
+        f.writestr('docs/invalid.folia.xml', '<notfolia>')
+        f.writestr('README', 'not a document')
+    status, _, body = server.request('/bulkimport/imported', body=archive.getvalue(), headers={'Content-Type': 'application/octet-stream'})
+    assert status == 200
+    report = json.loads(body)
+    assert report['imported'] == 1
+    assert [ failure['file'] for failure in report['failed'] ] == ['docs/duplicate.folia.xml', 'docs/invalid.folia.xml']
+    assert os.listdir(os.path.join(server.workdir, 'imported')) == ['untitleddoc.folia.xml']
+    status, _, body = server.request('/bulkimport/imported', body=b'not an archive', headers={'Content-Type': 'application/octet-stream'})
+    assert status == 400
+
+def test_poll_since(server, monkeypatch):
+    """Clients syncing since a version that is no longer in the ring of recent changes have to reload"""
+    monkeypatch.setattr(server.docstore, 'maxchanges', 2)
+    docsel = server.adddocument('since')
+    status, headers, _ = server.query('USE ' + docsel + ' SELECT w ID "' + WORD + '" FORMAT flat', {'X-Sessionid': 's1'})
+    assert status == 200
+    initial = int(headers['X-Docversion'])
+    status, headers, _ = server.edit(docsel, "N(1)", {'X-Sessionid': 's2'})
+    assert status == 200
+    first = int(headers['X-Docversion'])
+    response = server.poll(docsel, 's1', since=initial, delta=1)
+    assert response['docversion'] == first
+    assert list(response['annotations']) == [POS]
+    assert response['annotations'][POS]['class'] == "N(1)"
+    assert 'reload' not in response
+    for cls in ("N(2)", "N(3)"):
+        status, headers, _ = server.edit(docsel, cls, {'X-Sessionid': 's2'})
+    current = int(headers['X-Docversion'])
+    assert server.poll(docsel, 's1', since=first, delta=1)['annotations'][POS]['class'] == "N(3)" #still in the ring
+    for since in (initial, current + 1000):
+        response = server.poll(docsel, 's1', since=since, delta=1)
+        assert response['reload'] is True
+        assert response['docversion'] == current
+    response = server.poll(docsel, 's1', since=current, delta=1)
+    assert response['docversion'] == current
+    assert 'reload' not in response and 'annotations' not in response
+    assert server.request('/poll/' + docsel, {'since': 'x'}, {'X-Sessionid': 's1'})[0] == 400
+
+def test_ifmatch(server):
+    """Edits against an outdated version of the document are rejected with 409 and not applied"""
+    docsel = server.adddocument('ifmatch')
+    status, headers, _ = server.edit(docsel, "N(1)")
+    assert status == 200
+    version = headers['X-Docversion']
+    status, headers, _ = server.edit(docsel, "N(2)", {'If-Match': '"' + version + '"'})
+    assert status == 200
+    current = int(headers['X-Docversion'])
+    for headers, params in (({'If-Match': '"' + version + '"'}, {}), ({'If-Match': 'W/"' + version + '"'}, {}), ({}, {'docversion': version})):
+        status, _, body = server.edit(docsel, "N(3)", headers, **params)
+        assert status == 409
+        assert json.loads(body)['conflict'] is True
+        assert json.loads(body)['docversion'] == current
+    status, _, body = server.query('USE ' + docsel + ' SELECT pos FOR ID "' + WORD + '" FORMAT xml')
+    assert b'N(2)' in body and b'N(3)' not in body
+    assert server.edit(docsel, "N(3)", {'If-Match': '*'})[0] == 200
+    assert server.edit(docsel, "N(4)", {'If-Match': '"x"'})[0] == 400
+
+def test_export(server):
+    """The export is a zip archive with a string dictionary and an array of codes per column for every document"""
+    server.adddocument('first', 'export')
+    server.adddocument('second', 'export')
+    with open(os.path.join(server.workdir, 'export', 'invalid.folia.xml'), 'w', encoding='utf-8') as f:
+        f.write("<notfolia>")
+    server.query('USE export/second EDIT pos WITH class "N(x)" FOR ID "' + WORD + '" FORMAT flat') #loaded and edited
+    status, headers, body = server.request('/export/export')
+    assert status == 200
+    assert headers['Content-Type'] == 'application/zip'
+    expected = getexpectedcolumns()
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        manifest = json.loads(archive.read('manifest.json'))
+        assert manifest['columns'] == ['id', 'text', 'sentence', 'pos', 'lemma']
+        assert manifest['namespace'] == 'export'
+        documents = json.loads(archive.read('documents.json'))
+        assert list(documents) == ['first', 'invalid', 'second']
+        assert 'error' in documents['invalid']
+        for docid in ('first', 'second'):
+            assert documents[docid]['tokens'] == len(expected['id'])
+            strings = json.loads(archive.read(docid + '/strings.json'))
+            columns = { name: [ strings[code] if code != -1 else None for code in readnpy(archive.read(docid + '/' + name + '.npy')) ] for name in manifest['columns'] }
+            if docid == 'second':
+                expected['pos'][expected['id'].index(WORD)] = "N(x)"
+            assert columns == expected
+    assert server.request('/export/export/nonexistent')[0] == 404
+    assert server.request('/export/export', {'annotation': 'w'})[0] == 400
+
+def test_export_numpy(server):
+    """The export reads as an .npz file with NumPy"""
+    numpy = pytest.importorskip("numpy")
+    server.adddocument('doc', 'exportnumpy')
+    status, _, body = server.request('/export/exportnumpy/doc', {'annotation': ['pos', 'lemma', 'pos']})
+    assert status == 200
+    expected = getexpectedcolumns()
+    with numpy.load(io.BytesIO(body)) as archive:
+        assert {'doc/id', 'doc/text', 'doc/sentence', 'doc/pos', 'doc/lemma', 'doc/pos.2', 'doc/strings.json'} <= set(archive.files)
+        strings = json.loads(archive['doc/strings.json']) #files other than arrays are returned as is
+        for name, column in (('id', 'id'), ('pos', 'pos'), ('lemma', 'lemma'), ('pos.2', 'pos')):
+            array = archive['doc/' + name]
+            assert array.dtype.kind == 'i'
+            assert [ strings[code] if code != -1 else None for code in array.tolist() ] == expected[column]
@@ -0,0 +1,75 @@
+import os
+import time
+import pytest
+from folia.foliaset import SetDefinition
+from foliadocserve.setdefinitions import SetDefinitionCache
+
+TURTLE = """@prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+@prefix fsd: <http://folia.science.ru.nl/setdefinition#> .
+<https://example.org/test.foliaset.ttl#test> a skos:Collection ;
+    skos:notation "test" ;
+    skos:prefLabel "%s" ;
+    fsd:open true .
+"""
+
+@pytest.fixture
+def url(tmp_path):
+    """A set definition that can be 'downloaded', set definitions are read from local files just like from URLs"""
+    filename = str(tmp_path / 'test.foliaset.ttl')
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(TURTLE % "original")
+    return filename
+
+def update(url, label):
+    with open(url, 'w', encoding='utf-8') as f:
+        f.write(TURTLE % label)
+
+def waitrefresh(cache):
+    deadline = time.time() + 10
+    while cache.refreshing:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def getlabel(cache, url):
+    return cache.json(url)['label']
+
+
+def test_refresh_inmemory(tmp_path, url):
+    """Expired entries that are already in memory are refreshed in the background"""
+    cache = SetDefinitionCache(str(tmp_path / 'cache'), ttl=3600, log=lambda s: None)
+    cache[url] = SetDefinition(url)
+    update(url, "updated")
+    assert url in cache
+    assert not cache.refreshing #not expired
+    cache.ttl = 0
+    assert url in cache #served from memory right away
+    waitrefresh(cache)
+    assert getlabel(cache, url) == "updated"
+    assert cache.misses == 2
+
+def test_refresh_disk(tmp_path, url):
+    """Expired entries in the persistent cache are loaded, then refreshed in the background"""
+    cache = SetDefinitionCache(str(tmp_path / 'cache'), ttl=3600, log=lambda s: None)
+    cache[url] = SetDefinition(url)
+    update(url, "updated")
+    cache = SetDefinitionCache(str(tmp_path / 'cache'), ttl=0, log=lambda s: None)
+    assert url in cache
+    assert cache.diskhits == 1
+    waitrefresh(cache)
+    assert getlabel(cache, url) == "updated"
+    #the refreshed copy is persisted
+    cache = SetDefinitionCache(str(tmp_path / 'cache'), ttl=3600, log=lambda s: None)
+    assert url in cache
+    assert getlabel(cache, url) == "updated"
+
+def test_refresh_failure(tmp_path, url):
+    """If the set definition can not be obtained, the cached copy is kept and not retried before the TTL passes again"""
+    cache = SetDefinitionCache(str(tmp_path / 'cache'), ttl=3600, log=lambda s: None)
+    cache[url] = SetDefinition(url)
+    timestamp = cache.timestamps[url]
+    os.unlink(url)
+    cache.ttl = 0
+    assert url in cache
+    waitrefresh(cache)
+    assert getlabel(cache, url) == "original"
+    assert cache.timestamps[url] > timestamp
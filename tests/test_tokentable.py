@@ -0,0 +1,53 @@
+import os
+import pytest
+import folia.main as folia
+from folia import fql
+from foliadocserve.tokentable import TokenTable, getlayers
+
+TESTFLAT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'foliadocserve', 'testflat.folia.xml')
+
+SENTENCE = 'untitleddoc.p.3.s.12'
+
+@pytest.fixture
+def doc():
+    return folia.Document(file=TESTFLAT, autodeclare=True, allowadhocsets=True, loadsetdefinitions=False)
+
+def getrows(table):
+    return list(table.getrows(range(len(table))))
+
+def apply(doc, table, rawquery):
+    """Runs the query like the document server does and updates the table with the results"""
+    query = fql.Query(rawquery)
+    table.update(query(doc, False))
+
+def check(doc, table):
+    """The updated table has the same rows as a table built from scratch"""
+    rebuilt = TokenTable(doc, table.layers)
+    assert getrows(table) == getrows(rebuilt)
+    for row, id in enumerate(rebuilt.ids()):
+        assert table.locate(id) == row
+
+
+@pytest.mark.parametrize("rawqueries", [
+    ['SUBSTITUTE w WITH text "4" SUBSTITUTE w WITH text "uur" FOR SPAN ID "untitleddoc.p.3.s.12.w.5" FORMAT flat'], #split
+    ['SUBSTITUTE w WITH text "vieruur" FOR SPAN ID "untitleddoc.p.3.s.12.w.4" & ID "untitleddoc.p.3.s.12.w.5" FORMAT flat'], #merge
+    ['SUBSTITUTE w WITH text "4" SUBSTITUTE w WITH text "uur" FOR SPAN ID "untitleddoc.p.3.s.12.w.5" FORMAT flat',
+     'SUBSTITUTE w WITH text "vieruur" FOR SPAN ID "untitleddoc.p.3.s.12.w.4" & ID "untitleddoc.p.3.s.12.w.5" FORMAT flat'],
+    ['DELETE w ID "untitleddoc.p.3.s.8.w.10" FORMAT flat'],
+    ['EDIT pos WITH class "N(x)" FOR ID "untitleddoc.p.3.s.1.w.2" FORMAT flat', 'EDIT lemma WITH class "x" FOR ID "untitleddoc.p.3.s.1.w.3" FORMAT flat'],
+    ['DELETE pos FOR ID "untitleddoc.p.3.s.1.w.2" FORMAT flat'],
+    ['DELETE s ID "untitleddoc.p.3.s.2" FORMAT flat'],
+    ['ADD w WITH text "extra" FOR ID "' + SENTENCE + '" FORMAT flat'],
+], ids=["split", "merge", "splitmerge", "deleteword", "annotations", "deleteannotation", "deletesentence", "addword"])
+def test_update(doc, rawqueries):
+    table = TokenTable(doc)
+    for rawquery in rawqueries:
+        apply(doc, table, rawquery)
+        check(doc, table)
+
+def test_update_span(doc):
+    """Span annotation layers are updated for all tokens in the span"""
+    table = TokenTable(doc, getlayers(['pos', 'entity']))
+    apply(doc, table, 'ADD entity WITH class "per" RESPAN ID "untitleddoc.p.3.s.1.w.12" & ID "untitleddoc.p.3.s.1.w.12b" FOR ID "untitleddoc.p.3.s.1" FORMAT flat')
+    check(doc, table)
+    assert table.count('entity', 'per') >= 2